@@ -5,8 +5,10 @@ from config import Configuration
 from secrets import SecretManager
 from src.db.gateways.airport_gateway import AirportGateway
 from src.db.gateways.distance_pairs_gateway import AirportDistancePairsGateway
+from src.db.gateways.neighbors_gateway import AirportNeighborsGateway
 from src.db.pg_connect import FlightSearchPostgresDB, DBConnectConfig
-from src.flight_search.airport import Airport
+from src.geo.airport_dataset import AirportDatasetLoader
+from src.geo.distance_file import DistanceMatrixFile
 from util.logging.logger import get_logger, set_default_logger
 from util.logging.log_level import LogLevelEnum
 from util.logging.logging_handlers import FileHandler
@@ -32,7 +34,15 @@ def main():
         ]
     )
     set_default_logger(logger)
-    db = FlightSearchPostgresDB(config=DBConnectConfig(db_pass=secrets.db_password), logger=logger)
+    db = FlightSearchPostgresDB(
+        config=DBConnectConfig(
+            db_pass=secrets.db_password,
+            pool_min_connections=config.db_pool_min_connections,
+            pool_max_connections=config.db_pool_max_connections,
+            cursor_itersize=config.db_cursor_itersize
+        ),
+        logger=logger
+    )
 
     ap_gw = AirportGateway(
         pg=db,
@@ -44,51 +54,82 @@ def main():
     dist_gw = AirportDistancePairsGateway(
         pg=db,
         init_script=Path(config.db_distance_pairs_init_script).absolute(),
+        layout=config.db_distance_pairs_layout,
         debug_mode=bool(config.debug_mode),
         logger=logger
     )
-    airports = []
-    seen_uids = set()
-    with open(Path(config.world_map_airports_file)) as airports_file:
-        next(airports_file)  # Skip header
-        for airport_row in airports_file:
-            airport_details = airport_row[:-1].split(";")
-            if airport_details[0] not in {0, '0'}:
-                ap = Airport(
-                    full_name=airport_details[0],
-                    iso_country=airport_details[1],
-                    iso_region=airport_details[2],
-                    municipality=airport_details[3],
-                    latitude=float(airport_details[4]),
-                    longitude=float(airport_details[5]),
-                    size=airport_details[6],
-                    iata_code=airport_details[7],
-                    local_code=(airport_details[8] if len(airport_details) == 9 else '')
-                )
 
-            if ap.iata_code not in {None, ''}\
-                    and not (config.db_skip_small_airports and ap.size == 'small_airport')\
-                    and ap.uid not in seen_uids:
-                airports.append(ap)
-                seen_uids.add(ap.uid)
+    neighbors_gw = AirportNeighborsGateway(
+        pg=db,
+        init_script=Path(config.db_neighbors_init_script).absolute(),
+        max_radius_km=float(config.db_neighbors_max_radius_km),
+        debug_mode=bool(config.debug_mode),
+        logger=logger
+    )
+    loader = AirportDatasetLoader(
+        cache_location=Path(config.world_map_cache_location) if config.world_map_cache_location else None,
+        logger=logger
+    )
+    airports_dataset = loader.load(Path(config.world_map_airports_file))
+    airports = loader.to_airports(loader.filter(
+        airports_dataset,
+        closed=True,
+        small=not config.db_skip_small_airports,
+        require_iata=True,
+        unique=True
+    ))
 
     start = datetime.now()
 
-    added_airports = ap_gw.import_data(airports)
+    # Once the airports are stored, only the dataset's changes need importing
+    diff = ap_gw.diff(airports) if config.db_distance_pairs_import_incremental else None
+    if diff is not None and diff.stored:
+        dist_gw.delete_distances(diff.removed)
+        added_airports = ap_gw.apply_diff(diff)
+    else:
+        added_airports = ap_gw.import_data(airports)
     ap_import_finished = datetime.now()
     logger.info(f"Populating Airports table with {added_airports} entries took {format_timedelta_string(ap_import_finished - start)}")
-    n = dist_gw.import_data(
-        airports=airports,
-        batch_size=config.db_distance_pairs_import_batch_size,
-        validate=True
+    if dist_gw.by_id and config.db_distance_pairs_migrate_from_pair_id:
+        dist_gw.migrate_from_pair_layout()
+    sparse_options = dict(
+        max_distance_km=config.db_distance_pairs_import_max_distance_km or None,
+        max_neighbors=config.db_distance_pairs_import_max_neighbors or None
     )
+    if diff is not None and diff.stored:
+        n = dist_gw.import_diff(
+            airports=airports,
+            diff=diff,
+            batch_size=config.db_distance_pairs_import_batch_size,
+            workers=config.db_distance_pairs_import_workers,
+            validate=True,
+            **sparse_options
+        )
+    else:
+        n = dist_gw.import_data(
+            airports=airports,
+            batch_size=config.db_distance_pairs_import_batch_size,
+            workers=config.db_distance_pairs_import_workers,
+            validate=True,
+            **sparse_options
+        )
 
     logger.info(f"Calculating and populating {n} distances took {format_timedelta_string(datetime.now() - ap_import_finished)}")
+
+    neighbors_start = datetime.now()
+    n = neighbors_gw.import_data(airports)
+    logger.info(f"Building {n} neighbour list entries took {format_timedelta_string(datetime.now() - neighbors_start)}")
+
+    if config.db_distance_pairs_matrix_file:
+        matrix_file = DistanceMatrixFile.build(Path(config.db_distance_pairs_matrix_file), airports, logger=logger)
+        matrix_file.verify(dist_gw.iter_distances())
+        matrix_file.close()
     logger.info(f"Total time taken: {format_timedelta_string(datetime.now() - start)}")
 
     # mgr = FlightSearchManager(
     #     world_map=WorldMap(
     #         data=airports_dataset,
+    #         neighbors=neighbors_gw.get_neighbors,
     #         logger=logger
     #     ),
     #     fx_api=ExchangeRateMap(
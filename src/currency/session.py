@@ -1,9 +1,11 @@
 import dataclasses
 import json
+import time
 
 from requests import Session, Response
 
 from util.logging.logger import Logger, get_default_logger
+from util.rate_limiter import RateLimiter
 from util.types import const
 
 
@@ -26,12 +28,17 @@ class ExchangeRatesSession:
     _DAILY_LIMIT_KEY: const(str) = "X-RateLimit-Limit-Day"
     _DAILY_REMAINING_KEY: const(str) = "X-RateLimit-Remaining-Day"
 
-    def __init__(self, api_key: str, logger: Logger = None):
+    def __init__(self, api_key: str, rate_limiter: RateLimiter = None, logger: Logger = None):
+        """
+        Requests go through `rate_limiter`, which learns the daily quota from the rate limit headers of the responses
+        and retries 429s and 5xx with backoff.
+        """
         if logger:
             self.logger: Logger = logger
             self.__class__.logger = logger
         self._api_key: str = api_key
         self._sess: Session = Session()
+        self.rate_limiter: RateLimiter = rate_limiter or RateLimiter(logger=logger)
         self._rate_limiting: dict[str, int] = {
             self._MONTHLY_LIMIT_KEY: -1,
             self._MONTHLY_REMAINING_KEY: -1,
@@ -59,7 +66,16 @@ class ExchangeRatesSession:
         return f"{self.BASE_ENDPOINT}?base={base}"
 
     def _perform_request(self, url: str) -> Response:
-        return self._sess.get(url, headers={"apikey": self._api_key}, data={})
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            resp = self._sess.get(url, headers={"apikey": self._api_key}, data={})
+            self.rate_limiter.update_from_headers(resp.headers)
+            if (delay_s := self.rate_limiter.retry_delay(resp.status_code, attempt, resp.headers)) is None:
+                return resp
+            self.logger.warning(f"[{resp.status_code}] from `{url}`, retrying in {delay_s:.2f}s")
+            time.sleep(delay_s)
+            attempt += 1
 
     def get_rates(self, base: str) -> ExchangeRateResponse:
         url = self._build_url(base)
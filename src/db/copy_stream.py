@@ -0,0 +1,61 @@
+from typing import Any, Iterable, Iterator
+
+
+class CopyRowStream:
+    """
+    A read-only file-like object which lazily renders an iterable of row tuples into PostgreSQL's COPY text format.
+    It can be handed to `cursor.copy_expert` so rows are streamed to the server as they are produced, without
+    materializing the full payload in memory.
+    """
+
+    _ESCAPES: dict[int, str] = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+    def __init__(self, rows: Iterable[tuple]):
+        self._rows: Iterator[tuple] = iter(rows)
+        self._buffer: str = ''
+        self._exhausted: bool = False
+        self.rows_read: int = 0
+
+    @classmethod
+    def format_value(cls, value: Any) -> str:
+        if value is None:
+            return '\\N'
+        if isinstance(value, str):
+            return value.translate(cls._ESCAPES)
+        return str(value)
+
+    def _format_row(self, row: tuple) -> str:
+        return '\t'.join(self.format_value(x) for x in row) + '\n'
+
+    def _fill(self, size: int):
+        chunks = [self._buffer]
+        buffered = len(self._buffer)
+        while not self._exhausted and (size < 0 or buffered < size):
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                self._exhausted = True
+                break
+            line = self._format_row(row)
+            chunks.append(line)
+            buffered += len(line)
+            self.rows_read += 1
+        self._buffer = ''.join(chunks)
+
+    def read(self, size: int = -1) -> str:
+        self._fill(size)
+        if size < 0:
+            rv, self._buffer = self._buffer, ''
+        else:
+            rv, self._buffer = self._buffer[:size], self._buffer[size:]
+        return rv
+
+    def readline(self, size: int = -1) -> str:
+        if '\n' not in self._buffer:
+            self._fill(len(self._buffer) + 1)
+        idx = self._buffer.find('\n')
+        end = len(self._buffer) if idx < 0 else idx + 1
+        if 0 <= size < end:
+            end = size
+        rv, self._buffer = self._buffer[:end], self._buffer[end:]
+        return rv
@@ -1,4 +1,6 @@
+import dataclasses
 from pathlib import Path
+from typing import Iterator
 
 from src.db.gateways.base_gateway import BaseGateway
 from src.db.pg_connect import FlightSearchPostgresDB
@@ -7,17 +9,111 @@ from util.logging.logger import Logger
 from util.types import nullable
 
 
+@dataclasses.dataclass
+class AirportDiff:
+    """
+    How a dataset differs from the `airports` table, by fingerprint (uid + coordinates):
+        - added: airports which are not stored yet
+        - moved: airports stored under another uid or other coordinates (their outdated rows are in `removed`)
+        - removed: stored uids which are gone from the dataset, including the outdated rows of moved airports
+    """
+    stored: int
+    added: list[Airport] = dataclasses.field(default_factory=list)
+    moved: list[Airport] = dataclasses.field(default_factory=list)
+    removed: list[str] = dataclasses.field(default_factory=list)
+
+    @property
+    def changed(self) -> list[Airport]:
+        return self.added + self.moved
+
+    @property
+    def empty(self) -> bool:
+        return not (self.added or self.moved or self.removed)
+
+    def __str__(self) -> str:
+        return f"AirportDiff(stored={self.stored}, added={len(self.added)}, moved={len(self.moved)}, " \
+               f"removed={len(self.removed)})"
+
+
 class AirportGateway(BaseGateway):
 
+    columns: list[str] = ['uid', 'full_name', 'iso_country', 'iso_region', 'municipality',
+                          'latitude', 'longitude', 'size', 'iata_code', 'local_code']
+
     def __init__(self, pg: FlightSearchPostgresDB, init_script: Path = None,
                  debug_mode: bool = False, logger: Logger = None):
         BaseGateway.__init__(self, pg=pg, init_script=init_script, debug_mode=debug_mode, logger=logger)
 
-    def import_data(self, airports: list[Airport]) -> int:
-        added = 0
-        for airport in airports:
-            added += self.add_airport(airport)
-        return added
+    def import_data(self, airports: list[Airport], update: bool = False, **kwargs) -> int:
+        # One COPY round trip for the whole list. Stored airports are kept as they are, or with `update`, rewritten
+        # where any of their columns changed. Returns the number of airports added (or updated).
+        self.logger.info(f"Importing {len(airports)} airports")
+        resp = self.copy_upsert(
+            table=self.airports_table,
+            columns=self.columns,
+            rows=(tuple(airport.get_field_value_pairs(self.columns)[1]) for airport in airports),
+            conflict=['uid'],
+            on_conflict=self.ON_CONFLICT_UPDATE if update else self.ON_CONFLICT_NOTHING,
+            suppress_query_out=True,
+            **kwargs
+        )
+        if resp.failed:
+            err_msg = f"Failed to import {resp.rows_copied} airports into db. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return 0
+        self.logger.info(f"Streamed {resp.rows_copied} airports via COPY, merged {resp.row_count} rows")
+        return resp.row_count
+
+    def get_fingerprints(self, **kwargs) -> nullable(dict[str, tuple[str, float, float]]):
+        # uid -> (iata_code, latitude, longitude) of every stored airport
+        query = f"SELECT uid, iata_code, latitude, longitude FROM {self.airports_table}"
+        resp = self.execute(query, fetch=True, suppress_query_out=True, **kwargs)
+        if resp.failed:
+            err_msg = f"Failed to get airport fingerprints. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return
+        return {uid: (iata_code, latitude, longitude) for uid, iata_code, latitude, longitude in resp.pg_resp}
+
+    def diff(self, airports: list[Airport], **kwargs) -> nullable(AirportDiff):
+        if (stored := self.get_fingerprints(**kwargs)) is None:
+            return
+        dataset = {ap.uid: ap for ap in airports}
+        # A uid is derived from the coordinates, so this only catches rows written with other coordinates
+        stale = {uid for uid, (_, lat, lon) in stored.items()
+                 if uid in dataset and dataset[uid].coordinates != (lat, lon)}
+        removed = [uid for uid in stored if uid not in dataset or uid in stale]
+        removed_iata_codes = {stored[uid][0] for uid in removed}
+        rv = AirportDiff(stored=len(stored), removed=removed)
+        for uid, ap in dataset.items():
+            if uid in stale or (uid not in stored and ap.iata_code in removed_iata_codes):
+                rv.moved.append(ap)
+            elif uid not in stored:
+                rv.added.append(ap)
+        self.logger.info(f"Dataset diff against {self.airports_table}: {rv}")
+        return rv
+
+    def apply_diff(self, diff: AirportDiff, **kwargs) -> int:
+        # Removed (and outdated moved) rows go first, so that a moved airport's new row never conflicts with them
+        self.delete_airports(diff.removed, **kwargs)
+        return self.import_data(diff.changed)
+
+    def delete_airports(self, uids: list[str], **kwargs) -> int:
+        if not uids:
+            return 0
+        self.logger.info(f"Deleting {len(uids)} airports")
+        query = f"DELETE FROM {self.airports_table} WHERE uid IN ({', '.join(self.format_value(uid) for uid in uids)})"
+        resp = self.execute(query, suppress_query_out=True, **kwargs)
+        if resp.failed:
+            err_msg = f"Failed to delete {len(uids)} airports. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return 0
+        return resp.row_count
 
     def add_airport(self, airport: Airport, **kwargs) -> int:
         self.logger.info(f"Inserting airport {airport.uid} ({airport.full_name})")
@@ -42,7 +138,8 @@ class AirportGateway(BaseGateway):
 
     def get_airport(self, uid: str, fields: list[str] = None, **kwargs) -> nullable(Airport):
         self.logger.info(f"Trying to get airport by UID {uid}...")
-        selection = '*' if not fields else ', '.join(fields)
+        fields = fields or self.columns
+        selection = ', '.join(fields)
         query = f"SELECT {selection} FROM {self.airports_table} WHERE uid = {self.format_value(uid)}"
         resp = self.execute(query, fetch=True, **kwargs)
         if resp.failed:
@@ -57,3 +154,9 @@ class AirportGateway(BaseGateway):
             self.logger.warning(f"Found >1 row for UID {uid}! Returning first result")
 
         return Airport.from_db_row(resp.pg_resp[0], fields)
+
+    def iter_airports(self, fields: list[str] = None, itersize: int = None, **kwargs) -> Iterator[Airport]:
+        fields = fields or self.columns
+        query = f"SELECT {', '.join(fields)} FROM {self.airports_table}"
+        for row in self.iterate(query, itersize=itersize, **kwargs):
+            yield Airport.from_db_row(row, fields)
@@ -1,6 +1,7 @@
 import abc
 import time
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
 from src.db.mixins import FormattingMixin
 from src.db.pg_connect import FlightSearchPostgresDB, DBConnectConfig, PgResponse
@@ -14,6 +15,11 @@ class BaseGateway(abc.ABC, FormattingMixin):
 
     airports_table: const(str) = 'airports'
     distances_table: const(str) = 'airport_distance_mapping'
+    distances_by_id_table: const(str) = 'airport_distances'
+    neighbors_table: const(str) = 'airport_neighbors'
+
+    ON_CONFLICT_NOTHING: const(str) = 'nothing'
+    ON_CONFLICT_UPDATE: const(str) = 'update'
 
     def __init__(self, pg: FlightSearchPostgresDB, debug_mode: bool = False,
                  init_script: Path = None, logger: Logger = None):
@@ -71,3 +77,72 @@ class BaseGateway(abc.ABC, FormattingMixin):
                     continue
             self.logger.info(f"Total execution time for query: {resp.exec_time_ms:.1f}ms")
             return resp
+
+    def copy_rows(self, table: str, columns: list[str], rows: Iterable[tuple], before: str = None,
+                  after: str = None, fetch: bool = False, suppress_query_out: bool = False, **_) -> PgResponse:
+        qry_log = f' before:\n{before}\nafter:\n{after}' if self._debug_mode and not suppress_query_out else ''
+        self.logger.debug(f"Starting COPY into {table}{qry_log}")
+        resp = self.pg.copy_rows(table=table, columns=columns, rows=rows, before=before, after=after, fetch=fetch)
+        if resp.failed:
+            self.logger.error(f"COPY into {table} failed due to exception {resp.exc}!{qry_log}")
+        self.logger.info(f"Total execution time for COPY: {resp.exec_time_ms:.1f}ms")
+        return resp
+
+    @classmethod
+    def _merge_query(cls, table: str, staging_table: str, columns: list[str], conflict: list[str],
+                     on_conflict: str = ON_CONFLICT_NOTHING, update_columns: list[str] = None) -> str:
+        selection = ', '.join(columns)
+        if on_conflict == cls.ON_CONFLICT_NOTHING:
+            return f"INSERT INTO {table} ({selection}) SELECT {selection} FROM {staging_table} " \
+                   f"ON CONFLICT ({', '.join(conflict)}) DO NOTHING;"
+        if on_conflict != cls.ON_CONFLICT_UPDATE:
+            raise ValueError(f"Unknown ON CONFLICT action `{on_conflict}`")
+        update_columns = update_columns or [column for column in columns if column not in conflict]
+        current = ', '.join(f"{table}.{column}" for column in update_columns)
+        excluded = ', '.join(f"EXCLUDED.{column}" for column in update_columns)
+        # A row may only be updated once per statement, so only one staged row per key is merged. Rows whose
+        # values did not change are left alone, which keeps them (and their indexes) from being rewritten.
+        return f"INSERT INTO {table} ({selection}) " \
+               f"SELECT DISTINCT ON ({', '.join(conflict)}) {selection} FROM {staging_table} " \
+               f"ON CONFLICT ({', '.join(conflict)}) DO UPDATE SET " \
+               f"{', '.join(f'{column} = EXCLUDED.{column}' for column in update_columns)} " \
+               f"WHERE ({current}) IS DISTINCT FROM ({excluded});"
+
+    def copy_upsert(self, table: str, columns: list[str], rows: Iterable[tuple], conflict: list[str],
+                    on_conflict: str = ON_CONFLICT_NOTHING, update_columns: list[str] = None,
+                    wrap_merge: Callable[[str], str] = None, fetch: bool = False, **kwargs) -> PgResponse:
+        """
+        Bulk upsert in one round trip and one transaction: `rows` are streamed with COPY into a temporary staging
+        table shaped like `table`, then merged into it with INSERT ... SELECT ... ON CONFLICT (`conflict`):
+            - ON_CONFLICT_NOTHING keeps the stored rows
+            - ON_CONFLICT_UPDATE overwrites `update_columns` (default: all but the conflict columns) of the stored
+              rows, but only where a value actually changed (IS DISTINCT FROM)
+        `wrap_merge` may rewrite the merge statement, e.g. to count its RETURNING rows (with `fetch`).
+        The response's row_count is the number of rows the merge inserted or updated.
+        """
+        staging_table = f"{table}_staging"
+        merge = self._merge_query(table, staging_table, columns, conflict, on_conflict, update_columns)
+        return self.copy_rows(
+            table=staging_table,
+            columns=columns,
+            rows=rows,
+            # Only the staged columns, without constraints: generated columns (e.g. identities) are filled by the merge
+            before=f"CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS "
+                   f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA;",
+            after=wrap_merge(merge) if wrap_merge else merge,
+            fetch=fetch,
+            **kwargs
+        )
+
+    def iterate(self, query: str, itersize: int = None, suppress_query_out: bool = False, **_) -> Iterator[tuple]:
+        qry_log = f' query:\n{query}' if self._debug_mode and not suppress_query_out else ''
+        self.logger.debug(f"Streaming rows with a server-side cursor{qry_log}")
+        rows = 0
+        try:
+            for row in self.pg.iterate(q=query, itersize=itersize):
+                rows += 1
+                yield row
+        except Exception as e:
+            self.logger.error(f"Streaming query failed after {rows} rows due to exception {e}!{qry_log}")
+            raise
+        self.logger.debug(f"Streamed {rows} rows")
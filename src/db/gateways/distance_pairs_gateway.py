@@ -1,18 +1,138 @@
+import dataclasses
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
 from pathlib import Path
+from typing import Iterable, Iterator
 
+import numpy as np
+
+from src.db.gateways.airport_gateway import AirportDiff
 from src.db.gateways.base_gateway import BaseGateway
-from src.db.pg_connect import FlightSearchPostgresDB
+from src.db.pg_connect import FlightSearchPostgresDB, DBConnectConfig, PgResponse
 from src.flight_search.airport import Airport
+from src.geo.spatial_index import SphericalKDTree
 from util.logging.logger import Logger
-from util.math import calculate_distance_km
-from util.types import nullable
+from util.math import batch_distance_km, format_timedelta_string
+from util.types import const, nullable
+
+
+@dataclasses.dataclass
+class ShardImportResult:
+    shard: int
+    num_shards: int
+    rows_scheduled: int
+    rows_written: int
+    elapsed_s: float
+    error: str = None
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.rows_written / max(self.elapsed_s, 1e-9)
+
+
+@dataclasses.dataclass
+class SparsePairs:
+    """
+    The pairs a sparse import materializes, as parallel arrays of airport indexes (left <= right) and distances.
+    Like a full import, every airport is also paired with itself.
+    """
+    left: np.ndarray
+    right: np.ndarray
+    distances: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.left)
+
+    def expected_counts(self, n: int) -> np.ndarray:
+        # Pairs per airport, counted the way `get_pair_counts` counts them
+        return np.bincount(self.left, minlength=n) + np.bincount(self.right[self.left != self.right], minlength=n)
+
+    def select(self, rows: np.ndarray, pending: np.ndarray) -> np.ndarray:
+        # Airports left with extra pairs by an earlier, wider import count as complete even when some of their sparse
+        # pairs are missing, so every pair touching a `pending` airport is a candidate. Each pair belongs to its
+        # lower pending airport; returns the positions of the pairs belonging to `rows` (a subset of `pending`).
+        left_pending = np.isin(self.left, pending)
+        return np.flatnonzero(np.isin(np.where(left_pending, self.left, self.right), rows))
 
 
 class AirportDistancePairsGateway(BaseGateway):
+    """
+    Stores airport distances in one of two layouts:
+        - LAYOUT_PAIR_ID: `airport_distance_mapping`, one row per unordered pair keyed by the `<uid>_<uid>` pair_id
+        - LAYOUT_AIRPORT_ID: `airport_distances`, keyed by the integer ids of the `airports` table. Every pair is
+          stored in both directions under a (ap1_id, ap2_id) primary key covering distance_km, so all partners of an
+          airport are a single index range scan (optionally hash-partitioned by ap1_id)
+    Rows are generated in the pair_id shape either way and converted on their way into the id layout.
+    Counts (pairs imported, pairs per airport) mean the same in both layouts.
+    """
 
-    def __init__(self, pg: FlightSearchPostgresDB, init_script: Path = None,
+    LAYOUT_PAIR_ID: const(str) = 'pair_id'
+    LAYOUT_AIRPORT_ID: const(str) = 'airport_id'
+
+    def __init__(self, pg: FlightSearchPostgresDB, init_script: Path = None, layout: str = LAYOUT_PAIR_ID,
                  debug_mode: bool = False, logger: Logger = None):
+        if layout not in (self.LAYOUT_PAIR_ID, self.LAYOUT_AIRPORT_ID):
+            raise ValueError(f"Unknown distance table layout `{layout}`")
         BaseGateway.__init__(self, pg=pg, init_script=init_script, debug_mode=debug_mode, logger=logger)
+        self.layout: str = layout
+        self._airport_ids: dict[str, int] = {}
+
+    @property
+    def by_id(self) -> bool:
+        return self.layout == self.LAYOUT_AIRPORT_ID
+
+    def airport_ids(self, refresh: bool = False, **kwargs) -> dict[str, int]:
+        # uid -> id of the airports table, which the id layout keys distances by
+        if self._airport_ids and not refresh:
+            return self._airport_ids
+        resp = self.execute(f"SELECT uid, id FROM {self.airports_table};", fetch=True, suppress_query_out=True,
+                            **kwargs)
+        if resp.failed:
+            err_msg = f"Failed to load airport ids. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return self._airport_ids
+        self._airport_ids = {uid: ap_id for uid, ap_id in resp.pg_resp}
+        return self._airport_ids
+
+    def _airport_id(self, uid: str) -> nullable(int):
+        if (ap_id := self.airport_ids().get(uid)) is None:
+            ap_id = self.airport_ids(refresh=True).get(uid)
+        return ap_id
+
+    def _id_rows(self, rows: Iterable[tuple], ids: dict[str, int]) -> Iterator[tuple[int, int, float]]:
+        # pair_id rows -> both directions of the pair in the id layout. `ids` is resolved before any COPY starts:
+        # the rows are consumed while the COPY holds its connection, so they must not query the DB themselves.
+        for _, ap1, ap2, distance in rows:
+            if (id1 := ids.get(ap1)) is None or (id2 := ids.get(ap2)) is None:
+                self.logger.error(f"Skipping distance {ap1} -> {ap2}: airport missing from {self.airports_table}")
+                continue
+            yield id1, id2, distance
+            if id1 != id2:
+                yield id2, id1, distance
+
+    @property
+    def _table(self) -> str:
+        return self.distances_by_id_table if self.by_id else self.distances_table
+
+    @property
+    def _columns(self) -> list[str]:
+        return ['ap1_id', 'ap2_id', 'distance_km'] if self.by_id else ['pair_id', 'ap1', 'ap2', 'distance_km']
+
+    @property
+    def _conflict(self) -> list[str]:
+        return ['ap1_id', 'ap2_id'] if self.by_id else ['pair_id']
+
+    def _count_pairs(self, insert_query: str) -> str:
+        # Wraps an INSERT so that it reports merged pairs rather than rows, which the id layout stores twice
+        insert_query = insert_query.rstrip().rstrip(';')
+        return f"WITH merged AS ({insert_query} RETURNING ap1_id, ap2_id) " \
+               f"SELECT COUNT(*) FROM merged WHERE ap1_id <= ap2_id;"
 
     @staticmethod
     def order_iata_key_pairs(ap1_iata: str, ap2_iata: str) -> tuple[str, str]:
@@ -20,94 +140,392 @@ class AirportDistancePairsGateway(BaseGateway):
             return ap1_iata, ap2_iata
         return ap2_iata, ap1_iata
 
-    def import_data(self, airports: list[Airport], batch_size: int = 1000, validate: bool = True, **kwargs) -> int:
+    @staticmethod
+    def coordinate_arrays(airports: list[Airport]) -> tuple[np.ndarray, np.ndarray]:
+        lats = np.fromiter((ap.latitude for ap in airports), dtype=np.float64, count=len(airports))
+        lons = np.fromiter((ap.longitude for ap in airports), dtype=np.float64, count=len(airports))
+        return lats, lons
+
+    @classmethod
+    def sparse_pairs(cls, airports: list[Airport], max_distance_km: float = None,
+                     max_neighbors: int = None) -> SparsePairs:
+        """
+        The pairs within `max_distance_km` of each other, or, with `max_neighbors`, each airport's `max_neighbors`
+        nearest airports (optionally also limited to `max_distance_km`). Neighbourhoods are not symmetric, so a
+        top-K pair is kept when either of its airports picks the other.
+        Candidates come from a spatial index, so the distance of a skipped pair is never computed.
+        """
+        if max_distance_km is None and max_neighbors is None:
+            raise ValueError("A sparse import needs `max_distance_km`, `max_neighbors` or both")
+        n = len(airports)
+        lats, lons = cls.coordinate_arrays(airports)
+        index = SphericalKDTree(lats, lons)
+        if max_neighbors is not None:
+            # One extra neighbour, since every airport finds itself
+            ids, dists = index.query_knn_batch(lats, lons, max_neighbors + 1, max_km=max_distance_km)
+            own = np.arange(n)[:, None]
+            valid = (ids >= 0) & (ids != own)
+            keep = valid & (np.cumsum(valid, axis=1) <= max_neighbors)
+            left, right, distances = np.broadcast_to(own, ids.shape)[keep], ids[keep], dists[keep]
+        else:
+            left, right, distances = [], [], []
+            for i in range(n):
+                # The haversine pass settles the candidates; only the pairs this airport owns get an exact distance
+                found, _ = index.query_radius(lats[i], lons[i], max_distance_km, exact=False)
+                found = found[found > i]
+                left.append(np.full(len(found), i))
+                right.append(found)
+                distances.append(batch_distance_km((lats[i], lons[i]), lats[found], lons[found]))
+            left, right, distances = (np.concatenate(x) if n else np.empty(0) for x in (left, right, distances))
+
+        left = np.concatenate((np.arange(n), left)).astype(np.int64)
+        right = np.concatenate((np.arange(n), right)).astype(np.int64)
+        distances = np.concatenate((np.zeros(n), distances))
+        lo, hi = np.minimum(left, right), np.maximum(left, right)
+        _, first = np.unique(lo * max(n, 1) + hi, return_index=True)
+        return SparsePairs(left=lo[first], right=hi[first], distances=distances[first])
+
+    def generate_pair_rows(self, airports: list[Airport], rows: Iterable[int] = None, partners: Iterable[int] = None,
+                           pairs: SparsePairs = None) -> Iterator[tuple[str, str, str, float]]:
+        # A pair can only be missing if both of its airports are incomplete, so partners default to `rows` too
+        rows = np.arange(len(airports)) if rows is None else np.unique(np.fromiter(rows, dtype=np.int64))
+        partners = rows if partners is None else np.unique(np.fromiter(partners, dtype=np.int64))
+        uids = [ap.uid for ap in airports]
+        if pairs is not None:
+            selected = pairs.select(rows, partners)
+            for i, j, distance in zip(pairs.left[selected].tolist(), pairs.right[selected].tolist(),
+                                      pairs.distances[selected].tolist()):
+                left_key, right_key = self.order_iata_key_pairs(uids[i], uids[j])
+                yield f"{left_key}_{right_key}", left_key, right_key, distance
+            return
+        lats, lons = self.coordinate_arrays(airports)
+        for i in rows:
+            ap1_uid = uids[i]
+            # Upper-triangular row: pairs (ap1, ap2) with ap2 before ap1 belong to ap2's row
+            row_partners = partners[np.searchsorted(partners, i):]
+            distances = batch_distance_km((lats[i], lons[i]), lats[row_partners], lons[row_partners])
+            for j, distance in zip(row_partners, distances):
+                left_key, right_key = self.order_iata_key_pairs(ap1_uid, uids[j])
+                yield f"{left_key}_{right_key}", left_key, right_key, float(distance)
+
+    def plan_import(self, airports: list[Airport], pairs: SparsePairs = None, **kwargs) -> list[int]:
+        pair_counts = self.get_pair_counts(**kwargs)
+        if pairs is None:
+            num_expected_pairs = len(airports)
+            pending = [i for i, ap in enumerate(airports) if pair_counts.get(ap.uid, 0) != num_expected_pairs]
+        else:
+            # An earlier, wider import may have left more pairs behind than a sparse import expects
+            expected = pairs.expected_counts(len(airports)).tolist()
+            pending = [i for i, ap in enumerate(airports) if pair_counts.get(ap.uid, 0) < expected[i]]
+            self.logger.info(f"Sparse import expects {len(pairs)} pairs, "
+                             f"{len(pairs) / max(len(airports) * (len(airports) + 1) // 2, 1):.2%} of a full import")
+        self.logger.info(f"Import plan: {len(pending)}/{len(airports)} airports have missing pairs, "
+                         f"{len(airports) - len(pending)} are complete and will be skipped")
+        return pending
+
+    @staticmethod
+    def shard_rows(pending: list[int], shard: int, num_shards: int) -> list[int]:
+        # Sharding is by airport index, so a shard covers the same rows regardless of what is already imported
+        return [i for i in pending if i % num_shards == shard]
+
+    def import_data(self, airports: list[Airport], batch_size: int = 1000, validate: bool = True,
+                    use_copy: bool = True, workers: int = 1, shards: list[int] = None,
+                    shard_retries: int = 1, max_distance_km: float = None, max_neighbors: int = None,
+                    **kwargs) -> int:
+        """
+        Imports the distances between `airports`, skipping the airports whose pairs are all stored already.
+        By default every pair is imported. With `max_distance_km` and/or `max_neighbors` the import is sparse: only
+        the pairs `sparse_pairs` selects are computed and stored, so the table grows roughly linearly with the
+        number of airports.
+        """
         self.logger.info(f"Starting data import for {len(airports)} airports...")
+        start_ = datetime.now()
+        if self.by_id:
+            # Airports added since the ids were last loaded must be resolvable by the import
+            self.airport_ids(refresh=True, **kwargs)
+        pairs = None
+        if max_distance_km is not None or max_neighbors is not None:
+            pairs = self.sparse_pairs(airports, max_distance_km=max_distance_km, max_neighbors=max_neighbors)
+        pending = self.plan_import(airports, pairs=pairs, **kwargs)
+
+        if workers > 1 and pending:
+            insertions = self._import_parallel(airports, pending, workers=workers, shards=shards,
+                                               shard_retries=shard_retries, pairs=pairs)
+        else:
+            insertions = self._import_rows(airports, pending, pending, batch_size=batch_size, use_copy=use_copy,
+                                           pairs=pairs, **kwargs)
+        elapsed_s = (datetime.now() - start_).total_seconds()
+        self.logger.info(f"Initial import finished. Made {insertions} insertions in "
+                         f"{format_timedelta_string(datetime.now() - start_)} ({insertions / max(elapsed_s, 1e-9):.0f} rows/s).")
+        if validate:
+            insertions += self._validate_import(airports, pairs=pairs, **kwargs)
+        return insertions
+
+    def import_diff(self, airports: list[Airport], diff: AirportDiff, batch_size: int = 1000, validate: bool = True,
+                    use_copy: bool = True, workers: int = 1, shard_retries: int = 1, max_distance_km: float = None,
+                    max_neighbors: int = None, **kwargs) -> int:
+        """
+        Brings the distances of an already imported dataset up to date with `diff`, computing only the pairs of the
+        new and moved airports. `airports` is the whole, current dataset. The distances of `diff.removed` are
+        expected to be gone already (see `delete_distances`), and the `airports` table to be updated.
+        Sparse and parallel options are the same as for `import_data`.
+        """
+        changed = {ap.uid for ap in diff.changed}
+        self.logger.info(f"Starting incremental import for {len(changed)} of {len(airports)} airports...")
+        start_ = datetime.now()
+        if self.by_id:
+            self.airport_ids(refresh=True, **kwargs)
+        # Changed airports go first, so that every pair touching one of them belongs to a changed airport's row
+        ordered = [ap for ap in airports if ap.uid in changed]
+        num_changed = len(ordered)
+        ordered += [ap for ap in airports if ap.uid not in changed]
+        pairs = None
+        if max_distance_km is not None or max_neighbors is not None:
+            pairs = self.sparse_pairs(ordered, max_distance_km=max_distance_km, max_neighbors=max_neighbors)
+
+        insertions = 0
+        rows, partners = list(range(num_changed)), list(range(len(ordered)))
+        if workers > 1 and num_changed:
+            insertions = self._import_parallel(ordered, rows, workers=workers, shard_retries=shard_retries,
+                                               pairs=pairs, partners=partners)
+        elif num_changed:
+            insertions = self._import_rows(ordered, rows, partners, batch_size=batch_size, use_copy=use_copy,
+                                           pairs=pairs, **kwargs)
+        self.logger.info(f"Incremental import finished. Made {insertions} insertions in "
+                         f"{format_timedelta_string(datetime.now() - start_)}.")
+        if validate:
+            insertions += self._validate_import(ordered, pairs=pairs, **kwargs)
+        return insertions
+
+    def delete_distances(self, uids: list[str], **kwargs) -> int:
+        # Every pair of the given airports, e.g. before the airports themselves are removed
+        if not uids:
+            return 0
+        values = ', '.join(self.format_value(uid) for uid in uids)
+        if self.by_id:
+            # Both directions are found through the primary key, starting from the deleted airports' own rows
+            own = f"SELECT d.ap1_id, d.ap2_id FROM {self.distances_by_id_table} d " \
+                  f"JOIN {self.airports_table} a ON a.id = d.ap1_id WHERE a.uid IN ({values})"
+            query = f"WITH deleted AS (" \
+                    f"DELETE FROM {self.distances_by_id_table} d USING (" \
+                    f"SELECT ap1_id, ap2_id FROM ({own}) o UNION SELECT ap2_id, ap1_id FROM ({own}) o" \
+                    f") gone WHERE d.ap1_id = gone.ap1_id AND d.ap2_id = gone.ap2_id RETURNING d.ap1_id, d.ap2_id" \
+                    f") SELECT COUNT(*) FROM deleted WHERE ap1_id <= ap2_id;"
+        else:
+            query = f"DELETE FROM {self.distances_table} WHERE ap1 IN ({values}) OR ap2 IN ({values});"
+        resp = self.execute(query, fetch=self.by_id, suppress_query_out=True, **kwargs)
+        if resp.failed:
+            err_msg = f"Failed to delete the distances of {len(uids)} airports. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return 0
+        deleted = resp.pg_resp[0][0] if self.by_id else resp.row_count
+        self.logger.info(f"Deleted {deleted} distance pairs of {len(uids)} airports")
+        return deleted
+
+    def _import_rows(self, airports: list[Airport], rows: list[int], partners: list[int],
+                     batch_size: int = 1000, use_copy: bool = True, pairs: SparsePairs = None, **kwargs) -> int:
+        pair_rows = self.generate_pair_rows(airports, rows, partners, pairs=pairs)
+        if use_copy:
+            return self.copy_distances(pair_rows, **kwargs)
+        return self._insert_batched(pair_rows, batch_size=batch_size, **kwargs)
+
+    def import_shard(self, airports: list[Airport], pending: list[int], shard: int, num_shards: int,
+                     pairs: SparsePairs = None, partners: list[int] = None, **kwargs) -> 'ShardImportResult':
+        # Each shard is loaded in a single COPY transaction, so a failed shard leaves nothing behind to clean up.
+        # Partners default to `pending`, as in an initial import.
+        start_ = datetime.now()
+        rows = self.shard_rows(pending, shard, num_shards)
+        partners = pending if partners is None else partners
+        resp = self._copy_distances(self.generate_pair_rows(airports, rows, partners, pairs=pairs), **kwargs)
+        error = None
+        if resp.failed:
+            error = f"{resp.exc}" + (f", rollback exception: {resp.rollback_exc}" if resp.rollback_exc else "")
+        return ShardImportResult(
+            shard=shard,
+            num_shards=num_shards,
+            rows_scheduled=len(rows),
+            rows_written=0 if resp.failed else resp.row_count,
+            elapsed_s=(datetime.now() - start_).total_seconds(),
+            error=error
+        )
+
+    def _import_parallel(self, airports: list[Airport], pending: list[int], workers: int, shards: list[int] = None,
+                         shard_retries: int = 1, pairs: SparsePairs = None, partners: list[int] = None) -> int:
+        num_shards = workers
+        shards = sorted(set(shards)) if shards is not None else list(range(num_shards))
+        self.logger.info(f"Importing shards {shards} of {num_shards} with {workers} worker processes...")
+        results: dict[int, ShardImportResult] = {}
+        start_ = datetime.now()
+
+        for attempt in range(shard_retries + 1):
+            todo = [shard for shard in shards if shard not in results or results[shard].failed]
+            if not todo:
+                break
+            if attempt > 0:
+                self.logger.warning(f"Retrying failed shards {todo} (retry {attempt}/{shard_retries})")
+            with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+                futures = {
+                    pool.submit(
+                        _import_shard_worker, self.pg.config, airports, pending, shard, num_shards, self.layout,
+                        pairs, self.logger, partners
+                    ): shard
+                    for shard in todo
+                }
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = ShardImportResult(shard=futures[future], num_shards=num_shards, rows_scheduled=0,
+                                                   rows_written=0, elapsed_s=0., error=f"{type(e).__name__}: {e}")
+                    results[result.shard] = result
+                    done = sum(not r.failed for r in results.values())
+                    written = sum(r.rows_written for r in results.values())
+                    elapsed_s = (datetime.now() - start_).total_seconds()
+                    if result.failed:
+                        self.logger.error(f"Shard {result.shard}/{num_shards} failed after {result.elapsed_s:.1f}s: "
+                                          f"{result.error}")
+                    else:
+                        self.logger.info(f"Shard {result.shard}/{num_shards} wrote {result.rows_written} pairs for "
+                                         f"{result.rows_scheduled} airports in {result.elapsed_s:.1f}s "
+                                         f"({result.rows_per_s:.0f} rows/s)")
+                    self.logger.info(f"Progress: {done}/{len(shards)} shards done, {written} pairs written, "
+                                     f"{written / max(elapsed_s, 1e-9):.0f} rows/s overall")
+
+        if failed := [shard for shard in shards if results[shard].failed]:
+            self.logger.error(f"Shards {failed} of {num_shards} failed. Retry them alone with "
+                              f"`workers={num_shards}, shards={failed}`")
+        return sum(r.rows_written for r in results.values())
+
+    def _insert_batched(self, rows: Iterable[tuple], batch_size: int, **kwargs) -> int:
         insertions = 0
-        seen: set[str] = set()
         batch: list[tuple[str, str, str, float]] = []
 
         def flush(insertions_: int) -> int:
             ins = self.bulk_insert_distances(data=batch[:], **kwargs)
             insertions_ += ins
-            self.logger.debug(f"Successfully imported {ins} pairs (total: {insertions})")
+            self.logger.debug(f"Successfully imported {ins} pairs (total: {insertions_})")
             return insertions_
 
-        num_expected_pairs = len(airports)
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                insertions = flush(insertions)
+                batch = []
+        return flush(insertions)
 
-        for ap1 in airports:
-            existing_pairs = self.get_pairs_by_ap(ap1.uid, **kwargs)
-            if (num_existing_pairs := len(existing_pairs)) == num_expected_pairs:
-                self.logger.info(f"Skipping import for {ap1.uid}, all mappings exist")
-                continue
-            self.logger.debug(f"Found {num_existing_pairs}/{num_expected_pairs} existing pairs for airport {ap1.uid}")
-
-            for ap2 in airports:
-                left_key, right_key = self.order_iata_key_pairs(ap1.uid, ap2.uid)
-                if (pair_id := f"{left_key}_{right_key}") not in seen:
-                    batch.append((pair_id, left_key, right_key, ap1.distance_to(ap2)))
-                    seen.add(pair_id)
-
-                    if len(batch) >= batch_size:
-                        insertions = flush(insertions)
-                        batch = []
-        insertions = flush(insertions)
-        self.logger.info(f"Initial import finished. Made {insertions} insertions.")
-        if validate:
-            insertions += self._validate_import(airports, **kwargs)
-        return insertions
-
-    def _validate_import(self, airports: list[Airport], **kwargs) -> int:
+    def _validate_import(self, airports: list[Airport], pairs: SparsePairs = None, **kwargs) -> int:
         self.logger.info("Performing import validation...")
-        num_expected_pairs = len(airports)
-        new_insertions = 0
-        for ap1 in airports:
-            self.logger.debug(f"Validating pairs for airport {ap1.uid}")
-            pairs = self.get_pairs_by_ap(ap1.uid, **kwargs)
-            if (pair_count := len(pairs)) != num_expected_pairs:
-                self.logger.warning(f"Found {pair_count} pairs for airport {ap1.uid} (expected {num_expected_pairs})")
-                for ap2 in airports:
-                    key_l, key_r = self.order_iata_key_pairs(ap1.uid, ap2.uid)
-                    if self.get_distance(key_l, key_r, **kwargs) is None:
-                        self.logger.warning(f"Found missing pair {ap1.uid} -> {ap2.uid}! Inserting...")
-                        rc = self.insert_distance(key_l, key_r, ap1.distance_to(ap2), **kwargs)
-                        if rc != 1:
-                            self.logger.error(f"Expected rowcount 1 for single insert, got {rc}")
-                        new_insertions += rc
-                        pair_count += rc
-                        if pair_count == num_expected_pairs:
-                            break
+        incomplete_idx = self.plan_import(airports, pairs=pairs, **kwargs)
+        if not incomplete_idx:
+            self.logger.info("Validation run found no incomplete airports")
+            return 0
+        if pairs is not None:
+            # The expected pairs are known up front, so the incomplete airports' pairs are simply merged again
+            self.logger.warning(f"Found {len(incomplete_idx)} airports with missing pairs! Re-importing them...")
+            new_insertions = self.copy_distances(
+                self.generate_pair_rows(airports, incomplete_idx, incomplete_idx, pairs=pairs), **kwargs
+            )
+            self.logger.info(f"Validation run inserted {new_insertions} new rows")
+            return new_insertions
+        incomplete = [airports[i].uid for i in incomplete_idx]
+        self.logger.warning(f"Found {len(incomplete)} airports with missing pairs (expected {len(airports)} each)")
+
+        missing = self.find_missing_pairs(incomplete, **kwargs)
+        self.logger.warning(f"Found {len(missing)} missing pairs! Inserting...")
+        new_insertions = self.copy_distances(self.generate_missing_pair_rows(airports, missing), **kwargs)
+        if new_insertions != len(missing):
+            self.logger.error(f"Expected to insert {len(missing)} missing pairs, inserted {new_insertions}")
         self.logger.info(f"Validation run inserted {new_insertions} new rows")
         return new_insertions
 
-    def insert_distance(self, ap1_iata: str, ap2_iata: str, distance: float, **kwargs) -> int:
-        self.logger.debug(f"Inserting distance {ap1_iata} -> {ap2_iata} (~{distance:.2f}km)")
-        query = self._build_insert_query(
-            table=self.distances_table,
-            columns=['pair_id', 'ap1', 'ap2', 'distance_km'],
-            values=[(f"{ap1_iata}_{ap2_iata}", ap1_iata, ap2_iata, distance)],
-            avoid_conflict=True,
-            conflict='pair_id'
+    def generate_missing_pair_rows(self, airports: list[Airport],
+                                   missing: list[tuple[str, str]]) -> Iterator[tuple[str, str, str, float]]:
+        index_by_uid = {ap.uid: i for i, ap in enumerate(airports)}
+        partners_by_uid: dict[str, list[str]] = {}
+        for key_l, key_r in missing:
+            partners_by_uid.setdefault(key_l, []).append(key_r)
+
+        lats, lons = self.coordinate_arrays(airports)
+        for key_l, partners in partners_by_uid.items():
+            partner_idx = [index_by_uid[key_r] for key_r in partners]
+            i = index_by_uid[key_l]
+            distances = batch_distance_km((lats[i], lons[i]), lats[partner_idx], lons[partner_idx])
+            for key_r, distance in zip(partners, distances):
+                yield f"{key_l}_{key_r}", key_l, key_r, float(distance)
+
+    def get_pair_counts(self, **kwargs) -> dict[str, int]:
+        if self.by_id:
+            query = f"SELECT a.uid, pairs.count FROM (" \
+                    f"SELECT ap1_id, COUNT(*) count FROM {self.distances_by_id_table} GROUP BY ap1_id" \
+                    f") pairs JOIN {self.airports_table} a ON a.id = pairs.ap1_id;"
+        else:
+            query = f"SELECT ap, COUNT(*) FROM (" \
+                    f"SELECT ap1 ap FROM {self.distances_table} " \
+                    f"UNION ALL " \
+                    f"SELECT ap2 ap FROM {self.distances_table} WHERE ap1 <> ap2" \
+                    f") pairs GROUP BY ap;"
+        resp = self.execute(query, fetch=True, **kwargs)
+        if resp.failed:
+            err_msg = f"Failed to get pair counts. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return {}
+        return {uid: count for uid, count in resp.pg_resp}
+
+    def find_missing_pairs(self, uids: list[str], **kwargs) -> list[tuple[str, str]]:
+        # A pair can only be missing if both of its airports are incomplete, so `uids` should be just those.
+        # Keys are ordered with COLLATE "C" to match the codepoint ordering of `order_iata_key_pairs`.
+        expected_table = "expected_airport_uids"
+        resp = self.copy_rows(
+            table=expected_table,
+            columns=['uid'],
+            rows=((uid,) for uid in uids),
+            before=f"CREATE TEMP TABLE {expected_table} (uid varchar(30) PRIMARY KEY) ON COMMIT DROP;",
+            after=f"SELECT e1.uid, e2.uid FROM {expected_table} e1 "
+                  f"JOIN {expected_table} e2 ON e1.uid COLLATE \"C\" <= e2.uid COLLATE \"C\" "
+                  f"WHERE NOT EXISTS ({self._pair_exists_subquery('e1.uid', 'e2.uid')});",
+            fetch=True,
+            **kwargs
         )
-        resp = self.execute(query, **kwargs)
         if resp.failed:
-            err_msg = f"Failed to insert distance pair into db. Most recent exception: {resp.exc}"
+            err_msg = f"Failed to find missing pairs for {len(uids)} airports. Most recent exception: {resp.exc}"
             if resp.rollback_exc:
                 err_msg += f", rollback exception: {resp.rollback_exc}"
             self.logger.error(err_msg)
-            return 0
-        return resp.row_count
+            return []
+        return [(key_l, key_r) for key_l, key_r in resp.pg_resp]
+
+    def _pair_exists_subquery(self, uid1: str, uid2: str) -> str:
+        if self.by_id:
+            return f"SELECT 1 FROM {self.distances_by_id_table} d " \
+                   f"JOIN {self.airports_table} a1 ON a1.id = d.ap1_id " \
+                   f"JOIN {self.airports_table} a2 ON a2.id = d.ap2_id " \
+                   f"WHERE a1.uid = {uid1} AND a2.uid = {uid2}"
+        return f"SELECT 1 FROM {self.distances_table} d WHERE d.ap1 = {uid1} AND d.ap2 = {uid2}"
+
+    def insert_distance(self, ap1_iata: str, ap2_iata: str, distance: float, **kwargs) -> int:
+        self.logger.debug(f"Inserting distance {ap1_iata} -> {ap2_iata} (~{distance:.2f}km)")
+        return self.bulk_insert_distances([(f"{ap1_iata}_{ap2_iata}", ap1_iata, ap2_iata, distance)], **kwargs)
 
     def bulk_insert_distances(self, data: list[tuple], **kwargs) -> int:
         self.logger.debug(f"Starting distance bulk insert: {len(data)} values")
         data_len = len(data)
+        values = list(self._id_rows(data, self.airport_ids(**kwargs))) if self.by_id else data
+        if not values:
+            return 0
         query = self._build_insert_query(
-            table=self.distances_table,
-            columns=['pair_id', 'ap1', 'ap2', 'distance_km'],
-            values=data,
+            table=self._table,
+            columns=self._columns,
+            values=values,
             avoid_conflict=True,
-            conflict='pair_id'
+            conflict=', '.join(self._conflict)
         )
-        resp = self.execute(query, max_attempts=3, suppress_query_out=True, **kwargs)
+        if self.by_id:
+            query = self._count_pairs(query)
+        resp = self.execute(query, fetch=self.by_id, max_attempts=3, suppress_query_out=True, **kwargs)
         if resp.failed:
             err_msg = f"Failed to bulk insert {data_len} distance pairs into db. Most recent exception: {resp.exc}"
             if resp.rollback_exc:
@@ -115,14 +533,76 @@ class AirportDistancePairsGateway(BaseGateway):
             self.logger.error(err_msg)
             return 0
 
-        if resp.row_count != data_len:
-            self.logger.warning(f"Inserted {resp.row_count} distance pairs when passed data had length {data_len}")
+        inserted = resp.pg_resp[0][0] if self.by_id else resp.row_count
+        if inserted != data_len:
+            self.logger.warning(f"Inserted {inserted} distance pairs when passed data had length {data_len}")
+
+        return inserted
+
+    def _copy_distances(self, rows: Iterable[tuple], **kwargs) -> PgResponse:
+        resp = self.copy_upsert(
+            table=self._table,
+            columns=self._columns,
+            rows=self._id_rows(rows, self.airport_ids()) if self.by_id else rows,
+            conflict=self._conflict,
+            wrap_merge=self._count_pairs if self.by_id else None,
+            fetch=self.by_id,
+            **kwargs
+        )
+        if self.by_id and not resp.failed:
+            resp = dataclasses.replace(resp, row_count=resp.pg_resp[0][0], pg_resp=[])
+        return resp
 
+    def copy_distances(self, rows: Iterable[tuple], **kwargs) -> int:
+        resp = self._copy_distances(rows, **kwargs)
+        if resp.failed:
+            err_msg = f"Failed to COPY {resp.rows_copied} distance pairs into db. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return 0
+        rate = resp.rows_copied / max(resp.exec_time_ms / 1000, 1e-9)
+        self.logger.info(f"Streamed {resp.rows_copied} distance pairs via COPY ({rate:.0f} rows/s), "
+                         f"merged {resp.row_count} new rows")
         return resp.row_count
 
+    def migrate_from_pair_layout(self, **kwargs) -> int:
+        # Copies `airport_distance_mapping` into the id layout; the old table is left in place
+        if not self.by_id:
+            self.logger.error(f"Migrating distances needs the `{self.LAYOUT_AIRPORT_ID}` layout, not `{self.layout}`")
+            return 0
+        self.logger.info(f"Migrating distances from {self.distances_table} to {self.distances_by_id_table}...")
+        start_ = datetime.now()
+        joined = f"FROM {self.distances_table} d " \
+                 f"JOIN {self.airports_table} a1 ON a1.uid = d.ap1 " \
+                 f"JOIN {self.airports_table} a2 ON a2.uid = d.ap2"
+        query = self._count_pairs(
+            f"INSERT INTO {self.distances_by_id_table} (ap1_id, ap2_id, distance_km) "
+            f"SELECT a1.id, a2.id, d.distance_km {joined} "
+            f"UNION ALL "
+            f"SELECT a2.id, a1.id, d.distance_km {joined} WHERE d.ap1 <> d.ap2 "
+            f"ON CONFLICT (ap1_id, ap2_id) DO NOTHING"
+        )
+        resp = self.execute(query, fetch=True, **kwargs)
+        if resp.failed:
+            err_msg = f"Failed to migrate distance pairs. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return 0
+        migrated = resp.pg_resp[0][0]
+        self.logger.info(f"Migrated {migrated} distance pairs in {format_timedelta_string(datetime.now() - start_)}")
+        return migrated
+
     def get_distance(self, ap1_iata: str, ap2_iata: str, **kwargs) -> nullable(float):
         ap1_, ap2_ = self.order_iata_key_pairs(ap1_iata, ap2_iata)
-        query = f"SELECT distance_km FROM {self.distances_table}  WHERE ap1 = '{ap1_}' AND ap2 = '{ap2_}'"
+        if self.by_id:
+            if (id1 := self._airport_id(ap1_)) is None or (id2 := self._airport_id(ap2_)) is None:
+                self.logger.error(f"Could not find distance pair {ap1_iata} -> {ap2_iata}: unknown airport")
+                return
+            query = f"SELECT distance_km FROM {self.distances_by_id_table} WHERE ap1_id = {id1} AND ap2_id = {id2}"
+        else:
+            query = f"SELECT distance_km FROM {self.distances_table}  WHERE ap1 = '{ap1_}' AND ap2 = '{ap2_}'"
         resp = self.execute(query, fetch=True, **kwargs)
         if resp.failed:
             err_msg = f"Failed to get distance pair ({ap1_iata} -> {ap2_iata}) Most recent exception: {resp.exc}"
@@ -142,7 +622,8 @@ class AirportDistancePairsGateway(BaseGateway):
 
     def pair_exists(self, ap1_iata: str, ap2_iata: str, **kwargs) -> bool:
         ap1_, ap2_ = self.order_iata_key_pairs(ap1_iata, ap2_iata)
-        query = f"SELECT COUNT(*) FROM {self.distances_table} WHERE ap1 = '{ap1_}' AND ap2 = '{ap2_}' "
+        pair_query = self._pair_exists_subquery(self.format_value(ap1_), self.format_value(ap2_))
+        query = f"SELECT COUNT(*) FROM ({pair_query}) pair"
         resp = self.execute(query, fetch=True, **kwargs)
         if resp.failed:
             err_msg = f"Failed to get distance pair ({ap1_iata} -> {ap2_iata}) Most recent exception: {resp.exc}"
@@ -154,11 +635,18 @@ class AirportDistancePairsGateway(BaseGateway):
             self.logger.warning(f"Received more than 1 result for pair search ({resp_len})")
         return resp.pg_resp[0][0] > 0
 
-    def get_pairs_by_ap(self, ap_iata: str, **kwargs) -> dict[str, float]:
-        query = f"SELECT ap1 pair, distance_km from {self.distances_table} where ap2 = '{ap_iata}' " \
-                f"union " \
-                f"select ap2 pair, distance_km from {self.distances_table} where ap1 = '{ap_iata}';"
+    def _pairs_by_ap_query(self, ap_iata: str) -> str:
+        if self.by_id:
+            # One range scan of the primary key, then the partners' uids by id
+            return f"SELECT a.uid pair, d.distance_km FROM {self.distances_by_id_table} d " \
+                   f"JOIN {self.airports_table} a ON a.id = d.ap2_id " \
+                   f"WHERE d.ap1_id = {self._airport_id(ap_iata) or 'NULL'};"
+        return f"SELECT ap1 pair, distance_km from {self.distances_table} where ap2 = '{ap_iata}' " \
+               f"union " \
+               f"select ap2 pair, distance_km from {self.distances_table} where ap1 = '{ap_iata}';"
 
+    def get_pairs_by_ap(self, ap_iata: str, **kwargs) -> dict[str, float]:
+        query = self._pairs_by_ap_query(ap_iata)
         resp = self.execute(query, fetch=True, **kwargs)
         if resp.failed:
             err_msg = f"Failed to get pairs for airport {ap_iata}. Most recent exception: {resp.exc}"
@@ -175,5 +663,36 @@ class AirportDistancePairsGateway(BaseGateway):
             rv[pair_name] = float(row[1])
         return rv
 
+    def iter_pairs_by_ap(self, ap_iata: str, itersize: int = None, **kwargs) -> Iterator[tuple[str, float]]:
+        query = self._pairs_by_ap_query(ap_iata)
+        for pair_name, distance in self.iterate(query, itersize=itersize, **kwargs):
+            yield pair_name, float(distance)
+
+    def iter_distances(self, itersize: int = None, **kwargs) -> Iterator[tuple[str, str, float]]:
+        if self.by_id:
+            query = f"SELECT a1.uid, a2.uid, d.distance_km FROM {self.distances_by_id_table} d " \
+                    f"JOIN {self.airports_table} a1 ON a1.id = d.ap1_id " \
+                    f"JOIN {self.airports_table} a2 ON a2.id = d.ap2_id " \
+                    f"WHERE d.ap1_id <= d.ap2_id"
+        else:
+            query = f"SELECT ap1, ap2, distance_km FROM {self.distances_table}"
+        for ap1, ap2, distance in self.iterate(query, itersize=itersize, **kwargs):
+            yield ap1, ap2, float(distance)
 
 
+def _import_shard_worker(db_config: DBConnectConfig, airports: list[Airport], pending: list[int], shard: int,
+                         num_shards: int, layout: str, pairs: nullable(SparsePairs),
+                         logger: Logger, partners: list[int] = None) -> ShardImportResult:
+    try:
+        pg = FlightSearchPostgresDB(
+            config=dataclasses.replace(db_config, pool_min_connections=1, pool_max_connections=1),
+            logger=logger
+        )
+    except Exception as e:
+        return ShardImportResult(shard=shard, num_shards=num_shards, rows_scheduled=0, rows_written=0,
+                                 elapsed_s=0., error=f"{type(e).__name__}: {e}")
+    gw = AirportDistancePairsGateway(pg=pg, layout=layout, logger=logger)
+    try:
+        return gw.import_shard(airports, pending, shard, num_shards, pairs=pairs, partners=partners)
+    finally:
+        gw.close()
@@ -0,0 +1,76 @@
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from src.db.gateways.base_gateway import BaseGateway
+from src.db.pg_connect import FlightSearchPostgresDB
+from src.flight_search.airport import Airport
+from src.geo.spatial_index import SphericalKDTree
+from util.logging.logger import Logger
+from util.math import format_timedelta_string
+from util.types import nullable
+
+
+class AirportNeighborsGateway(BaseGateway):
+    """
+    Per-airport neighbour lists: every airport within `max_radius_km` of an airport, ranked by distance.
+    The primary key (ap, rank) makes a nearby-airport expansion a single index range scan.
+    """
+
+    def __init__(self, pg: FlightSearchPostgresDB, init_script: Path = None, max_radius_km: float = 150.,
+                 debug_mode: bool = False, logger: Logger = None):
+        BaseGateway.__init__(self, pg=pg, init_script=init_script, debug_mode=debug_mode, logger=logger)
+        self.max_radius_km: float = max_radius_km
+
+    def generate_neighbor_rows(self, airports: list[Airport]) -> Iterator[tuple[str, int, str, float]]:
+        lats = np.fromiter((ap.latitude for ap in airports), dtype=np.float64, count=len(airports))
+        lons = np.fromiter((ap.longitude for ap in airports), dtype=np.float64, count=len(airports))
+        index = SphericalKDTree(lats, lons)
+        for i, ap in enumerate(airports):
+            ids, distances = index.query_radius(lats[i], lons[i], self.max_radius_km)
+            rank = 0
+            for j, distance in zip(ids.tolist(), distances.tolist()):
+                if j != i:
+                    rank += 1
+                    yield ap.uid, rank, airports[j].uid, distance
+
+    def import_data(self, airports: list[Airport], **kwargs) -> int:
+        # The lists depend on the whole airport set, so they are rebuilt from scratch in one transaction
+        self.logger.info(f"Building neighbour lists within {self.max_radius_km:.1f}km for {len(airports)} airports...")
+        start_ = datetime.now()
+        resp = self.copy_rows(
+            table=self.neighbors_table,
+            columns=['ap', 'rank', 'neighbor', 'distance_km'],
+            rows=self.generate_neighbor_rows(airports),
+            before=f"TRUNCATE {self.neighbors_table};",
+            **kwargs
+        )
+        if resp.failed:
+            err_msg = f"Failed to COPY {resp.rows_copied} neighbour rows into db. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return 0
+        self.logger.info(f"Stored {resp.rows_copied} neighbour rows in {format_timedelta_string(datetime.now() - start_)}")
+        return resp.rows_copied
+
+    def get_neighbors(self, ap_iata: str, max_radius_km: float = None,
+                      **kwargs) -> nullable(list[tuple[str, float]]):
+        # None (unlike an empty list) means the lookup failed or cannot be answered from the stored radius
+        if max_radius_km is not None and max_radius_km > self.max_radius_km:
+            self.logger.warning(f"Neighbour lists only cover {self.max_radius_km:.1f}km, "
+                                f"cannot answer a {max_radius_km:.1f}km lookup")
+            return None
+        radius_filter = f" AND distance_km < {max_radius_km}" if max_radius_km is not None else ''
+        query = f"SELECT neighbor, distance_km FROM {self.neighbors_table} " \
+                f"WHERE ap = '{ap_iata}'{radius_filter} ORDER BY rank;"
+        resp = self.execute(query, fetch=True, **kwargs)
+        if resp.failed:
+            err_msg = f"Failed to get neighbours for airport {ap_iata}. Most recent exception: {resp.exc}"
+            if resp.rollback_exc:
+                err_msg += f", rollback exception: {resp.rollback_exc}"
+            self.logger.error(err_msg)
+            return None
+        return [(neighbor, float(distance)) for neighbor, distance in resp.pg_resp]
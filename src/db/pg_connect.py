@@ -1,9 +1,15 @@
 import dataclasses
+from contextlib import contextmanager
 from datetime import datetime
 from time import time
+from typing import Generator, Iterable, Iterator
+from uuid import uuid4
 
 import psycopg2
+from psycopg2 import extensions
 
+from src.db.copy_stream import CopyRowStream
+from src.db.pg_pool import PgConnectionPool
 from util.logging.logger import Logger, get_default_logger
 from util.types import nullable, const
 
@@ -15,6 +21,11 @@ class DBConnectConfig:
     db_name: str = 'postgres'
     db_user: str = 'postgres'
     db_pass: str = None
+    pool_min_connections: int = 1
+    pool_max_connections: int = 1
+    pool_checkout_timeout_s: float = None
+    pool_health_check_idle_s: float = 10.
+    cursor_itersize: int = 2000
 
 
 @dataclasses.dataclass
@@ -25,6 +36,7 @@ class PgResponse:
     row_count: int
     exc: Exception = None
     rollback_exc: Exception = None
+    rows_copied: int = 0
 
     @property
     def failed(self) -> bool:
@@ -42,55 +54,92 @@ class FlightSearchPostgresDB:
         self._conf: DBConnectConfig = config
 
         self._initialized: bool = False
-        self._db_conn: nullable(psycopg2.connection) = None
+        self._pool: nullable(PgConnectionPool) = None
 
         self._connect()
 
+    @property
+    def config(self) -> DBConnectConfig:
+        return self._conf
+
+    @property
+    def pool(self) -> PgConnectionPool:
+        return self._pool
+
     def reconnect(self, new_config: DBConnectConfig = None):
         if new_config:
             self._conf = new_config
+        self.close()
         self._connect()
 
     def _connect(self):
-        self.logger.info(f"Attempting to connect to DB `{self._conf.db_name}` on {self._conf.db_host}:{self._conf.db_port}")
-        c = psycopg2.connect(
-            database=self._conf.db_name,
-            user=self._conf.db_user,
-            password=self._conf.db_pass,
-            host=self._conf.db_host,
-            port=self._conf.db_port,
+        self.logger.info(f"Attempting to connect to DB `{self._conf.db_name}` on {self._conf.db_host}:{self._conf.db_port} "
+                         f"(pool size {self._conf.pool_min_connections}-{self._conf.pool_max_connections})")
+        self._pool = PgConnectionPool(
+            dsn_kwargs=dict(
+                database=self._conf.db_name,
+                user=self._conf.db_user,
+                password=self._conf.db_pass,
+                host=self._conf.db_host,
+                port=self._conf.db_port,
+            ),
+            min_connections=self._conf.pool_min_connections,
+            max_connections=self._conf.pool_max_connections,
+            checkout_timeout_s=self._conf.pool_checkout_timeout_s,
+            health_check_idle_s=self._conf.pool_health_check_idle_s,
+            logger=self.logger
         )
-        self._db_conn = c
         self._initialized = True
 
     def close(self):
         if self._initialized:
-            self._db_conn.close()
+            self._pool.close()
             self._initialized = False
 
+    @contextmanager
+    def connection(self) -> Generator[extensions.connection, None, None]:
+        """
+        Borrows a connection from the pool for the duration of the block, e.g. to run several statements which
+        depend on the same session (temp tables, server-side cursors).
+        """
+        with self._pool.connection() as conn:
+            yield conn
+
+    @staticmethod
+    def _is_connection_error(exc: Exception) -> bool:
+        return isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
     def execute(self, q: str, fetch: bool = False) -> PgResponse:
         start_ = datetime.now()
         exc_ = None
         rb_exc_ = None
         rc = 0
         rv = []
-        with self._db_conn.cursor() as cur:
-            try:
+        try:
+            conn = self._pool.checkout()
+        except Exception as exc:
+            return PgResponse(query=q, exec_time_ms=0., pg_resp=rv, row_count=rc, exc=exc)
+        discard = False
+        try:
+            with conn.cursor() as cur:
                 cur.execute(q)
                 if fetch:
                     rv = cur.fetchall()
                     rc = len(rv)
                 else:
                     rc = cur.rowcount
-                self._db_conn.commit()
-            except Exception as exc:
-                exc_ = exc
-                try:
-                    self.logger.debug(f"ROLLBACK! {q=}")
-                    self._db_conn.rollback()
-                except Exception as rb_exc:
-                    rb_exc_ = rb_exc
-                    ...
+            conn.commit()
+        except Exception as exc:
+            exc_ = exc
+            discard = self._is_connection_error(exc)
+            try:
+                self.logger.debug(f"ROLLBACK! {q=}")
+                conn.rollback()
+            except Exception as rb_exc:
+                rb_exc_ = rb_exc
+                discard = True
+        finally:
+            self._pool.checkin(conn, discard=discard)
         return PgResponse(
             query=q,
             exec_time_ms=(datetime.now() - start_).microseconds / 1000,
@@ -100,3 +149,79 @@ class FlightSearchPostgresDB:
             rollback_exc=rb_exc_
         )
 
+    def iterate(self, q: str, itersize: int = None) -> Iterator[tuple]:
+        """
+        Lazily yields the rows of `q` through a named (server-side) cursor, fetching `itersize` rows per round trip,
+        so memory stays bounded regardless of the result size. The connection is held until the iterator is exhausted
+        or closed. Unlike `execute`, failures are raised to the consumer, as rows may already have been yielded.
+        """
+        itersize = itersize or self._conf.cursor_itersize
+        with self._pool.connection() as conn:
+            try:
+                with conn.cursor(name=f"fs_iter_{uuid4().hex}") as cur:
+                    cur.itersize = itersize
+                    cur.execute(q)
+                    while rows := cur.fetchmany(itersize):
+                        yield from rows
+                conn.commit()
+            except BaseException:
+                try:
+                    self.logger.debug(f"ROLLBACK! {q=}")
+                    conn.rollback()
+                except Exception:
+                    ...
+                raise
+
+    def copy_rows(self, table: str, columns: list[str], rows: Iterable[tuple],
+                  before: str = None, after: str = None, fetch: bool = False) -> PgResponse:
+        """
+        Streams `rows` into `table` with COPY FROM STDIN. The optional `before` and `after` statements run in the
+        same transaction, e.g. to create a staging table and merge it into its target. The row count (and result
+        rows, if `fetch` is set) of the response come from `after` when it is given.
+        """
+        start_ = datetime.now()
+        exc_ = None
+        rb_exc_ = None
+        rc = 0
+        rv = []
+        stream = CopyRowStream(rows)
+        q = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+        try:
+            conn = self._pool.checkout()
+        except Exception as exc:
+            return PgResponse(query=q, exec_time_ms=0., pg_resp=rv, row_count=rc, exc=exc)
+        discard = False
+        try:
+            with conn.cursor() as cur:
+                if before:
+                    cur.execute(before)
+                cur.copy_expert(q, stream)
+                rc = cur.rowcount
+                if after:
+                    cur.execute(after)
+                    if fetch:
+                        rv = cur.fetchall()
+                        rc = len(rv)
+                    else:
+                        rc = cur.rowcount
+            conn.commit()
+        except Exception as exc:
+            exc_ = exc
+            discard = self._is_connection_error(exc)
+            try:
+                self.logger.debug(f"ROLLBACK! {q=}")
+                conn.rollback()
+            except Exception as rb_exc:
+                rb_exc_ = rb_exc
+                discard = True
+        finally:
+            self._pool.checkin(conn, discard=discard)
+        return PgResponse(
+            query=q,
+            exec_time_ms=(datetime.now() - start_).total_seconds() * 1000,
+            pg_resp=rv,
+            row_count=rc,
+            exc=exc_,
+            rollback_exc=rb_exc_,
+            rows_copied=stream.rows_read
+        )
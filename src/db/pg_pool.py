@@ -0,0 +1,156 @@
+from contextlib import contextmanager
+from threading import Condition, Lock
+from time import monotonic
+from typing import Generator
+
+import psycopg2
+from psycopg2 import extensions
+
+from util.logging.logger import Logger, get_default_logger
+from util.types import nullable
+
+
+class PoolClosed(Exception):
+
+    def __str__(self) -> str:
+        return "This connection pool is closed"
+
+
+class PoolTimeout(Exception):
+
+    def __init__(self, timeout_s: float):
+        self.timeout_s: float = timeout_s
+
+    def __str__(self) -> str:
+        return f"Timed out after {self.timeout_s:.1f}s waiting for a free DB connection"
+
+
+class PgConnectionPool:
+    """
+    A thread-safe pool of psycopg2 connections.
+    Up to `max_connections` connections are handed out at once, and callers block on `checkout()` while the pool is
+    exhausted. Idle connections are health-checked on checkout (closed connections always, and with a `SELECT 1` once
+    they have been idle for longer than `health_check_idle_s`), and broken ones are replaced with a fresh connection.
+    """
+
+    logger: Logger = get_default_logger()
+
+    def __init__(self, dsn_kwargs: dict, min_connections: int = 1, max_connections: int = 1,
+                 checkout_timeout_s: nullable(float) = None, health_check_idle_s: float = 10., logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+        if not 0 <= min_connections <= max_connections or max_connections < 1:
+            raise ValueError(f"Invalid pool bounds {min_connections=} {max_connections=}")
+        self._dsn_kwargs: dict = dsn_kwargs
+        self.min_connections: int = min_connections
+        self.max_connections: int = max_connections
+        self._checkout_timeout_s: nullable(float) = checkout_timeout_s
+        self._health_check_idle_s: float = health_check_idle_s
+
+        self._cond: Condition = Condition(Lock())
+        self._idle: list[tuple[extensions.connection, float]] = []
+        self._in_use: int = 0
+        self._closed: bool = False
+
+        for _ in range(min_connections):
+            self._idle.append((self._new_connection(), monotonic()))
+
+    @property
+    def size(self) -> int:
+        with self._cond:
+            return len(self._idle) + self._in_use
+
+    @property
+    def in_use(self) -> int:
+        with self._cond:
+            return self._in_use
+
+    def _new_connection(self) -> extensions.connection:
+        return psycopg2.connect(**self._dsn_kwargs)
+
+    def _is_healthy(self, conn: extensions.connection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if monotonic() - last_used < self._health_check_idle_s:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            self.logger.warning(f"Pooled DB connection failed its health check: {e}")
+            return False
+
+    @staticmethod
+    def _close_quietly(conn: extensions.connection):
+        try:
+            conn.close()
+        except Exception:
+            ...
+
+    def checkout(self) -> extensions.connection:
+        deadline = None if self._checkout_timeout_s is None else monotonic() + self._checkout_timeout_s
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolClosed
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._in_use < self.max_connections:
+                    conn, last_used = None, 0.
+                    break
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout(self._checkout_timeout_s)
+                self._cond.wait(timeout=remaining)
+            self._in_use += 1
+
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                self.logger.info("Reconnecting broken pooled DB connection")
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self._new_connection()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def checkin(self, conn: extensions.connection, discard: bool = False):
+        if not discard and not conn.closed and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed or conn.closed:
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self) -> Generator[extensions.connection, None, None]:
+        conn = self.checkout()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.checkin(conn, discard=discard)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._close_quietly(conn)
+            self._idle = []
+            self._cond.notify_all()
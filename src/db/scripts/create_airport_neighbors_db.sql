@@ -0,0 +1,9 @@
+create table if not exists airport_neighbors
+(
+    ap          varchar(30)      not null,
+    rank        integer          not null,
+    neighbor    varchar(30)      not null,
+    distance_km double precision not null,
+    constraint airport_neighbors_pk
+        primary key (ap, rank)
+);
@@ -12,7 +12,10 @@ create table if not exists airports
     longitude    double precision not null,
     size         varchar(16)      not null,
     iata_code    varchar(8)       not null,
-    local_code   varchar(16)
+    local_code   varchar(16),
+    id           integer generated by default as identity
+                 constraint airports_id_uk
+                 unique
 );
 
 create index if not exists airports_iata_code_index
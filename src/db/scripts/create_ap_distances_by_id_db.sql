@@ -0,0 +1,14 @@
+alter table airports
+    add column if not exists id integer generated by default as identity;
+
+create unique index if not exists airports_id_uk
+    on airports (id);
+
+create table if not exists airport_distances
+(
+    ap1_id      integer          not null,
+    ap2_id      integer          not null,
+    distance_km double precision not null,
+    constraint airport_distances_pk
+        primary key (ap1_id, ap2_id) include (distance_km)
+);
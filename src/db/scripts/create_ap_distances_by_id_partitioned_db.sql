@@ -0,0 +1,27 @@
+alter table airports
+    add column if not exists id integer generated by default as identity;
+
+create unique index if not exists airports_id_uk
+    on airports (id);
+
+create table if not exists airport_distances
+(
+    ap1_id      integer          not null,
+    ap2_id      integer          not null,
+    distance_km double precision not null,
+    constraint airport_distances_pk
+        primary key (ap1_id, ap2_id) include (distance_km)
+) partition by hash (ap1_id);
+
+do
+$$
+    begin
+        for i in 0..7
+            loop
+                execute format(
+                    'create table if not exists airport_distances_p%s partition of airport_distances '
+                    'for values with (modulus 8, remainder %s)', i, i
+                );
+            end loop;
+    end
+$$;
@@ -74,8 +74,13 @@ class Airport:
     def __hash__(self) -> int:
         return hash(self.coordinates)
 
+    @staticmethod
+    def make_uid(iata_code: nullable(str), latitude: float, longitude: float) -> str:
+        coordinates_hash = hash((latitude, longitude))
+        if not iata_code:
+            return str(coordinates_hash)
+        return f"{iata_code}_{abs(coordinates_hash)}"
+
     @property
     def uid(self) -> nullable(str):
-        if not self.iata_code:
-            return str(hash(self))
-        return f"{self.iata_code}_{abs(hash(self))}"
+        return self.make_uid(self.iata_code, self.latitude, self.longitude)
@@ -0,0 +1,138 @@
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from src.flight_search.airport import Airport
+from util.logging.logger import Logger, get_default_logger
+from util.types import nullable
+
+
+class AirportTable:
+    """
+    All airports as parallel (struct-of-arrays) columns, addressed by stable integer ids: the row number.
+    Coordinates are float64 arrays, sizes/countries/regions are interned into small integer codes, and each uid is
+    computed once, with an O(1) uid <-> id map. `Airport` objects are only built on demand, as views of a row, so
+    geo, distance and search code can pass ids around instead.
+    """
+
+    logger: Logger = get_default_logger()
+
+    def __init__(self, names: Iterable[str], iso_countries: Iterable[str], iso_regions: Iterable[str],
+                 municipalities: Iterable[str], latitudes: Iterable[float], longitudes: Iterable[float],
+                 sizes: Iterable[str], iata_codes: Iterable[str], local_codes: Iterable[str], logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        self.names: np.ndarray = self._strings(names)
+        self.municipalities: np.ndarray = self._strings(municipalities)
+        self.iata_codes: np.ndarray = self._strings(iata_codes)
+        self.local_codes: np.ndarray = self._strings(local_codes)
+        self.latitudes: np.ndarray = np.asarray(list(latitudes), dtype=np.float64)
+        self.longitudes: np.ndarray = np.asarray(list(longitudes), dtype=np.float64)
+        self.size_codes, self.sizes = self._intern(sizes, np.int8)
+        self.country_codes, self.countries = self._intern(iso_countries, np.int16)
+        self.region_codes, self.regions = self._intern(iso_regions, np.int16)
+
+        n = len(self.names)
+        lengths = {len(column) for column in (self.municipalities, self.iata_codes, self.local_codes, self.latitudes,
+                                              self.longitudes, self.size_codes, self.country_codes, self.region_codes)}
+        if lengths != {n}:
+            raise ValueError(f"AirportTable columns must have the same length, got {sorted(lengths | {n})}")
+
+        self.uids: list[str] = [Airport.make_uid(iata_code, lat, lon) for iata_code, lat, lon
+                                in zip(self.iata_codes.tolist(), self.latitudes.tolist(), self.longitudes.tolist())]
+        self._ids: dict[str, int] = {}
+        for ap_id, uid in enumerate(self.uids):
+            if self._ids.setdefault(uid, ap_id) != ap_id:
+                self.logger.warning(f"Duplicate airport uid {uid} (ids {self._ids[uid]} and {ap_id}), "
+                                    f"lookups by uid resolve to the first")
+
+    @staticmethod
+    def _strings(values: Iterable[str]) -> np.ndarray:
+        values = list(values)
+        rv = np.empty(len(values), dtype=object)
+        rv[:] = ['' if value is None else value for value in values]
+        return rv
+
+    @staticmethod
+    def _intern(values: Iterable[str], dtype: type) -> tuple[np.ndarray, list[str]]:
+        codes, uniques = pd.factorize(pd.Series(list(values), dtype=object).fillna(''))
+        if len(uniques) > np.iinfo(dtype).max:
+            dtype = np.int32
+        return codes.astype(dtype), [str(value) for value in uniques]
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, logger: Logger = None) -> 'AirportTable':
+        # Columns as read by `AirportDatasetLoader`
+        return cls(
+            names=df['name'].tolist(),
+            iso_countries=df['iso_country'].tolist(),
+            iso_regions=df['iso_region'].tolist(),
+            municipalities=df['municipality'].tolist(),
+            latitudes=df['latitude'].to_numpy(dtype=np.float64),
+            longitudes=df['longitude'].to_numpy(dtype=np.float64),
+            sizes=df['type'].astype(str).tolist(),
+            iata_codes=df['iata_code'].tolist(),
+            local_codes=df['local_code'].tolist(),
+            logger=logger
+        )
+
+    @classmethod
+    def from_airports(cls, airports: list[Airport], logger: Logger = None) -> 'AirportTable':
+        return cls(
+            names=[ap.full_name for ap in airports],
+            iso_countries=[ap.iso_country for ap in airports],
+            iso_regions=[ap.iso_region for ap in airports],
+            municipalities=[ap.municipality for ap in airports],
+            latitudes=[ap.latitude for ap in airports],
+            longitudes=[ap.longitude for ap in airports],
+            sizes=[ap.size for ap in airports],
+            iata_codes=[ap.iata_code for ap in airports],
+            local_codes=[ap.local_code for ap in airports],
+            logger=logger
+        )
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    @property
+    def ids(self) -> np.ndarray:
+        return np.arange(len(self))
+
+    def id_of(self, uid: str) -> nullable(int):
+        return self._ids.get(uid)
+
+    def ids_of(self, uids: Iterable[str]) -> np.ndarray:
+        # -1 for unknown uids
+        return np.fromiter((self._ids.get(uid, -1) for uid in uids), dtype=np.int64)
+
+    def uid_of(self, ap_id: int) -> str:
+        return self.uids[ap_id]
+
+    def size_of(self, ap_id: int) -> str:
+        return self.sizes[self.size_codes[ap_id]]
+
+    def ids_with_size(self, *sizes: str) -> np.ndarray:
+        codes = [code for code, size in enumerate(self.sizes) if size in sizes]
+        return np.flatnonzero(np.isin(self.size_codes, codes))
+
+    def coordinates(self, ap_id: int) -> tuple[float, float]:
+        return float(self.latitudes[ap_id]), float(self.longitudes[ap_id])
+
+    def view(self, ap_id: int) -> Airport:
+        return Airport(
+            full_name=self.names[ap_id],
+            iso_country=self.countries[self.country_codes[ap_id]],
+            iso_region=self.regions[self.region_codes[ap_id]],
+            municipality=self.municipalities[ap_id],
+            latitude=float(self.latitudes[ap_id]),
+            longitude=float(self.longitudes[ap_id]),
+            size=self.sizes[self.size_codes[ap_id]],
+            iata_code=self.iata_codes[ap_id],
+            local_code=self.local_codes[ap_id]
+        )
+
+    def views(self, ap_ids: Iterable[int] = None) -> Iterator[Airport]:
+        for ap_id in (range(len(self)) if ap_ids is None else ap_ids):
+            yield self.view(int(ap_id))
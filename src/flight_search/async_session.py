@@ -0,0 +1,240 @@
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+
+import aiohttp
+from requests import Session
+
+from src.flight_search.airport import Airport
+from src.flight_search.flight import FlightOffers
+from src.flight_search.search_query import FlightSearchQuery
+from src.flight_search.response_cache import ResponseCache
+from src.flight_search.session import AmadeusSession
+from src.flight_search.token_manager import AccessToken, TokenManager
+from util.goroutine import Channel, GoRoutine, go
+from util.logging.logger import Logger, get_default_logger
+from util.rate_limiter import RateLimiter
+from util.types import nullable, const
+
+
+class AsyncAmadeusSession:
+    """
+    An asyncio counterpart of AmadeusSession. A search is fanned out into one flight-offers request per leg
+    (origin, destination, departure date). At most `max_concurrency` requests are in flight at any time, sharing a
+    pool of keep-alive connections, and every leg's FlightOffers is put into the channel as soon as it arrives, so a
+    search takes about as long as its slowest requests rather than the sum of all of them. Searches running at the
+    same time which need the same leg share a single request for it.
+    Use it either with `async with` and `await fan_out(...)` from a running loop, or through `search` from synchronous
+    code, which runs fan-outs on a background loop (stopped by `shutdown`), but not both.
+    """
+
+    logger: Logger = get_default_logger()
+    BASE_ENDPOINT: const(str) = AmadeusSession.BASE_ENDPOINT
+
+    def __init__(self, api_key: str, api_secret: str, max_concurrency: int = 8, timeout_s: float = 30.,
+                 base_endpoint: str = None, proactive_refresh: bool = True, token_cache_file: Path = None,
+                 cache: ResponseCache = None, rate_limiter: RateLimiter = None, logger: Logger = None):
+        """
+        Access tokens are managed by a TokenManager, as in AmadeusSession: refreshes are single-flight, with
+        `proactive_refresh` the token is replaced in the background while the session is open, and
+        `token_cache_file` shares the token with other processes (and sessions) using the same file.
+        """
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self._api_key: str = api_key
+        self._api_secret: str = api_secret
+        self._base_endpoint: str = base_endpoint or self.BASE_ENDPOINT
+        self._max_concurrency: int = max_concurrency
+        # Shared with AmadeusSession's key format, so both can use the same cache
+        self.cache: nullable(ResponseCache) = cache
+        # Share it with any AmadeusSession using the same credentials, their requests count against the same quota
+        self.rate_limiter: RateLimiter = rate_limiter or RateLimiter(
+            per_second=AmadeusSession.RATE_LIMIT_PER_S, logger=logger
+        )
+        self._timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(total=timeout_s)
+        self._http: nullable(aiohttp.ClientSession) = None
+        self._slots: nullable(asyncio.Semaphore) = None
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.coalesced: int = 0
+
+        self._loop: nullable(asyncio.AbstractEventLoop) = None
+        self._loop_routine: nullable(GoRoutine) = None
+        self._loop_lock: Lock = Lock()
+
+        # Tokens are rare, blocking requests: they are fetched off the loop, in TokenManager's threads
+        self._proactive_refresh: bool = proactive_refresh
+        self._token_sess: Session = Session()
+        self._tokens: TokenManager = TokenManager(
+            fetch=self._fetch_access_token,
+            cache_file=token_cache_file,
+            logger=logger
+        )
+
+    def _build_url(self, *parts) -> str:
+        return self._base_endpoint.rstrip("/") + "/" + "/".join(parts)
+
+    async def open(self):
+        # HTTP sessions belong to the loop they were created on, so each loop gets its own
+        if self._http is not None and not self._http.closed:
+            return
+        self._http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._max_concurrency, keepalive_timeout=60),
+            timeout=self._timeout
+        )
+        self._slots = asyncio.Semaphore(self._max_concurrency)
+        self._in_flight = {}
+        if self._proactive_refresh:
+            self._tokens.start()
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+        self._http = None
+        self._slots = None
+        await asyncio.to_thread(self._tokens.stop)
+
+    async def __aenter__(self) -> 'AsyncAmadeusSession':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    def _fetch_access_token(self) -> nullable(AccessToken):
+        return AmadeusSession.request_access_token(
+            self._token_sess, self._build_url("v1", "security", "oauth2", "token"), self._api_key, self._api_secret,
+            timeout_s=self._timeout.total, logger=self.logger
+        )
+
+    async def _access_token(self) -> nullable(str):
+        # A valid token is used without leaving the loop; only a caller which has to wait for a refresh does
+        if (token := self._tokens.current) is not None and token.valid_for(TokenManager.MIN_VALIDITY_S):
+            return token.value
+        return await asyncio.to_thread(self._tokens.token)
+
+    @staticmethod
+    async def _read_body(resp: aiohttp.ClientResponse) -> dict | str:
+        # Gateways in front of the API answer errors with HTML or plain text
+        try:
+            return await resp.json(content_type=None)
+        except ValueError:
+            return await resp.text()
+
+    async def _request(self, url: str, method: str = "GET", **kwargs) -> tuple[int, dict | str]:
+        extra_headers = kwargs.pop("headers", {})
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire_async()
+            headers = {"Authorization": f"Bearer {await self._access_token()}"} | extra_headers
+            async with self._http.request(method=method, url=url, headers=headers, **kwargs) as resp:
+                self.rate_limiter.update_from_headers(resp.headers)
+                status = resp.status
+                # Bodies of responses which are retried are never read
+                if (delay_s := self.rate_limiter.retry_delay(status, attempt, resp.headers)) is None:
+                    return status, await self._read_body(resp)
+            self.logger.warning(f"[{status}] from `{url}`, retrying in {delay_s:.2f}s")
+            await asyncio.sleep(delay_s)
+            attempt += 1
+
+    async def find_flight_offers(self, depart: Airport, arrive: Airport, date: datetime,
+                                 query: FlightSearchQuery) -> FlightOffers:
+        params = AmadeusSession.flight_offers_params(depart, arrive, date, query)
+        key = AmadeusSession.flight_offers_key(params)
+        rv = FlightOffers(departs_from=depart, arrives_at=arrive, departure_date=date)
+        # The cache is SQLite: its blocking reads and writes run off the loop
+        if self.cache is not None and not query.bypass_cache:
+            if (cached := await asyncio.to_thread(self.cache.get, key)) is not None:
+                rv.offers = cached
+                return rv
+        # Concurrent requests for the same leg share one upstream call. Shielded, so that a cancelled caller does not
+        # cancel the call for everyone else.
+        if (shared := self._in_flight.get(key)) is None:
+            shared = self._in_flight[key] = asyncio.ensure_future(self._fetch_flight_offers(params))
+            shared.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        offers, rv.error = await asyncio.shield(shared)
+        rv.offers = list(offers)
+        return rv
+
+    async def _fetch_flight_offers(self, params: dict) -> tuple[list[dict], nullable(str)]:
+        async with self._slots:
+            try:
+                status, body = await self._request(self._build_url("v2", "shopping", "flight-offers"), params=params)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                return [], f"{type(e).__name__}: {e}"
+        if status != 200 or not isinstance(body, dict):
+            return [], f"[{status}] {body.get('errors') if isinstance(body, dict) else body}"
+        offers = body.get("data") or []
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, AmadeusSession.flight_offers_key(params), offers)
+        return offers, None
+
+    async def fan_out(self, query: FlightSearchQuery, channel: Channel) -> int:
+        # Puts one FlightOffers per leg into `channel`, in completion order. Returns the number of failed legs.
+        if len(query.depart_from) < 1:
+            raise ValueError("You need to choose at least one departure point")
+        if len(query.arrive_at) < 1:
+            raise ValueError("You need to choose at least one arrival point")
+        await self.open()
+        # One token for the whole fan-out, before the requests race for it
+        await self._access_token()
+        legs = query.legs()
+        self.logger.info(f"Searching {len(legs)} legs, up to {self._max_concurrency} at a time")
+        start_ = datetime.now()
+        failed = 0
+        for next_done in asyncio.as_completed([self.find_flight_offers(*leg, query=query) for leg in legs]):
+            offers = await next_done
+            if offers.failed:
+                failed += 1
+                self.logger.error(f"Flight search {offers.departs_from.iata_code} -> {offers.arrives_at.iata_code} "
+                                  f"on {offers.departure_date:%Y-%m-%d} failed: {offers.error}")
+            channel.put(offers)
+        self.logger.info(f"Searched {len(legs)} legs ({failed} failed) in "
+                         f"{(datetime.now() - start_).total_seconds():.2f}s")
+        return failed
+
+    def _run_loop(self, channel: Channel):
+        # Body of the background goroutine: the loop every synchronous `search` runs on, until `shutdown`
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+        self._loop.run_until_complete(self.close())
+        self._loop.close()
+        channel.close()
+
+    def _background_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_routine = go(self._run_loop)
+            return self._loop
+
+    async def _search(self, query: FlightSearchQuery, channel: Channel):
+        try:
+            await self.fan_out(query, channel)
+        except Exception as e:
+            self.logger.error(f"Flight search failed: {type(e).__name__}: {e}")
+        finally:
+            channel.close()
+
+    def search(self, query: FlightSearchQuery) -> Channel:
+        """
+        Like AmadeusSession.search, but returns straight away. FlightOffers arrive in the channel as their requests
+        complete, and the channel is closed once every leg is in. Searches share the background loop, and with it
+        the connection pool and the concurrency limit.
+        """
+        chan = Channel()
+        asyncio.run_coroutine_threadsafe(self._search(query, chan), self._background_loop())
+        return chan
+
+    def shutdown(self, timeout_s: float = None):
+        with self._loop_lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_routine.stop(timeout_s)
+            self._loop = self._loop_routine = None
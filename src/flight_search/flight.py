@@ -19,3 +19,21 @@ class Flight:
 class Trip:
 
     flights: list[Flight]
+
+
+@dataclasses.dataclass
+class FlightOffers:
+    """
+    The flight offers found for one leg (origin, destination and departure date) of a search, or why there are none.
+    `offers` holds the raw offer objects of the response.
+    """
+
+    departs_from: Airport
+    arrives_at: Airport
+    departure_date: datetime
+    offers: list[dict] = dataclasses.field(default_factory=list)
+    error: str = None
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
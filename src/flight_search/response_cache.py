@@ -0,0 +1,118 @@
+import json
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Any
+
+from util.logging.logger import Logger, get_default_logger
+from util.types import nullable, const
+
+
+class ResponseCache:
+    """
+    A TTL + LRU cache of API responses (JSON-serializable bodies) keyed by request, backed by SQLite so that it
+    survives restarts. Without a `path` it lives in memory only.
+        - every entry expires `ttl_s` after it was stored (or its own `ttl_s`); expired entries are never returned
+        - past `max_entries`, the least recently used entries are evicted
+    Hits, misses, evictions (LRU) and expirations are counted, see `stats`. Safe to share between threads.
+    """
+
+    logger: Logger = get_default_logger()
+
+    DEFAULT_TTL_S: const(float) = 15 * 60.
+
+    def __init__(self, path: Path = None, max_entries: int = 10_000, ttl_s: float = DEFAULT_TTL_S,
+                 logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.path: nullable(Path) = path
+        self.max_entries: int = max_entries
+        self.ttl_s: float = ttl_s
+        self._lock: Lock = Lock()
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self._db: sqlite3.Connection = sqlite3.connect(
+            str(path) if path is not None else ":memory:", check_same_thread=False, isolation_level=None
+        )
+        self._db.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, body TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS responses_last_used_index ON responses (last_used);"
+            "CREATE INDEX IF NOT EXISTS responses_expires_at_index ON responses (expires_at);"
+        )
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+        self.logger.info(f"Response cache ready with {len(self)} entries ({path or 'in memory'})")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> nullable(Any):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT body, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return
+            body, expires_at = row
+            if expires_at <= now:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.expirations += 1
+                self.misses += 1
+                return
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(body)
+
+    def put(self, key: str, body: Any, ttl_s: float = None):
+        now = time.time()
+        expires_at = now + (self.ttl_s if ttl_s is None else ttl_s)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO responses (key, body, expires_at, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET body = excluded.body, expires_at = excluded.expires_at, "
+                "last_used = excluded.last_used",
+                (key, json.dumps(body), expires_at, now)
+            )
+            self._evict()
+
+    def _evict(self):
+        # Expired entries go first, then the least recently used ones until the cache fits
+        expired = self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),)).rowcount
+        self.expirations += expired
+        excess = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,)
+            )
+            self.evictions += excess
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
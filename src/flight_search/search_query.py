@@ -13,3 +13,23 @@ class FlightSearchQuery:
     budget: Money
     departure_dates: list[datetime.datetime]
     max_journey_legs: int = 2
+    passengers: int = 1
+    # Skip cached responses (fresh responses are still cached)
+    bypass_cache: bool = False
+
+    def legs(self) -> list[tuple[Airport, Airport, datetime.datetime]]:
+        """
+        The unique (origin, destination, departure date) legs of the query, in query order: repeated airports and
+        dates are searched once, and an airport is never searched against itself.
+        """
+        seen = set()
+        rv = []
+        for depart in self.depart_from:
+            for arrive in self.arrive_at:
+                if arrive.uid == depart.uid:
+                    continue
+                for date in self.departure_dates:
+                    if (key := (depart.uid, arrive.uid, date.date())) not in seen:
+                        seen.add(key)
+                        rv.append((depart, arrive, date))
+        return rv
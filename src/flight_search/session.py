@@ -1,12 +1,20 @@
+import time
+from concurrent.futures import Future
 from datetime import datetime, timedelta
+from pathlib import Path
+from threading import Lock
 
-from requests import Session, Response
+from requests import RequestException, Session, Response
 
 from src.currency.money import Money
 from src.flight_search.airport import Airport
+from src.flight_search.flight import FlightOffers
+from src.flight_search.response_cache import ResponseCache
 from src.flight_search.search_query import FlightSearchQuery
+from src.flight_search.token_manager import AccessToken, PermanentTokenError, TokenManager
 from util.goroutine import Channel
 from util.logging.logger import Logger, get_default_logger
+from util.rate_limiter import RateLimiter
 from util.types import nullable, const
 
 
@@ -14,8 +22,23 @@ class AmadeusSession:
 
     logger: Logger = get_default_logger()
     BASE_ENDPOINT: const(str) = "https://test.api.amadeus.com/"
-
-    def __init__(self, api_key: str, api_secret: str, lazy_init: bool = False, logger: Logger = None):
+    TOKEN_LIFETIME: const(timedelta) = timedelta(minutes=30)
+    # The test environment's limit
+    RATE_LIMIT_PER_S: const(float) = 10.
+    TOKEN_TIMEOUT_S: const(float) = 30.
+
+    def __init__(self, api_key: str, api_secret: str, lazy_init: bool = False, proactive_refresh: bool = True,
+                 token_cache_file: Path = None, cache: ResponseCache = None, rate_limiter: RateLimiter = None,
+                 logger: Logger = None):
+        """
+        Access tokens are managed by a TokenManager: refreshes are single-flight, and with `proactive_refresh` the
+        token is replaced in the background before it expires. `token_cache_file` shares the token with the other
+        processes using the same file.
+        Successful flight-offer responses are kept in `cache`, if given, unless a query asks to bypass it. Threads
+        asking for the same flight offers at the same time share a single request.
+        API requests go through `rate_limiter` (by default, one of RATE_LIMIT_PER_S requests per second), which also
+        retries 429s and 5xx with backoff. Sessions using the same credentials should share a limiter.
+        """
         if logger:
             self.logger: Logger = logger
             self.__class__.logger = logger
@@ -23,9 +46,18 @@ class AmadeusSession:
         self._api_secret: str = api_secret
         self._sess: Session = Session()
         self._initialized: bool = False
-
-        self._token_expiry: nullable(datetime) = None
-        self._access_token: nullable(str) = None
+        self._proactive_refresh: bool = proactive_refresh
+        self.cache: nullable(ResponseCache) = cache
+        self._in_flight: dict[str, Future] = {}
+        self._in_flight_lock: Lock = Lock()
+        self.coalesced: int = 0
+        self.rate_limiter: RateLimiter = rate_limiter or RateLimiter(per_second=self.RATE_LIMIT_PER_S, logger=logger)
+
+        self._tokens: TokenManager = TokenManager(
+            fetch=self._fetch_access_token,
+            cache_file=token_cache_file,
+            logger=logger
+        )
         if not lazy_init:
             self._init()
 
@@ -34,43 +66,134 @@ class AmadeusSession:
         return cls.BASE_ENDPOINT + "/".join(parts)
 
     def _init(self):
-        self._refresh_access_token()
+        self._initialized = self._tokens.token() is not None
+        if self._proactive_refresh:
+            self._tokens.start()
 
-    def _cycle_token(self):
-        if self._token_expiry < datetime.now():
-            self._refresh_access_token()
+    def close(self):
+        self._tokens.stop()
+        self._sess.close()
 
     def _request(self, url: str, method: str = "GET", **kwargs) -> Response:
-        self._cycle_token()
-        headers = {"Authorization": f"Bearer {self._access_token}"} | kwargs.pop("headers", {})
-        return self._sess.request(method=method, url=url, headers=headers, **kwargs)
-
-    def _refresh_access_token(self):
-        self.logger.info("Trying to get Amadeus API token...")
-        if not self._api_key or not self._api_secret:
-            self.logger.error("Cannot refresh Amadeus Session. No api key and/or secret set")
-            return
-        url = self._build_url("v1", "security", "oauth2", "token")
-        resp = self._sess.post(
-            url,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            data={
-                "grant_type": "client_credentials",
-                "client_id": self._api_key,
-                "client_secret": self._api_secret
-            }
+        if not self._initialized:
+            self._init()
+        extra_headers = kwargs.pop("headers", {})
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            headers = {"Authorization": f"Bearer {self._tokens.token()}"} | extra_headers
+            resp = self._sess.request(method=method, url=url, headers=headers, **kwargs)
+            self.rate_limiter.update_from_headers(resp.headers)
+            if (delay_s := self.rate_limiter.retry_delay(resp.status_code, attempt, resp.headers)) is None:
+                return resp
+            self.logger.warning(f"[{resp.status_code}] from `{url}`, retrying in {delay_s:.2f}s")
+            time.sleep(delay_s)
+            attempt += 1
+
+    def _fetch_access_token(self) -> nullable(AccessToken):
+        return self.request_access_token(
+            self._sess, self._build_url("v1", "security", "oauth2", "token"), self._api_key, self._api_secret,
+            logger=self.logger
         )
+
+    @classmethod
+    def request_access_token(cls, sess: Session, url: str, api_key: str, api_secret: str,
+                             timeout_s: float = TOKEN_TIMEOUT_S, logger: Logger = None) -> nullable(AccessToken):
+        """
+        Also the `fetch` of AsyncAmadeusSession's TokenManager. Logs to `logger`, if given, rather than the class's.
+        Returns None if the request failed, or raises PermanentTokenError if it cannot succeed with these credentials.
+        """
+        logger = logger or cls.logger
+        logger.info("Trying to get Amadeus API token...")
+        if not api_key or not api_secret:
+            raise PermanentTokenError("Cannot refresh Amadeus Session. No api key and/or secret set")
+        try:
+            resp = sess.post(
+                url,
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                data={
+                    "grant_type": "client_credentials",
+                    "client_id": api_key,
+                    "client_secret": api_secret
+                },
+                timeout=timeout_s
+            )
+        except RequestException as e:
+            logger.error(f"Failed to get Amadeus token from `{url}`: {type(e).__name__}: {e}")
+            return
+        if resp.status_code == 401:
+            raise PermanentTokenError(f"Amadeus rejected the api key and/or secret: [{resp.status_code}] {resp.text}")
         if not resp.ok:
-            self.logger.error(f"Failed to get Amadeus token from `{url}`:"
-                              f"[{resp.status_code}] {resp.text}")
+            logger.error(f"Failed to get Amadeus token from `{url}`:"
+                         f"[{resp.status_code}] {resp.text}")
             return
-        if not (token := resp.json().get("access_token")):
-            self.logger.error(f"Response does not contain access token! Resp:\n{resp.text}")
+        body = resp.json()
+        if not (token := body.get("access_token")):
+            logger.error(f"Response does not contain access token! Resp:\n{resp.text}")
             return
-        self._access_token = token
-        self._initialized = True
-        self._token_expiry = datetime.now() + timedelta(minutes=30)
-        self.logger.info("Amadeus access token set!")
+        lifetime_s = body.get("expires_in") or cls.TOKEN_LIFETIME.total_seconds()
+        logger.info("Amadeus access token set!")
+        return AccessToken(value=token, expires_at=time.time() + lifetime_s)
+
+    @staticmethod
+    def flight_offers_params(depart: Airport, arrive: Airport, date: datetime, query: FlightSearchQuery) -> dict:
+        return {
+            "originLocationCode": depart.iata_code,
+            "destinationLocationCode": arrive.iata_code,
+            "departureDate": date.strftime("%Y-%m-%d"),
+            "adults": query.passengers,
+            "currencyCode": query.budget.currency,
+            "maxPrice": int(query.budget.amount),
+            "nonStop": "true" if query.max_journey_legs <= 1 else "false"
+        }
+
+    @staticmethod
+    def flight_offers_key(params: dict) -> str:
+        # Every parameter which shapes the response, in a fixed order
+        return "flight-offers?" + "&".join(f"{name}={params[name]}" for name in sorted(params))
+
+    def cached_flight_offers(self, params: dict, query: FlightSearchQuery) -> nullable(list[dict]):
+        if self.cache is None or query.bypass_cache:
+            return
+        return self.cache.get(self.flight_offers_key(params))
+
+    def cache_flight_offers(self, params: dict, offers: list[dict]):
+        if self.cache is not None:
+            self.cache.put(self.flight_offers_key(params), offers)
+
+    def get_flight_offers(self, depart: Airport, arrive: Airport, date: datetime,
+                          query: FlightSearchQuery) -> FlightOffers:
+        params = self.flight_offers_params(depart, arrive, date, query)
+        rv = FlightOffers(departs_from=depart, arrives_at=arrive, departure_date=date)
+        if (cached := self.cached_flight_offers(params, query)) is not None:
+            rv.offers = cached
+            return rv
+        key = self.flight_offers_key(params)
+        with self._in_flight_lock:
+            shared = self._in_flight.get(key)
+            if leader := shared is None:
+                shared = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                shared.set_result(self._fetch_flight_offers(params))
+            except Exception as e:
+                shared.set_exception(e)
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight.pop(key, None)
+        offers, rv.error = shared.result()
+        rv.offers = list(offers)
+        return rv
+
+    def _fetch_flight_offers(self, params: dict) -> tuple[list[dict], nullable(str)]:
+        resp = self._request(self._build_url("v2", "shopping", "flight-offers"), params=params)
+        if not resp.ok:
+            return [], f"[{resp.status_code}] {resp.text}"
+        offers = resp.json().get("data", [])
+        self.cache_flight_offers(params, offers)
+        return offers, None
 
     def find_flights_o2o(self, depart: Airport, arrive: Airport, budget: Money, dates: list[datetime],
                          channel: Channel):
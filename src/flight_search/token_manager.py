@@ -0,0 +1,220 @@
+import dataclasses
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Condition, Event, Thread
+from typing import Callable, Iterator
+
+try:
+    import fcntl
+    fcntl_exists: bool = True
+except ImportError:
+    fcntl = None
+    fcntl_exists = False
+
+from util.logging.logger import Logger, get_default_logger
+from util.types import nullable, const
+
+
+class PermanentTokenError(Exception):
+    # Raised by a TokenManager's `fetch` when retrying cannot help, e.g. without credentials
+    ...
+
+
+@dataclasses.dataclass
+class AccessToken:
+    value: str
+    expires_at: float  # unix time
+
+    def valid_for(self, seconds: float) -> bool:
+        return self.expires_at - time.time() > seconds
+
+
+class SharedTokenFile:
+    """
+    A token cache file which worker processes on the same host share, so that only one of them has to fetch a token.
+    Writers hold an exclusive lock (fcntl, on a sibling `.lock` file) while they check and refresh the token. Without
+    fcntl (i.e. not on POSIX) the file is still shared, just not locked.
+    """
+
+    logger: Logger = get_default_logger()
+
+    def __init__(self, path: Path, logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        self.path: Path = path
+        self._lock_path: Path = path.with_name(path.name + ".lock")
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        if not fcntl_exists:
+            yield
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._lock_path, "a+") as h:
+            fcntl.flock(h, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(h, fcntl.LOCK_UN)
+
+    def read(self) -> nullable(AccessToken):
+        try:
+            with open(self.path) as h:
+                data = json.load(h)
+            return AccessToken(value=data["access_token"], expires_at=float(data["expires_at"]))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable token cache `{self.path}`: {e}")
+            return
+
+    def write(self, token: AccessToken):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            # The token is a credential: only the owner may read it
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as h:
+                json.dump({"access_token": token.value, "expires_at": token.expires_at}, h)
+            tmp.replace(self.path)
+        except Exception as e:
+            self.logger.error(f"Failed to save token cache `{self.path}`. error: {e}")
+
+
+class TokenManager:
+    """
+    Hands out a valid OAuth access token to any number of threads:
+        - refreshes are single-flight: one caller fetches, concurrent callers wait for its result
+        - with `start`, a background thread replaces the token `refresh_margin_s` before it expires, so callers never
+          wait for a refresh while it keeps succeeding
+        - with a `cache_file`, processes share the token: a fresh token in the file is used instead of fetching one
+    `fetch` obtains a new token, or returns None on failure. It raises PermanentTokenError if retrying cannot help:
+    the manager then stops fetching, and the background thread exits.
+    """
+
+    logger: Logger = get_default_logger()
+
+    # A token this close to its expiry is not handed out anymore, so that it cannot expire in flight
+    MIN_VALIDITY_S: const(float) = 5.
+    # The background thread retries failed refreshes after RETRY_AFTER_S, doubling up to RETRY_MAX_S
+    RETRY_AFTER_S: const(float) = 10.
+    RETRY_MAX_S: const(float) = 600.
+
+    def __init__(self, fetch: Callable[[], nullable(AccessToken)], cache_file: Path = None,
+                 refresh_margin_s: float = 120., logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        self._fetch: Callable[[], nullable(AccessToken)] = fetch
+        self._file: nullable(SharedTokenFile) = SharedTokenFile(cache_file, logger=logger) if cache_file else None
+        self.refresh_margin_s: float = refresh_margin_s
+        self._token: nullable(AccessToken) = None
+        self._cond: Condition = Condition()
+        self._refreshing: bool = False
+        self._refreshes: int = 0
+        self._stop: Event = Event()
+        self._refresher: nullable(Thread) = None
+        self.fetches: int = 0
+        self.permanent_error: nullable(PermanentTokenError) = None
+
+    @property
+    def current(self) -> nullable(AccessToken):
+        return self._token
+
+    def token(self) -> nullable(str):
+        # Fast path: a valid token is returned without waiting, even while a background refresh is running
+        with self._cond:
+            while True:
+                if self._token is not None and self._token.valid_for(self.MIN_VALIDITY_S):
+                    return self._token.value
+                if self.permanent_error is not None:
+                    return
+                if not self._refreshing:
+                    break
+                refreshes = self._refreshes
+                self._cond.wait_for(lambda: self._refreshes != refreshes)
+                if self._token is None or not self._token.valid_for(self.MIN_VALIDITY_S):
+                    # The refresh everyone waited for failed; don't pile up more attempts behind it
+                    return
+        token = self.refresh()
+        return token.value if token else None
+
+    def refresh(self, min_validity_s: float = None) -> nullable(AccessToken):
+        """
+        Single-flight refresh. Returns the new token, or None if it failed (the current token, if any, is kept).
+        A token shared through the cache file which is valid for `min_validity_s` (default: the refresh margin) is
+        taken over instead of fetching a new one.
+        """
+        with self._cond:
+            if self._refreshing:
+                refreshes = self._refreshes
+                self._cond.wait_for(lambda: self._refreshes != refreshes)
+                return self._token
+            self._refreshing = True
+        token = None
+        try:
+            token = self._obtain(self.refresh_margin_s if min_validity_s is None else min_validity_s)
+        except PermanentTokenError as e:
+            self.logger.error(f"Token refresh failed, not retrying: {e}")
+            self.permanent_error = e
+        except Exception as e:
+            self.logger.error(f"Token refresh failed: {type(e).__name__}: {e}")
+        finally:
+            with self._cond:
+                if token is not None:
+                    self._token = token
+                self._refreshing = False
+                self._refreshes += 1
+                self._cond.notify_all()
+        return token
+
+    def _obtain(self, min_validity_s: float) -> nullable(AccessToken):
+        if self._file is None:
+            return self._fetch_counted()
+        with self._file.locked():
+            if (shared := self._file.read()) is not None and shared.valid_for(min_validity_s):
+                self.logger.debug(f"Using the shared token from `{self._file.path}`")
+                return shared
+            if (token := self._fetch_counted()) is not None:
+                self._file.write(token)
+            return token
+
+    def _fetch_counted(self) -> nullable(AccessToken):
+        self.fetches += 1
+        return self._fetch()
+
+    def start(self):
+        # Daemon thread: a forgotten `stop` must not keep the process alive
+        if self._refresher is not None:
+            return
+        self._stop.clear()
+        self._refresher = Thread(target=self._refresh_loop, name="token-refresher", daemon=True)
+        self._refresher.start()
+
+    def stop(self, timeout: float = None):
+        if self._refresher is None:
+            return
+        self._stop.set()
+        self._refresher.join(timeout)
+        self._refresher = None
+
+    def _refresh_loop(self):
+        retry_s = self.RETRY_AFTER_S
+        while not self._stop.is_set():
+            token = self._token
+            wait_s = token.expires_at - self.refresh_margin_s - time.time() if token is not None else 0.
+            if wait_s > 0:
+                self._stop.wait(wait_s)
+                continue
+            token = self.refresh()
+            if self.permanent_error is not None:
+                return
+            if token is not None and token.valid_for(self.refresh_margin_s):
+                retry_s = self.RETRY_AFTER_S
+                continue
+            self.logger.warning(f"Retrying the token refresh in {retry_s:.0f}s")
+            self._stop.wait(retry_s)
+            retry_s = min(retry_s * 2, self.RETRY_MAX_S)
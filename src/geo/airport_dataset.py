@@ -0,0 +1,122 @@
+import hashlib
+from pathlib import Path
+
+import pandas as pd
+
+from src.flight_search.airport import Airport
+from util.logging.logger import Logger, get_default_logger
+from util.types import const, nullable
+
+
+class AirportDatasetLoader:
+    """
+    Reads the `;` separated airports dataset once, with explicit dtypes, into a columnar DataFrame.
+    The parsed frame is snapshotted (pickled) to `cache_location`, keyed by a hash of the source file, so later
+    startups skip parsing entirely. Any change to the source file changes the key, which invalidates the snapshot.
+    """
+
+    logger: Logger = get_default_logger()
+
+    COLUMNS: const(list[str]) = ['name', 'iso_country', 'iso_region', 'municipality', 'latitude', 'longitude',
+                                 'type', 'iata_code', 'local_code']
+    DTYPES: const(dict[str, str]) = {
+        'name': 'str',
+        'iso_country': 'str',
+        'iso_region': 'str',
+        'municipality': 'str',
+        'latitude': 'float64',
+        'longitude': 'float64',
+        'type': 'category',
+        'iata_code': 'str',
+        'local_code': 'str',
+    }
+    SNAPSHOT_VERSION: const(int) = 2
+
+    def __init__(self, cache_location: Path = None, logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        self._cache_location: nullable(Path) = cache_location
+
+    @staticmethod
+    def file_hash(path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as h:
+            while chunk := h.read(1 << 20):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def snapshot_path(self, path: Path) -> nullable(Path):
+        if self._cache_location is None:
+            return None
+        return self._cache_location / f"{path.stem}_v{self.SNAPSHOT_VERSION}_{self.file_hash(path)[:16]}.pkl"
+
+    def read_csv(self, path: Path) -> pd.DataFrame:
+        # keep_default_na=False keeps empty codes as '' and real codes like Namibia's `NA` as they are.
+        # Coordinates must parse exactly like `float()` did: `Airport.uid` hashes them, and the stored rows are keyed
+        # by those uids. pandas' default float parser is off by an ulp for many 17 digit values.
+        df = pd.read_csv(path, sep=';', header=0, names=self.COLUMNS, dtype=self.DTYPES,
+                         keep_default_na=False, na_values={'latitude': [''], 'longitude': ['']},
+                         float_precision='round_trip')
+        return df.dropna(subset=['latitude', 'longitude']).reset_index(drop=True)
+
+    def load(self, path: Path) -> pd.DataFrame:
+        snapshot = self.snapshot_path(path)
+        if snapshot is not None and snapshot.is_file():
+            try:
+                df = pd.read_pickle(snapshot)
+                self.logger.info(f"Loaded {len(df)} airports from snapshot `{snapshot}`")
+                return df
+            except Exception as e:
+                self.logger.error(f"Failed to load airports snapshot `{snapshot}`, re-reading `{path}`. error: {e}")
+
+        df = self.read_csv(path)
+        self.logger.info(f"Parsed {len(df)} airports from `{path}`")
+        if snapshot is not None:
+            try:
+                snapshot.parent.mkdir(parents=True, exist_ok=True)
+                tmp = snapshot.with_suffix(".tmp")
+                df.to_pickle(tmp)
+                tmp.replace(snapshot)
+                self.logger.debug(f"Airports snapshot saved to `{snapshot}`")
+            except Exception as e:
+                self.logger.error(f"Failed to save airports snapshot `{snapshot}`. error: {e}")
+        return df
+
+    @staticmethod
+    def filter(df: pd.DataFrame, closed: bool = False, small: bool = False, medium: bool = True,
+               require_iata: bool = False, unique: bool = False) -> pd.DataFrame:
+        excluded = set()
+        if not closed:
+            excluded.add('closed')
+        if not small:
+            excluded.add('small_airport')
+        if not medium:
+            excluded.add('medium_airport')
+        mask = ~df['type'].isin(excluded) & (df['name'] != '0')
+        if require_iata:
+            mask &= df['iata_code'] != ''
+        df = df[mask]
+        if unique:
+            # Same rule as `Airport.uid`: an airport is identified by its IATA code and its coordinates
+            df = df[~df.duplicated(subset=['iata_code', 'latitude', 'longitude'])]
+        return df
+
+    @staticmethod
+    def to_airports(df: pd.DataFrame) -> list[Airport]:
+        columns = (df[column].tolist() for column in AirportDatasetLoader.COLUMNS)
+        return [
+            Airport(
+                full_name=name,
+                iso_country=iso_country,
+                iso_region=iso_region,
+                municipality=municipality,
+                latitude=latitude,
+                longitude=longitude,
+                size=size,
+                iata_code=iata_code,
+                local_code=local_code
+            )
+            for name, iso_country, iso_region, municipality, latitude, longitude, size, iata_code, local_code
+            in zip(*columns)
+        ]
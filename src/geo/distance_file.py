@@ -0,0 +1,185 @@
+import mmap
+import struct
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from src.flight_search.airport import Airport
+from util.logging.logger import Logger, get_default_logger
+from util.math import batch_distance_km
+from util.types import const, nullable
+
+
+class DistanceMatrixFile:
+    """
+    A compact on-disk store for the airport distance matrix, opened with mmap.
+    Layout (little-endian):
+        - header: magic, format version, airport count N, length of the uid block in bytes
+        - uid block: the airport uids in ordinal order, utf-8 encoded and newline separated, padded to 4 bytes
+        - the upper-triangular matrix (diagonal excluded) as packed float32 kilometres, row by row
+    A lookup by uid pair is a dict lookup plus one array index, without any DB round trip.
+    Storing float32 bounds the error against the float64 source to FLOAT32_TOLERANCE_KM.
+    """
+
+    logger: Logger = get_default_logger()
+
+    MAGIC: const(bytes) = b"FSDM"
+    VERSION: const(int) = 1
+    FLOAT32_TOLERANCE_KM: const(float) = 0.005
+    _HEADER: const(struct.Struct) = struct.Struct("<4sHHIQ")
+
+    def __init__(self, path: Path, logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        self.path: Path = path
+        self._file = open(path, "rb")
+        self._mm: mmap.mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, n, uid_block_len = self._HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError(f"`{path}` is not a v{self.VERSION} distance matrix file ({magic=}, {version=})")
+        uid_block_start = self._HEADER.size
+        uid_block = self._mm[uid_block_start:uid_block_start + uid_block_len].decode("utf-8")
+        self.uids: list[str] = uid_block.split("\n") if n else []
+        self._index: dict[str, int] = {uid: i for i, uid in enumerate(self.uids)}
+        self._data: np.ndarray = np.frombuffer(
+            self._mm, dtype="<f4", count=n * (n - 1) // 2,
+            offset=self._data_offset(uid_block_len)
+        )
+
+    @classmethod
+    def _data_offset(cls, uid_block_len: int) -> int:
+        return cls._HEADER.size + uid_block_len + (-(cls._HEADER.size + uid_block_len) % 4)
+
+    @staticmethod
+    def condensed_index(i: int, j: int, n: int) -> int:
+        if i > j:
+            i, j = j, i
+        return i * (2 * n - i - 1) // 2 + (j - i - 1)
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def __enter__(self) -> 'DistanceMatrixFile':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        # Views into the map must be released before it can be closed
+        self._data = None
+        self._mm.close()
+        self._file.close()
+
+    def index_of(self, uid: str) -> nullable(int):
+        return self._index.get(uid)
+
+    def distance_by_index(self, i: int, j: int) -> float:
+        if i == j:
+            return 0.
+        return float(self._data[self.condensed_index(i, j, len(self))])
+
+    def distance(self, ap1_uid: str, ap2_uid: str) -> nullable(float):
+        i, j = self._index.get(ap1_uid), self._index.get(ap2_uid)
+        if i is None or j is None:
+            return None
+        return self.distance_by_index(i, j)
+
+    def row(self, i: int) -> np.ndarray:
+        n = len(self)
+        rv = np.zeros(n, dtype=np.float32)
+        # Column i of the rows above it, then row i to the right of the diagonal
+        above = np.arange(i)
+        rv[:i] = self._data[above * (2 * n - above - 1) // 2 + (i - above - 1)]
+        start = self.condensed_index(i, i + 1, n) if i < n - 1 else 0
+        rv[i + 1:] = self._data[start:start + n - i - 1]
+        return rv
+
+    def rows(self) -> Iterator[tuple[str, str, str, float]]:
+        # Rows in the airport_distance_mapping layout, e.g. to re-import the table with copy_distances
+        n = len(self)
+        offset = 0
+        for i, ap1_uid in enumerate(self.uids):
+            yield f"{ap1_uid}_{ap1_uid}", ap1_uid, ap1_uid, 0.
+            row = self._data[offset:offset + n - i - 1]
+            offset += n - i - 1
+            for ap2_uid, distance in zip(self.uids[i + 1:], row):
+                left_key, right_key = (ap1_uid, ap2_uid) if ap1_uid < ap2_uid else (ap2_uid, ap1_uid)
+                yield f"{left_key}_{right_key}", left_key, right_key, float(distance)
+
+    @classmethod
+    def _write_header(cls, h, uids: list[str]) -> int:
+        uid_block = "\n".join(uids).encode("utf-8")
+        h.write(cls._HEADER.pack(cls.MAGIC, cls.VERSION, 0, len(uids), len(uid_block)))
+        h.write(uid_block)
+        padding = cls._data_offset(len(uid_block)) - cls._HEADER.size - len(uid_block)
+        h.write(b"\0" * padding)
+        return len(uid_block)
+
+    @classmethod
+    def build(cls, path: Path, airports: list[Airport], logger: Logger = None) -> 'DistanceMatrixFile':
+        logger = logger or cls.logger
+        logger.info(f"Building distance matrix file `{path}` for {len(airports)} airports...")
+        uids = [ap.uid for ap in airports]
+        if len(set(uids)) != len(uids):
+            raise ValueError("Airport uids must be unique to build a distance matrix file")
+        lats = np.fromiter((ap.latitude for ap in airports), dtype=np.float64, count=len(airports))
+        lons = np.fromiter((ap.longitude for ap in airports), dtype=np.float64, count=len(airports))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as h:
+            cls._write_header(h, uids)
+            for i in range(len(airports) - 1):
+                row = batch_distance_km((lats[i], lons[i]), lats[i + 1:], lons[i + 1:])
+                h.write(row.astype("<f4").tobytes())
+        return cls(path, logger=logger)
+
+    @classmethod
+    def from_pairs(cls, path: Path, uids: list[str], distances: Iterable[tuple[str, str, float]],
+                   logger: Logger = None) -> 'DistanceMatrixFile':
+        # `distances` are (uid, uid, km) rows, e.g. exported from the DB with `iter_distances`
+        logger = logger or cls.logger
+        n = len(uids)
+        index = {uid: i for i, uid in enumerate(uids)}
+        data = np.full(n * (n - 1) // 2, np.nan, dtype="<f4")
+        logger.info(f"Writing distances for {n} airports to `{path}`...")
+        for ap1, ap2, distance in distances:
+            i, j = index.get(ap1), index.get(ap2)
+            if i is None or j is None or i == j:
+                continue
+            data[cls.condensed_index(i, j, n)] = distance
+        if missing := int(np.isnan(data).sum()):
+            logger.warning(f"{missing} pairs are missing from the distances and are stored as NaN")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as h:
+            cls._write_header(h, uids)
+            h.write(data.tobytes())
+        return cls(path, logger=logger)
+
+    def verify(self, distances: Iterable[tuple[str, str, float]], tolerance_km: float = FLOAT32_TOLERANCE_KM) -> bool:
+        # `distances` are (uid, uid, km) rows, e.g. the DB's `iter_distances`
+        self.logger.info(f"Verifying distance matrix file `{self.path}` against the stored distances...")
+        n = len(self)
+        seen = np.zeros(len(self._data), dtype=bool)
+        mismatched = 0
+        for ap1, ap2, distance in distances:
+            i, j = self._index.get(ap1), self._index.get(ap2)
+            if i is None or j is None or i == j:
+                continue
+            k = self.condensed_index(i, j, n)
+            seen[k] = True
+            if not abs(float(self._data[k]) - distance) <= tolerance_km:
+                mismatched += 1
+                if mismatched <= 10:
+                    self.logger.warning(f"Distance mismatch {ap1} -> {ap2}: file {self._data[k]:.3f}km, "
+                                        f"stored {distance:.3f}km")
+        missing = int((~seen).sum())
+        if mismatched or missing:
+            self.logger.error(f"Distance matrix file verification failed: {mismatched} mismatched pairs, "
+                              f"{missing} pairs missing from the stored distances")
+            return False
+        self.logger.info(f"Distance matrix file matches the stored distances for all {len(self._data)} pairs")
+        return True
@@ -0,0 +1,117 @@
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from src.flight_search.airport import Airport
+from src.flight_search.airport_table import AirportTable
+from src.geo.distance_file import DistanceMatrixFile
+from util.logging.logger import Logger, get_default_logger
+from util.math import batch_distance_km
+from util.types import nullable
+
+
+class DistanceMatrix:
+    """
+    An in-memory airport distance matrix keyed by integer airport ids (the ordinal of each uid in `uids`).
+    Every row also keeps its neighbours pre-sorted by distance, so `distance`, `k_nearest` and `within` are answered
+    with array indexing and a binary search instead of a DB round trip.
+    """
+
+    logger: Logger = get_default_logger()
+
+    def __init__(self, uids: list[str], distances: np.ndarray, logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        n = len(uids)
+        if distances.shape != (n, n):
+            raise ValueError(f"Expected a {n}x{n} distance matrix, got {distances.shape}")
+        self.uids: list[str] = list(uids)
+        self._index: dict[str, int] = {uid: i for i, uid in enumerate(self.uids)}
+        self._distances: np.ndarray = distances.astype(np.float32, copy=False)
+        id_dtype = np.int16 if n <= np.iinfo(np.int16).max else np.int32
+        self._neighbours: np.ndarray = np.argsort(self._distances, axis=1, kind="stable").astype(id_dtype)
+        self._sorted_distances: np.ndarray = np.take_along_axis(self._distances, self._neighbours, axis=1)
+        self.logger.info(f"Distance matrix ready for {n} airports")
+
+    @classmethod
+    def from_coordinates(cls, uids: list[str], lats: np.ndarray, lons: np.ndarray,
+                         logger: Logger = None) -> 'DistanceMatrix':
+        n = len(uids)
+        distances = np.zeros((n, n), dtype=np.float32)
+        for i in range(n - 1):
+            row = batch_distance_km((lats[i], lons[i]), lats[i + 1:], lons[i + 1:])
+            distances[i, i + 1:] = row
+            distances[i + 1:, i] = row
+        return cls(uids, distances, logger=logger)
+
+    @classmethod
+    def from_airports(cls, airports: list[Airport], logger: Logger = None) -> 'DistanceMatrix':
+        n = len(airports)
+        lats = np.fromiter((ap.latitude for ap in airports), dtype=np.float64, count=n)
+        lons = np.fromiter((ap.longitude for ap in airports), dtype=np.float64, count=n)
+        return cls.from_coordinates([ap.uid for ap in airports], lats, lons, logger=logger)
+
+    @classmethod
+    def from_table(cls, table: AirportTable, logger: Logger = None) -> 'DistanceMatrix':
+        # Matrix ids are the table's ids
+        return cls.from_coordinates(table.uids, table.latitudes, table.longitudes, logger=logger)
+
+    @classmethod
+    def from_file(cls, file: DistanceMatrixFile | Path, logger: Logger = None) -> 'DistanceMatrix':
+        opened = not isinstance(file, DistanceMatrixFile)
+        if opened:
+            file = DistanceMatrixFile(file, logger=logger)
+        try:
+            distances = np.empty((len(file), len(file)), dtype=np.float32)
+            for i in range(len(file)):
+                distances[i] = file.row(i)
+            return cls(file.uids, distances, logger=logger)
+        finally:
+            if opened:
+                file.close()
+
+    @classmethod
+    def from_pairs(cls, uids: list[str], distances: Iterable[tuple[str, str, float]],
+                   logger: Logger = None) -> 'DistanceMatrix':
+        # `distances` are (uid, uid, km) rows, e.g. the DB's `iter_distances`
+        n = len(uids)
+        index = {uid: i for i, uid in enumerate(uids)}
+        matrix = np.full((n, n), np.inf, dtype=np.float32)
+        np.fill_diagonal(matrix, 0.)
+        for ap1, ap2, distance in distances:
+            i, j = index.get(ap1), index.get(ap2)
+            if i is not None and j is not None:
+                matrix[i, j] = matrix[j, i] = distance
+        if missing := int(np.isinf(matrix).sum()) // 2:
+            (logger or cls.logger).warning(f"{missing} pairs are missing and are treated as unreachable")
+        return cls(uids, matrix, logger=logger)
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def id_of(self, uid: str) -> nullable(int):
+        return self._index.get(uid)
+
+    def uid_of(self, ap_id: int) -> str:
+        return self.uids[ap_id]
+
+    def distance(self, a: int, b: int) -> float:
+        return float(self._distances[a, b])
+
+    def row(self, a: int) -> np.ndarray:
+        return self._distances[a]
+
+    def k_nearest(self, a: int, k: int) -> tuple[np.ndarray, np.ndarray]:
+        ids = self._neighbours[a, :k + 1]
+        dists = self._sorted_distances[a, :k + 1]
+        keep = ids != a
+        return ids[keep][:k], dists[keep][:k]
+
+    def within(self, a: int, km: float) -> tuple[np.ndarray, np.ndarray]:
+        end = int(np.searchsorted(self._sorted_distances[a], km, side="right"))
+        ids = self._neighbours[a, :end]
+        dists = self._sorted_distances[a, :end]
+        keep = ids != a
+        return ids[keep], dists[keep]
@@ -0,0 +1,358 @@
+import heapq
+import math
+
+import numpy as np
+
+from util.math import (batch_distance_km, chord_for_km, geodesic_distance_km, km_for_chord, to_unit_vectors,
+                       within_radius_km, PairDistanceCache, SPHERICAL_MAX_RELATIVE_ERROR)
+from util.types import const, nullable
+
+
+class SphericalKDTree:
+    """
+    A KD-tree over airport coordinates projected onto the unit sphere as 3D vectors. Straight-line (chord) distance
+    between the vectors is monotonic in great-circle distance and has no seams, so the antimeridian and the poles
+    need no special handling.
+    The tree prunes by chord distance with a margin of SPHERICAL_MAX_RELATIVE_ERROR (the worst-case gap between the
+    sphere and WGS-84), and only the surviving candidates get an exact geodesic distance, which is what queries return.
+    Points are identified by their insertion order. Inserted points are kept in a pending buffer, scanned linearly,
+    until the buffer outgrows `rebuild_threshold` (or sqrt(n)), at which point the tree is rebuilt on the next query.
+    """
+
+    LEAF_SIZE: const(int) = 16
+    # Batch queries are grouped by the subtree they descend into; each group shares one candidate scan
+    BATCH_GROUP_SIZE: const(int) = 32
+    BATCH_CHUNK_SIZE: const(int) = 512
+    # Absorbs the rounding of chords computed from dot products (~1e-8, i.e. centimetres on the unit sphere)
+    _CHORD_SLACK: const(float) = 1e-7
+
+    def __init__(self, lats: np.ndarray = None, lons: np.ndarray = None, leaf_size: int = LEAF_SIZE,
+                 rebuild_threshold: int = 64):
+        self._leaf_size: int = leaf_size
+        self._rebuild_threshold: int = rebuild_threshold
+        self._n: int = 0
+        self._lat_buf: np.ndarray = np.empty(0, dtype=np.float64)
+        self._lon_buf: np.ndarray = np.empty(0, dtype=np.float64)
+        self._xyz_buf: np.ndarray = np.empty((0, 3), dtype=np.float64)
+        self._pending_from: int = 0
+
+        self._perm: np.ndarray = np.empty(0, dtype=np.int64)
+        self._node_lo: np.ndarray = np.empty((0, 3))
+        self._node_hi: np.ndarray = np.empty((0, 3))
+        self._node_start: np.ndarray = np.empty(0, dtype=np.int64)
+        self._node_end: np.ndarray = np.empty(0, dtype=np.int64)
+        self._node_left: np.ndarray = np.empty(0, dtype=np.int64)
+        self._node_right: np.ndarray = np.empty(0, dtype=np.int64)
+        self._node_parent: np.ndarray = np.empty(0, dtype=np.int64)
+        self._split_dim: np.ndarray = np.empty(0, dtype=np.int64)
+        self._split_val: np.ndarray = np.empty(0)
+        self._boxes_lo: list[list[float]] = []
+        self._boxes_hi: list[list[float]] = []
+        self._children: list[tuple[int, int]] = []
+        self._leaf_ids: list[nullable(np.ndarray)] = []
+
+        if lats is not None and lons is not None:
+            self.extend(lats, lons)
+            self.rebuild()
+
+    def __len__(self) -> int:
+        return self._n
+
+    @property
+    def lats(self) -> np.ndarray:
+        return self._lat_buf[:self._n]
+
+    @property
+    def lons(self) -> np.ndarray:
+        return self._lon_buf[:self._n]
+
+    @property
+    def xyz(self) -> np.ndarray:
+        return self._xyz_buf[:self._n]
+
+    def _reserve(self, extra: int):
+        if self._n + extra <= len(self._lat_buf):
+            return
+        capacity = max(self._n + extra, 2 * len(self._lat_buf), 64)
+        for name in ('_lat_buf', '_lon_buf', '_xyz_buf'):
+            old = getattr(self, name)
+            new = np.empty((capacity, *old.shape[1:]), dtype=old.dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, name, new)
+
+    def extend(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        self._reserve(len(lats))
+        start, end = self._n, self._n + len(lats)
+        self._lat_buf[start:end] = lats
+        self._lon_buf[start:end] = lons
+        self._xyz_buf[start:end] = to_unit_vectors(lats, lons)
+        self._n = end
+        return np.arange(start, end)
+
+    def insert(self, lat: float, lon: float) -> int:
+        return int(self.extend([lat], [lon])[0])
+
+    @property
+    def pending(self) -> int:
+        return self._n - self._pending_from
+
+    def rebuild(self):
+        n = self._n
+        xyz = self.xyz
+        perm = np.arange(n)
+        lo, hi, start, end, left, right, parent, split_dim, split_val = [], [], [], [], [], [], [], [], []
+
+        def new_node(s: int, e: int, parent_: int) -> int:
+            pts = xyz[perm[s:e]]
+            lo.append(pts.min(axis=0))
+            hi.append(pts.max(axis=0))
+            start.append(s)
+            end.append(e)
+            left.append(-1)
+            right.append(-1)
+            parent.append(parent_)
+            split_dim.append(0)
+            split_val.append(0.)
+            return len(start) - 1
+
+        if n:
+            stack = [new_node(0, n, -1)]
+            while stack:
+                node = stack.pop()
+                s, e = start[node], end[node]
+                if e - s <= self._leaf_size:
+                    continue
+                dim = int(np.argmax(hi[node] - lo[node]))
+                mid = (s + e) // 2
+                segment = perm[s:e]
+                perm[s:e] = segment[np.argpartition(xyz[segment, dim], mid - s)]
+                split_dim[node], split_val[node] = dim, float(xyz[perm[mid], dim])
+                left[node] = new_node(s, mid, node)
+                right[node] = new_node(mid, e, node)
+                stack.extend((left[node], right[node]))
+
+        self._perm = perm
+        self._node_lo = np.array(lo).reshape(-1, 3)
+        self._node_hi = np.array(hi).reshape(-1, 3)
+        self._boxes_lo = self._node_lo.tolist()
+        self._boxes_hi = self._node_hi.tolist()
+        self._node_start = np.array(start, dtype=np.int64)
+        self._node_end = np.array(end, dtype=np.int64)
+        self._node_left = np.array(left, dtype=np.int64)
+        self._node_right = np.array(right, dtype=np.int64)
+        self._node_parent = np.array(parent, dtype=np.int64)
+        self._split_dim = np.array(split_dim, dtype=np.int64)
+        self._split_val = np.array(split_val, dtype=np.float64)
+        self._children = list(zip(left, right))
+        self._leaf_ids = [self._perm[s:e] if l < 0 else None for s, e, l in zip(start, end, left)]
+        self._pending_from = n
+
+    def _maybe_rebuild(self):
+        if self.pending > max(self._rebuild_threshold, int(np.sqrt(self._n))):
+            self.rebuild()
+
+    def _box_distance(self, node: int, q: tuple[float, float, float]) -> float:
+        # Plain floats: traversal touches one box at a time, where numpy's per-call overhead dominates
+        total = 0.
+        for lo, hi, x in zip(self._boxes_lo[node], self._boxes_hi[node], q):
+            if x < lo:
+                total += (lo - x) ** 2
+            elif x > hi:
+                total += (x - hi) ** 2
+        return math.sqrt(total)
+
+    def _pending_ids(self) -> np.ndarray:
+        return np.arange(self._pending_from, self._n)
+
+    def _within_chord(self, q: np.ndarray, chord: float) -> np.ndarray:
+        xyz = self.xyz
+        q_ = tuple(q.tolist())
+        found = []
+        stack = [0] if self._children else []
+        while stack:
+            node = stack.pop()
+            if self._box_distance(node, q_) > chord:
+                continue
+            if (ids := self._leaf_ids[node]) is not None:
+                found.append(ids[np.linalg.norm(xyz[ids] - q, axis=1) <= chord])
+            else:
+                stack.extend(self._children[node])
+        if self.pending:
+            ids = self._pending_ids()
+            found.append(ids[np.linalg.norm(xyz[ids] - q, axis=1) <= chord])
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def _kth_chord(self, q: np.ndarray, k: int) -> float:
+        # Best-first search for the chord distance of the k-th nearest point
+        xyz = self.xyz
+        best = np.full(k, np.inf)
+
+        def merge(ids: np.ndarray):
+            nonlocal best
+            merged = np.concatenate((best, np.linalg.norm(xyz[ids] - q, axis=1)))
+            best = np.sort(merged)[:k]
+
+        if self.pending:
+            merge(self._pending_ids())
+        q_ = tuple(q.tolist())
+        heap = [(0., 0)] if self._children else []
+        while heap:
+            box_distance, node = heapq.heappop(heap)
+            if box_distance > best[-1]:
+                break
+            if (ids := self._leaf_ids[node]) is not None:
+                merge(ids)
+            else:
+                for child in self._children[node]:
+                    heapq.heappush(heap, (self._box_distance(child, q_), child))
+        return float(best[-1])
+
+    def _exact(self, lat: float, lon: float, ids: np.ndarray) -> np.ndarray:
+        return batch_distance_km((lat, lon), self.lats[ids], self.lons[ids])
+
+    @staticmethod
+    def _sorted(ids: np.ndarray, dists: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        order = np.argsort(dists, kind="stable")
+        return ids[order], dists[order]
+
+    def query_radius(self, lat: float, lon: float, radius_km: float, exact: bool = True,
+                     cache: PairDistanceCache = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Ids and geodesic distances (km, ascending) of every point within `radius_km` of (lat, lon).
+        The tree's candidates go through `within_radius_km`, so only the ones the haversine bound cannot settle are
+        solved exactly, unless `exact` asks for exact distances on all the results.
+        """
+        self._maybe_rebuild()
+        q = to_unit_vectors(lat, lon)
+        chord = chord_for_km(radius_km / (1 - SPHERICAL_MAX_RELATIVE_ERROR))
+        ids = self._within_chord(q, chord)
+        keep, dists = within_radius_km((lat, lon), self.lats[ids], self.lons[ids], radius_km, exact=exact, cache=cache)
+        return self._sorted(ids[keep], dists)
+
+    def query_knn(self, lat: float, lon: float, k: int,
+                  max_km: nullable(float) = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Ids and geodesic distances (km, ascending) of the `k` points nearest to (lat, lon), optionally limited to
+        `max_km`. The k-th nearest by chord bounds the search radius; everything the sphere/ellipsoid error margin
+        could reorder past it is checked with an exact distance.
+        """
+        self._maybe_rebuild()
+        if k <= 0 or not self._n:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        q = to_unit_vectors(lat, lon)
+        kth_km = km_for_chord(self._kth_chord(q, min(k, self._n)))
+        search_km = kth_km * (1 + SPHERICAL_MAX_RELATIVE_ERROR) / (1 - SPHERICAL_MAX_RELATIVE_ERROR)
+        if max_km is not None:
+            search_km = min(search_km, max_km / (1 - SPHERICAL_MAX_RELATIVE_ERROR))
+        ids = self._within_chord(q, chord_for_km(search_km))
+        dists = self._exact(lat, lon, ids)
+        if max_km is not None:
+            keep = dists <= max_km
+            ids, dists = ids[keep], dists[keep]
+        ids, dists = self._sorted(ids, dists)
+        return ids[:k], dists[:k]
+
+    def _descend(self, q: np.ndarray) -> np.ndarray:
+        # Leaf node each of the (m, 3) query vectors falls into, walking all of them down the tree level by level
+        node = np.zeros(len(q), dtype=np.int64)
+        while (inner := np.nonzero(self._node_left[node] >= 0)[0]).size:
+            at = node[inner]
+            go_right = q[inner, self._split_dim[at]] >= self._split_val[at]
+            node[inner] = np.where(go_right, self._node_right[at], self._node_left[at])
+        return node
+
+    def _group_nodes(self, min_points: int) -> np.ndarray:
+        # For every node, its deepest ancestor (or itself) holding at least `min_points` points.
+        # Parents are always created before their children, so one forward pass suffices.
+        counts = (self._node_end - self._node_start).tolist()
+        parents = self._node_parent.tolist()
+        rv = [0] * len(counts)
+        for node in range(1, len(counts)):
+            rv[node] = node if counts[node] >= min_points else rv[parents[node]]
+        return np.array(rv, dtype=np.int64)
+
+    def _node_ids(self, nodes: np.ndarray) -> np.ndarray:
+        return np.concatenate([self._perm[s:e] for s, e in zip(self._node_start[nodes], self._node_end[nodes])])
+
+    @staticmethod
+    def _chords(q: np.ndarray, points: np.ndarray) -> np.ndarray:
+        # |a - b|^2 = 2 - 2 a.b for unit vectors, which turns the whole block into one matrix product
+        return np.sqrt(np.maximum(2. - 2. * (q @ points.T), 0.))
+
+    @classmethod
+    def _search_chord(cls, kth_chord: np.ndarray) -> np.ndarray:
+        # Everything the sphere/ellipsoid error margin could reorder past the k-th nearest by chord
+        search_km = km_for_chord(kth_chord) * (1 + SPHERICAL_MAX_RELATIVE_ERROR) / (1 - SPHERICAL_MAX_RELATIVE_ERROR)
+        return chord_for_km(search_km) + cls._CHORD_SLACK
+
+    def query_knn_batch(self, lats: np.ndarray, lons: np.ndarray, k: int,
+                        max_km: nullable(float) = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized `query_knn` for many points at once. Returns (m, k) arrays of ids and geodesic distances (km,
+        ascending per row), padded with -1 and inf where fewer than `k` points qualify.
+        Queries are walked down the tree together and grouped by the subtree they land in. Each group bounds every
+        member's k-th neighbour from the points of that subtree, collects the leaves any member could reach, and
+        computes exact distances only for the candidates inside each member's error-margin search radius.
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        m = len(lats)
+        ids_out = np.full((m, max(k, 0)), -1, dtype=np.int64)
+        dists_out = np.full((m, max(k, 0)), np.inf)
+        if k <= 0 or not m or not self._n:
+            return ids_out, dists_out
+        if self.pending:
+            self.rebuild()
+
+        k_eff = min(k, self._n)
+        if max_km is not None:
+            max_chord = chord_for_km(max_km / (1 - SPHERICAL_MAX_RELATIVE_ERROR)) + self._CHORD_SLACK
+        xyz, tree_lats, tree_lons = self.xyz, self.lats, self.lons
+        q = to_unit_vectors(lats, lons)
+        leaves = np.nonzero(self._node_left < 0)[0]
+        leaf_lo, leaf_hi = self._node_lo[leaves], self._node_hi[leaves]
+        landed = self._descend(q)
+        groups = self._group_nodes(max(k_eff, self.BATCH_GROUP_SIZE))[landed]
+
+        # By group, then by leaf, so that every chunk of a group covers a compact part of it
+        order = np.lexsort((landed, groups))
+        bounds = np.flatnonzero(np.diff(groups[order])) + 1
+        for members in np.split(order, bounds):
+            group_ids = self._node_ids(groups[members[:1]])
+            for qi in np.array_split(members, -(-len(members) // self.BATCH_CHUNK_SIZE)):
+                qv = q[qi]
+                # Upper bound for each member's k-th neighbour, from the points of its own subtree
+                chords = self._chords(qv, xyz[group_ids])
+                kth = np.partition(chords, k_eff - 1, axis=1)[:, k_eff - 1] + self._CHORD_SLACK
+                search_chord = self._search_chord(kth)
+                if max_km is not None:
+                    search_chord = np.minimum(search_chord, max_chord)
+
+                # Leaves within reach of any member, then the candidates within each member's own radius
+                gap = np.maximum(0., np.maximum(leaf_lo - qv.max(axis=0), qv.min(axis=0) - leaf_hi))
+                reachable = leaves[np.linalg.norm(gap, axis=1) <= search_chord.max()]
+                if not reachable.size:
+                    continue
+                cand = self._node_ids(reachable)
+                chords = self._chords(qv, xyz[cand])
+                # The candidates hold every member's true k nearest by chord, which tightens the radius further
+                width = min(k_eff, len(cand))
+                kth = np.partition(chords, width - 1, axis=1)[:, width - 1] + self._CHORD_SLACK
+                search_chord = np.minimum(search_chord, self._search_chord(kth))
+                rows, cols = np.nonzero(chords <= search_chord[:, None])
+                cand = cand[cols]
+                exact = geodesic_distance_km(lats[qi[rows]], lons[qi[rows]], tree_lats[cand], tree_lons[cand])
+                if max_km is not None:
+                    keep = exact <= max_km
+                    rows, cand, exact = rows[keep], cand[keep], exact[keep]
+
+                # Rank the candidates of each query and keep its first k
+                ranked = np.lexsort((cand, exact, rows))
+                rows, cand, exact = rows[ranked], cand[ranked], exact[ranked]
+                rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+                top = rank < k_eff
+                ids_out[qi[rows[top]], rank[top]] = cand[top]
+                dists_out[qi[rows[top]], rank[top]] = exact[top]
+        return ids_out, dists_out
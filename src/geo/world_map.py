@@ -1,13 +1,18 @@
 import dataclasses
 import math
 from functools import lru_cache
-from typing import Iterator
+from typing import Callable, Iterator
 
+import numpy as np
 import pandas as pd
 
 from src.flight_search.airport import Airport
+from src.flight_search.airport_table import AirportTable
+from src.geo.airport_dataset import AirportDatasetLoader
+from src.geo.spatial_index import SphericalKDTree
 from util.logging.logger import Logger, get_default_logger
-from util.types import const
+from util.math import within_radius_km, PairDistanceCache
+from util.types import const, nullable
 
 
 class Bounds:
@@ -63,32 +68,40 @@ class Field:
 
 
 class WorldMap:
+    """
+    Airports on a sparse lat/lon grid, with a spatial index for radius and nearest-airport queries.
+    Populated from an AirportTable, the map's airport ids are the table's ids (and those of a DistanceMatrix built
+    from the same table), so the `*_ids` queries take and return table ids and never build Airport objects.
+    """
 
     logger: Logger = get_default_logger()
 
     KM_PER_SQUARE: const(float) = 12.5
+    DISTANCE_CACHE_SIZE: const(int) = 100_000
 
-    def __init__(self, data: pd.DataFrame = None, logger: Logger = None):
+    def __init__(self, data: pd.DataFrame = None, neighbors: Callable[[str, float], nullable(list[tuple[str, float]])] = None,
+                 table: AirportTable = None, logger: Logger = None):
         if logger:
             self.logger: Logger = logger
             self.__class__.logger = logger
-        self._map: list[list[Field]] = self._build_default_map()
+        # Sparse grid: only cells holding at least one airport are materialized
+        self._map: dict[tuple[int, int], Field] = {}
+        # Spatial index over the same airports, in insertion order. Replaced airports keep their id.
+        self._index: SphericalKDTree = SphericalKDTree()
+        self._airports: list[Airport] = []
+        self._ids: dict[tuple[int, int, str], int] = {}
+        self._ids_by_uid: dict[str, int] = {}
+        # Precomputed neighbour lists (e.g. AirportNeighborsGateway.get_neighbors), when available, answer find_nearby
+        # with one indexed lookup
+        self._neighbors: Callable[[str, float], nullable(list[tuple[str, float]])] = neighbors
+        # Exact distances are keyed by coordinates, so they stay valid as airports come and go
+        self._distances: PairDistanceCache = PairDistanceCache(max_entries=self.DISTANCE_CACHE_SIZE)
+        self.table: nullable(AirportTable) = None
+        if table is not None:
+            self.populate_table(table)
         if data is not None:
             self.populate(data)
 
-    @classmethod
-    def _build_default_map(cls) -> list[list[Field]]:
-        _map: list[list[Field]] = []
-        max_lat_i, max_lon_i = cls.convert_ll_to_indexes(Bounds.max_lat, Bounds.max_lon)
-        cls.logger.debug(f"Building default map with bounds {max_lat_i=} {max_lon_i=}")
-        for lat_i in range(max_lat_i + 1):
-            row = []
-            for lon_i in range(max_lon_i + 1):
-                lat, lon = cls.convert_indexes_to_ll(lat_i, lon_i)
-                row.append(Field(lat=lat, lon=lon))
-            _map.append(row)
-        return _map
-
     @staticmethod
     def _get_min_lat_bound(lat: int, offset: int) -> int:
         min_bound = lat - offset
@@ -105,17 +118,26 @@ class WorldMap:
 
         return min_bound
 
-    def subgrid(self, min_lat_i: int, min_lon_i: int, offset: int) -> Iterator[Field]:
+    def _subgrid_indexes(self, min_lat_i: int, min_lon_i: int, offset: int) -> Iterator[tuple[int, int]]:
         lat_i = min_lat_i
         lon_i = min_lon_i
-        self.logger.debug(f"Trying to find subgrid with {min_lat_i=} {min_lon_i=} and {offset=}")
         for _ in range(offset * 2):
             for _ in range(offset * 2):
-                yield self.get_field(lat_i, lon_i)
+                yield lat_i, lon_i
                 lon_i = self.next_lon_i(lon_i)
             lon_i = min_lon_i
             lat_i = self.next_lat_i(lat_i)
 
+    def subgrid(self, min_lat_i: int, min_lon_i: int, offset: int) -> Iterator[Field]:
+        self.logger.debug(f"Trying to find subgrid with {min_lat_i=} {min_lon_i=} and {offset=}")
+        for lat_i, lon_i in self._subgrid_indexes(min_lat_i, min_lon_i, offset):
+            yield self.get_field(lat_i, lon_i)
+
+    def _occupied_subgrid(self, min_lat_i: int, min_lon_i: int, offset: int) -> Iterator[Field]:
+        for key in self._subgrid_indexes(min_lat_i, min_lon_i, offset):
+            if (field := self._map.get(key)) is not None:
+                yield field
+
     @staticmethod
     def next_lat_i(lat_i: int) -> int:
         if lat_i >= Bounds.max_lat_i():
@@ -128,15 +150,70 @@ class WorldMap:
             return 0
         return lon_i + 1
 
+    @property
+    def airports(self) -> list[Airport]:
+        return self._airports
+
     @lru_cache
     def find_nearby(self, ap: Airport, max_radius_km: float = 100.) -> list[tuple[Airport, float]]:
+        self.logger.info(f"Finding airports within {max_radius_km:.2f}km of {ap.full_name} {ap.coordinates}")
+        if (stored := self._stored_neighbors(ap, max_radius_km)) is not None:
+            return stored
+        ids, distances = self._index.query_radius(ap.latitude, ap.longitude, max_radius_km, cache=self._distances)
+        return [(self._airports[i], float(d)) for i, d in zip(ids, distances) if d < max_radius_km]
+
+    def _stored_neighbors(self, ap: Airport, max_radius_km: float) -> list[tuple[Airport, float]] | None:
+        if self._neighbors is None or ap.uid not in self._ids_by_uid:
+            return None
+        if (neighbors := self._neighbors(ap.uid, max_radius_km)) is None:
+            return None
+        # Like the spatial index, the result starts with the airport itself, once. Neighbours the map does not hold
+        # (e.g. filtered out by size) are skipped.
+        return [(self._airports[self._ids_by_uid[ap.uid]], 0.)] + [
+            (self._airports[ap_id], distance) for uid, distance in neighbors
+            if uid != ap.uid and (ap_id := self._ids_by_uid.get(uid)) is not None
+        ]
+
+    def k_nearest(self, ap: Airport, k: int, max_radius_km: float = None) -> list[tuple[Airport, float]]:
+        ids, distances = self._index.query_knn(ap.latitude, ap.longitude, k, max_km=max_radius_km)
+        return [(self._airports[i], float(d)) for i, d in zip(ids, distances)]
+
+    def id_of(self, uid: str) -> nullable(int):
+        return self._ids_by_uid.get(uid)
+
+    def nearby_ids(self, ap_id: int, max_radius_km: float = 100.) -> tuple[np.ndarray, np.ndarray]:
+        # Like find_nearby: ids (starting with `ap_id` itself) and distances (km, ascending)
+        ids, distances = self._index.query_radius(self._index.lats[ap_id], self._index.lons[ap_id], max_radius_km,
+                                                  cache=self._distances)
+        keep = distances < max_radius_km
+        return ids[keep], distances[keep]
+
+    def k_nearest_ids(self, ap_id: int, k: int, max_radius_km: float = None) -> tuple[np.ndarray, np.ndarray]:
+        return self._index.query_knn(self._index.lats[ap_id], self._index.lons[ap_id], k, max_km=max_radius_km)
+
+    def nearest_airports(self, lats: np.ndarray | pd.DataFrame, lons: np.ndarray = None, k: int = 1,
+                         max_km: float = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The `k` airports nearest to each of many points, resolved in one vectorized pass.
+        `lats` may also be a DataFrame with `latitude` and `longitude` columns, in which case `lons` is ignored.
+        Returns two (len(points), k) arrays: indexes into `airports` and geodesic distances (km, ascending per row).
+        Rows with fewer than `k` airports (within `max_km`) are padded with -1 and inf.
+        """
+        if isinstance(lats, pd.DataFrame):
+            lats, lons = lats['latitude'].to_numpy(dtype=np.float64), lats['longitude'].to_numpy(dtype=np.float64)
+        if lons is None:
+            raise ValueError("nearest_airports needs longitudes unless it is given a DataFrame")
+        self.logger.debug(f"Finding the {k} nearest airports for {len(lats)} points")
+        return self._index.query_knn_batch(lats, lons, k, max_km=max_km)
+
+    def find_nearby_grid(self, ap: Airport, max_radius_km: float = 100.) -> list[tuple[Airport, float]]:
+        # Reference implementation walking the grid cells around `ap`, kept to cross-check the spatial index
         # TODO: See why some searches work in one direction but not in reverse
         max_jumps = math.ceil(max_radius_km / self.KM_PER_SQUARE)
         self.logger.info(f"FInding airports within {max_jumps} jumps ({max_radius_km:.2f}km) of {ap.full_name} {ap.coordinates}")
         rv: list[tuple[Airport, float]] = []
 
-        def __insert(ap_: Airport):
-            dist = ap.distance_to(ap_)
+        def __insert(ap_: Airport, dist: float):
             for idx, (stored_ap, stored_dist) in enumerate(rv):
                 if dist < stored_dist and (dist <= max_radius_km):
                     rv.insert(idx, (ap_, dist))
@@ -146,15 +223,28 @@ class WorldMap:
         lat_i, lon_i = self.convert_ll_to_indexes(ap.latitude, ap.longitude)
         min_lat_i = self._get_min_lat_bound(lat_i, offset=max_jumps)
         min_lon_i = self._get_min_lon_bound(lon_i, offset=max_jumps)
-        for field in self.subgrid(min_lat_i=min_lat_i, min_lon_i=min_lon_i, offset=max_jumps):
-            for found_ap in field.airports.values():
-                if (distance := ap.distance_to(found_ap)) < max_radius_km:
-                    self.logger.debug(f"Found nearby ({distance=}) AP {found_ap.full_name} {found_ap.coordinates} ")
-                    __insert(found_ap)
+        candidates = [found_ap for field in self._occupied_subgrid(min_lat_i=min_lat_i, min_lon_i=min_lon_i,
+                                                                    offset=max_jumps)
+                      for found_ap in field.airports.values()]
+        lats = np.fromiter((found_ap.latitude for found_ap in candidates), dtype=np.float64, count=len(candidates))
+        lons = np.fromiter((found_ap.longitude for found_ap in candidates), dtype=np.float64, count=len(candidates))
+        found, distances = within_radius_km(ap.coordinates, lats, lons, max_radius_km, cache=self._distances)
+        for i, distance in zip(found.tolist(), distances.tolist()):
+            if distance < max_radius_km:
+                found_ap = candidates[i]
+                self.logger.debug(f"Found nearby ({distance=}) AP {found_ap.full_name} {found_ap.coordinates} ")
+                __insert(found_ap, distance)
         return rv
 
     def get_field(self, lat_i: int, lon_i: int) -> Field:
-        return self._map[lat_i][lon_i]
+        if (field := self._map.get((lat_i, lon_i))) is not None:
+            return field
+        lat, lon = self.convert_indexes_to_ll(lat_i, lon_i)
+        return Field(lat=lat, lon=lon)
+
+    @property
+    def occupied_fields(self) -> int:
+        return len(self._map)
 
     @classmethod
     def convert_ll_to_indexes(cls, lat: float, lon: float) -> tuple[int, int]:
@@ -171,22 +261,46 @@ class WorldMap:
         return round(rv_lat, 1), round(rv_lon, 1)
 
     def _insert(self, lat_i: int, lon_i: int, ap: Airport):
-        self._map[lat_i][lon_i].put(ap)
+        if (field := self._map.get((lat_i, lon_i))) is None:
+            lat, lon = self.convert_indexes_to_ll(lat_i, lon_i)
+            field = self._map[(lat_i, lon_i)] = Field(lat=lat, lon=lon)
+        field.put(ap)
+        if (ap_id := self._ids.get((lat_i, lon_i, ap.full_name))) is not None:
+            # Same cell and name: the field replaced the airport, and so does the index
+            self._airports[ap_id] = ap
+        else:
+            ap_id = self._ids[(lat_i, lon_i, ap.full_name)] = self._index.insert(ap.latitude, ap.longitude)
+            self._airports.append(ap)
+        if ap.iata_code:
+            self._ids_by_uid[ap.uid] = ap_id
+        self.find_nearby.cache_clear()
 
     def insert(self, airport: Airport):
+        if self.table is not None:
+            raise ValueError("A WorldMap populated from an AirportTable cannot take more airports, its ids are the "
+                             "table's")
         if Bounds.in_bounds(airport.latitude, airport.longitude):
             lat_i, lon_i = self.convert_ll_to_indexes(airport.latitude, airport.longitude)
             self._insert(lat_i, lon_i, airport)
 
     def populate(self, data: pd.DataFrame, closed: bool = False, small: bool = False, medium: bool = True):
-        filter_ = set()
-        if not closed:
-            filter_.add('closed')
-        if not small:
-            filter_.add('small_airport')
-        if not medium:
-            filter_.add('medium_airport')
-        for ap in data.itertuples(index=False):
-            airport = Airport.from_namedtuple(ap)
-            if airport.size not in filter_:
-                self.insert(airport)
+        for airport in AirportDatasetLoader.to_airports(AirportDatasetLoader.filter(data, closed, small, medium)):
+            self.insert(airport)
+
+    def populate_table(self, table: AirportTable):
+        if self._airports:
+            raise ValueError("Only an empty WorldMap can be populated from an AirportTable")
+        self.table = table
+        # Every row goes into the index, in id order, so index ids are table ids
+        self._index = SphericalKDTree(table.latitudes, table.longitudes)
+        self._airports = list(table.views())
+        for ap_id, ap in enumerate(self._airports):
+            if Bounds.in_bounds(ap.latitude, ap.longitude):
+                lat_i, lon_i = self.convert_ll_to_indexes(ap.latitude, ap.longitude)
+                if (field := self._map.get((lat_i, lon_i))) is None:
+                    lat, lon = self.convert_indexes_to_ll(lat_i, lon_i)
+                    field = self._map[(lat_i, lon_i)] = Field(lat=lat, lon=lon)
+                field.put(ap)
+        self._ids_by_uid = {uid: table.id_of(uid) for uid in table.uids}
+        self.find_nearby.cache_clear()
+        self.logger.info(f"World map populated with {len(table)} airports")
@@ -0,0 +1,78 @@
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+
+# Appended rather than prepended: the repo's `secrets.py` must not shadow the standard library module
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+
+class AmadeusStub:
+    """
+    A local stand-in for the Amadeus API, running on its own thread and loop. Flight-offer requests are answered
+    from `responses`, (status, body, content type) tuples, in order, then with one offer echoing the leg, each
+    after `delay_s`. Token requests are answered after `token_delay_s`.
+    """
+
+    def __init__(self):
+        self.responses: list[tuple[int, str, str]] = []
+        self.token_calls: int = 0
+        self.token_lifetime_s: float = 1799.
+        self.token_delay_s: float = 0.
+        self.offer_calls: int = 0
+        self.delay_s: float = 0.
+        self.in_flight: int = 0
+        self.max_in_flight: int = 0
+        self.url: str = None
+        self._loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self._runner: web.AppRunner = None
+
+    async def _token(self, _: web.Request) -> web.Response:
+        self.token_calls += 1
+        await asyncio.sleep(self.token_delay_s)
+        return web.json_response({"access_token": f"token{self.token_calls}", "expires_in": self.token_lifetime_s})
+
+    async def _offers(self, request: web.Request) -> web.Response:
+        self.offer_calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay_s)
+        finally:
+            self.in_flight -= 1
+        if self.responses:
+            status, body, content_type = self.responses.pop(0)
+            return web.Response(status=status, text=body, content_type=content_type)
+        leg = request.query
+        return web.json_response({"data": [{"from": leg["originLocationCode"], "to": leg["destinationLocationCode"],
+                                            "date": leg["departureDate"]}]})
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post("/v1/security/oauth2/token", self._token)
+        app.router.add_get("/v2/shopping/flight-offers", self._offers)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}/"
+
+    def start(self):
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result(5)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+@pytest.fixture
+def amadeus_stub() -> AmadeusStub:
+    stub = AmadeusStub()
+    stub.start()
+    yield stub
+    stub.stop()
@@ -0,0 +1,32 @@
+import random
+
+from src.flight_search.airport import Airport
+from src.geo.airport_dataset import AirportDatasetLoader
+
+HEADER = "name;iso_country;iso_region;municipality;latitude;longitude;type;iata_code;local_code\n"
+
+
+def test_coordinates_parse_like_float(tmp_path):
+    rng = random.Random(0)
+    coordinates = ["51.47060012817383", "-0.461941003799"] + [
+        repr(rng.uniform(-90., 90.)) for _ in range(2000)
+    ]
+    path = tmp_path / "airports.csv"
+    path.write_text(HEADER + "".join(
+        f"Airport {i};GB;GB-ENG;London;{lat};{lon};large_airport;A{i:03};\n"
+        for i, (lat, lon) in enumerate(zip(coordinates, reversed(coordinates)))
+    ))
+
+    df = AirportDatasetLoader().read_csv(path)
+
+    assert df["latitude"].tolist() == [float(lat) for lat in coordinates]
+    assert df["longitude"].tolist() == [float(lon) for lon in reversed(coordinates)]
+
+
+def test_uids_match_the_float_parse(tmp_path):
+    path = tmp_path / "airports.csv"
+    path.write_text(HEADER + "London Heathrow;GB;GB-ENG;London;51.47060012817383;-0.461941003799;large_airport;LHR;\n")
+
+    airport, = AirportDatasetLoader.to_airports(AirportDatasetLoader().read_csv(path))
+
+    assert airport.uid == Airport.make_uid("LHR", float("51.47060012817383"), float("-0.461941003799"))
@@ -0,0 +1,78 @@
+import pytest
+
+from src.db.gateways.airport_gateway import AirportGateway
+from src.db.gateways.base_gateway import BaseGateway
+from src.db.pg_connect import PgResponse
+from src.flight_search.airport import Airport
+
+
+class FakePg:
+    # Records every COPY instead of running it
+
+    def __init__(self):
+        self.copies: list[dict] = []
+
+    def copy_rows(self, table: str, columns: list[str], rows, before: str = None, after: str = None,
+                  fetch: bool = False) -> PgResponse:
+        rows = list(rows)
+        self.copies.append(dict(table=table, columns=columns, rows=rows, before=before, after=after, fetch=fetch))
+        return PgResponse(query=f"COPY {table}", exec_time_ms=0., pg_resp=[], row_count=len(rows),
+                          rows_copied=len(rows))
+
+
+def _airport(name: str, iata_code: str = "AAA") -> Airport:
+    return Airport(full_name=name, latitude=1., longitude=2., iata_code=iata_code, size="large_airport")
+
+
+def test_merge_without_update_keeps_stored_rows():
+    query = BaseGateway._merge_query("t", "t_staging", ["k", "a", "b"], ["k"])
+
+    assert query == "INSERT INTO t (k, a, b) SELECT k, a, b FROM t_staging ON CONFLICT (k) DO NOTHING;"
+
+
+def test_merge_with_update_merges_one_row_per_key_and_skips_unchanged_rows():
+    query = BaseGateway._merge_query("t", "t_staging", ["k1", "k2", "a", "b"], ["k1", "k2"],
+                                     on_conflict=BaseGateway.ON_CONFLICT_UPDATE)
+
+    assert query == "INSERT INTO t (k1, k2, a, b) SELECT DISTINCT ON (k1, k2) k1, k2, a, b FROM t_staging " \
+                    "ON CONFLICT (k1, k2) DO UPDATE SET a = EXCLUDED.a, b = EXCLUDED.b " \
+                    "WHERE (t.a, t.b) IS DISTINCT FROM (EXCLUDED.a, EXCLUDED.b);"
+
+
+def test_merge_updates_only_the_given_columns():
+    query = BaseGateway._merge_query("t", "t_staging", ["k", "a", "b"], ["k"],
+                                     on_conflict=BaseGateway.ON_CONFLICT_UPDATE, update_columns=["b"])
+
+    assert query.endswith("DO UPDATE SET b = EXCLUDED.b WHERE (t.b) IS DISTINCT FROM (EXCLUDED.b);")
+
+
+def test_merge_rejects_unknown_conflict_actions():
+    with pytest.raises(ValueError):
+        BaseGateway._merge_query("t", "t_staging", ["k", "a"], ["k"], on_conflict="replace")
+
+
+@pytest.mark.parametrize("update", [False, True])
+def test_import_data_stages_every_row_and_merges_by_uid(update: bool):
+    pg = FakePg()
+    gw = AirportGateway(pg=pg)
+    # The same airport twice in one batch: both rows are staged, the merge handles the duplicate key
+    airports = [_airport("Old name"), _airport("New name"), _airport("Other", iata_code="BBB")]
+
+    assert gw.import_data(airports, update=update) == 3
+
+    copy, = pg.copies
+    selection = ", ".join(AirportGateway.columns)
+    assert copy["table"] == "airports_staging" and copy["columns"] == AirportGateway.columns
+    assert [row[0] for row in copy["rows"]] == [ap.uid for ap in airports]
+    assert copy["before"] == f"CREATE TEMP TABLE airports_staging ON COMMIT DROP AS " \
+                             f"SELECT {selection} FROM airports WITH NO DATA;"
+    if update:
+        # A key may only be updated once per statement, so duplicates must be collapsed before the merge
+        assert copy["after"].startswith(f"INSERT INTO airports ({selection}) "
+                                        f"SELECT DISTINCT ON (uid) {selection} FROM airports_staging "
+                                        f"ON CONFLICT (uid) DO UPDATE SET full_name = EXCLUDED.full_name, ")
+        assert "uid = EXCLUDED.uid" not in copy["after"]
+    else:
+        # DO NOTHING skips the second row of a duplicate key instead of failing
+        assert copy["after"] == f"INSERT INTO airports ({selection}) SELECT {selection} FROM airports_staging " \
+                                f"ON CONFLICT (uid) DO NOTHING;"
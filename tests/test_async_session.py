@@ -0,0 +1,148 @@
+import asyncio
+import threading
+from datetime import datetime
+
+from src.currency.money import Money
+from src.flight_search.airport import Airport
+from src.flight_search.async_session import AsyncAmadeusSession
+from src.flight_search.response_cache import ResponseCache
+from src.flight_search.search_query import FlightSearchQuery
+from util.goroutine import Channel
+from util.rate_limiter import RateLimiter
+
+BAD_GATEWAY = (502, "<html><body><h1>502 Bad Gateway</h1></body></html>", "text/html")
+
+
+def _query(*arrivals: str) -> FlightSearchQuery:
+    return FlightSearchQuery(
+        depart_from=[Airport(iata_code="LHR", latitude=51.4706, longitude=-0.461941)],
+        arrive_at=[Airport(iata_code=code, latitude=float(i), longitude=float(i)) for i, code in enumerate(arrivals)],
+        budget=Money(300.),
+        departure_dates=[datetime(2026, 11, 1)]
+    )
+
+
+def _fan_out(url: str, query: FlightSearchQuery, **session_kwargs) -> tuple[int, list]:
+    async def run():
+        channel = Channel()
+        async with AsyncAmadeusSession("key", "secret", base_endpoint=url, **session_kwargs) as session:
+            failed = await session.fan_out(query, channel)
+        return failed, list(channel.iter())
+    return asyncio.run(run())
+
+
+def test_fan_out_is_bounded_and_returns_every_leg(amadeus_stub):
+    amadeus_stub.delay_s = 0.05
+    arrivals = [f"A{i:02}" for i in range(12)]
+
+    failed, results = _fan_out(amadeus_stub.url, _query(*arrivals), max_concurrency=4)
+
+    assert failed == 0
+    assert sorted(offers.arrives_at.iata_code for offers in results) == arrivals
+    assert all(len(offers.offers) == 1 for offers in results)
+    assert amadeus_stub.max_in_flight == 4
+    assert amadeus_stub.token_calls == 1
+
+
+def test_non_json_error_fails_only_its_leg(amadeus_stub):
+    amadeus_stub.responses = [BAD_GATEWAY]
+
+    failed, results = _fan_out(amadeus_stub.url, _query("CDG", "AMS"), rate_limiter=RateLimiter(max_retries=0))
+
+    assert failed == 1
+    assert amadeus_stub.offer_calls == 2
+    assert len(results) == 2
+    error, = [offers.error for offers in results if offers.failed]
+    assert error.startswith("[502] <html>")
+    ok, = [offers for offers in results if not offers.failed]
+    assert len(ok.offers) == 1
+
+
+def test_non_json_error_is_retried(amadeus_stub):
+    amadeus_stub.responses = [BAD_GATEWAY, (503, "Service Unavailable", "text/plain")]
+    rate_limiter = RateLimiter(max_retries=3, backoff_base_s=0.01)
+
+    failed, results = _fan_out(amadeus_stub.url, _query("CDG"), rate_limiter=rate_limiter)
+
+    assert failed == 0
+    assert amadeus_stub.offer_calls == 3
+    assert len(results[0].offers) == 1
+    assert rate_limiter.retries == 2
+
+
+def test_retries_give_up_after_max_retries(amadeus_stub):
+    amadeus_stub.responses = [BAD_GATEWAY] * 5
+    rate_limiter = RateLimiter(max_retries=2, backoff_base_s=0.01)
+
+    failed, results = _fan_out(amadeus_stub.url, _query("CDG"), rate_limiter=rate_limiter)
+
+    assert failed == 1
+    assert amadeus_stub.offer_calls == 3
+    assert results[0].error.startswith("[502] <html>")
+
+
+def test_concurrent_requests_share_one_token(amadeus_stub):
+    failed, results = _fan_out(amadeus_stub.url, _query(*(f"A{i:02}" for i in range(20))))
+
+    assert failed == 0
+    assert len(results) == 20
+    assert amadeus_stub.token_calls == 1
+
+
+def test_sessions_share_the_token_file(amadeus_stub, tmp_path):
+    token_file = tmp_path / "amadeus.token"
+
+    async def run():
+        for _ in range(2):
+            async with AsyncAmadeusSession("key", "secret", base_endpoint=amadeus_stub.url,
+                                           token_cache_file=token_file) as session:
+                await session.fan_out(_query("CDG"), Channel())
+
+    asyncio.run(run())
+
+    assert amadeus_stub.offer_calls == 2
+    assert amadeus_stub.token_calls == 1
+
+
+def test_token_is_refreshed_in_the_background(amadeus_stub):
+    # Inside TokenManager's 120s refresh margin a second after it is issued
+    amadeus_stub.token_lifetime_s = 121.
+
+    async def run():
+        async with AsyncAmadeusSession("key", "secret", base_endpoint=amadeus_stub.url) as session:
+            await session.fan_out(_query("CDG"), Channel())
+            await asyncio.sleep(1.5)
+            return session._tokens.current.value
+
+    token = asyncio.run(run())
+
+    assert amadeus_stub.token_calls == 2
+    assert token == "token2"
+
+
+class ThreadRecordingCache(ResponseCache):
+
+    def __init__(self):
+        ResponseCache.__init__(self)
+        self.threads: list[threading.Thread] = []
+
+    def get(self, key: str):
+        self.threads.append(threading.current_thread())
+        return ResponseCache.get(self, key)
+
+    def put(self, key: str, body, ttl_s: float = None):
+        self.threads.append(threading.current_thread())
+        ResponseCache.put(self, key, body, ttl_s)
+
+
+def test_cache_is_used_off_the_loop(amadeus_stub):
+    cache = ThreadRecordingCache()
+
+    for _ in range(2):
+        failed, results = _fan_out(amadeus_stub.url, _query("CDG"), cache=cache)
+        assert failed == 0 and len(results[0].offers) == 1
+
+    # A miss and its put, then a hit
+    assert len(cache.threads) == 3
+    assert amadeus_stub.offer_calls == 1
+    assert threading.main_thread() not in cache.threads
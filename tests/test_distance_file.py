@@ -0,0 +1,22 @@
+import numpy as np
+
+from src.flight_search.airport import Airport
+from src.geo.distance_file import DistanceMatrixFile
+
+
+def _airports(n: int) -> list[Airport]:
+    rng = np.random.default_rng(0)
+    return [Airport(full_name=f"Airport {i}", latitude=float(lat), longitude=float(lon), iata_code=f"A{i:02}")
+            for i, (lat, lon) in enumerate(zip(rng.uniform(-60., 60., n), rng.uniform(-180., 180., n)))]
+
+
+def test_pairs_round_trip_and_verify(tmp_path):
+    airports = _airports(12)
+    with DistanceMatrixFile.build(tmp_path / "built.fsdm", airports) as built:
+        pairs = [(ap1, ap2, distance) for _, ap1, ap2, distance in built.rows() if ap1 != ap2]
+        with DistanceMatrixFile.from_pairs(tmp_path / "copied.fsdm", built.uids, pairs) as copied:
+            assert copied.uids == built.uids
+            assert all(np.array_equal(copied.row(i), built.row(i)) for i in range(len(built)))
+            assert copied.verify(pairs)
+        assert not built.verify(pairs[1:])
+        assert not built.verify([(ap1, ap2, distance + 1.) for ap1, ap2, distance in pairs])
@@ -0,0 +1,21 @@
+import numpy as np
+
+from src.flight_search.airport import Airport
+from src.geo.distance_matrix import DistanceMatrix
+
+
+def test_from_pairs_matches_the_computed_matrix():
+    rng = np.random.default_rng(0)
+    airports = [Airport(full_name=f"Airport {i}", latitude=float(lat), longitude=float(lon), iata_code=f"A{i:02}")
+                for i, (lat, lon) in enumerate(zip(rng.uniform(-60., 60., 15), rng.uniform(-180., 180., 15)))]
+    computed = DistanceMatrix.from_airports(airports)
+    pairs = [(computed.uid_of(i), computed.uid_of(j), computed.distance(i, j))
+             for i in range(len(computed)) for j in range(i + 1, len(computed))]
+
+    loaded = DistanceMatrix.from_pairs(computed.uids, pairs[1:])
+
+    assert np.isinf(loaded.distance(0, 1))
+    assert all(loaded.distance(i, j) == computed.distance(i, j)
+               for i in range(len(computed)) for j in range(len(computed)) if {i, j} != {0, 1})
+    ids, _ = loaded.k_nearest(0, 3)
+    assert 1 not in ids.tolist()
@@ -0,0 +1,42 @@
+from src.db.gateways.airport_gateway import AirportDiff
+from src.db.gateways.distance_pairs_gateway import AirportDistancePairsGateway
+from src.db.pg_connect import PgResponse
+from src.flight_search.airport import Airport
+
+
+def _airports(n: int) -> list[Airport]:
+    return [Airport(full_name=f"Airport {i}", latitude=float(i), longitude=float(2 * i), iata_code=f"A{i:02}")
+            for i in range(n)]
+
+
+def test_import_diff_passes_workers_to_the_parallel_import(monkeypatch):
+    airports = _airports(5)
+    gw = AirportDistancePairsGateway(pg=None)
+    calls = []
+    monkeypatch.setattr(gw, "_import_parallel", lambda *args, **kwargs: calls.append((args, kwargs)) or 7)
+
+    inserted = gw.import_diff(airports, AirportDiff(stored=3, added=airports[3:]), workers=2, validate=False)
+
+    assert inserted == 7
+    (ordered, rows), kwargs = calls[0]
+    # The changed airports' rows are paired with every airport, not only with each other
+    assert [ap.uid for ap in ordered[:2]] == [ap.uid for ap in airports[3:]]
+    assert rows == [0, 1] and kwargs["partners"] == [0, 1, 2, 3, 4] and kwargs["workers"] == 2
+
+
+def test_shards_pair_their_rows_with_the_given_partners(monkeypatch):
+    airports = _airports(4)
+    gw = AirportDistancePairsGateway(pg=None)
+    copied = []
+
+    def copy_distances(rows, **_) -> PgResponse:
+        copied.extend(rows)
+        return PgResponse(query="COPY", exec_time_ms=0., pg_resp=[], row_count=len(copied))
+    monkeypatch.setattr(gw, "_copy_distances", copy_distances)
+
+    result = gw.import_shard(airports, [0], shard=0, num_shards=1, partners=[0, 1, 2, 3])
+
+    assert result.rows_written == 4
+    assert {pair_id for pair_id, *_ in copied} == {
+        "_".join(gw.order_iata_key_pairs(airports[0].uid, ap.uid)) for ap in airports
+    }
@@ -0,0 +1,45 @@
+import numpy as np
+
+import util.math
+from util.math import BATCH_DISTANCE_TOLERANCE_KM, batch_distance_km, calculate_distance_km, geodesic_distance_km
+
+
+def _reference(lats1, lons1, lats2, lons2) -> np.ndarray:
+    return np.array([calculate_distance_km((a, b), (c, d)) for a, b, c, d in zip(lats1, lons1, lats2, lons2)])
+
+
+def test_geodesic_distances_are_within_tolerance():
+    rng = np.random.default_rng(0)
+    n = 15_000
+    lats1, lons1 = rng.uniform(-90., 90., n), rng.uniform(-180., 180., n)
+    lats2, lons2 = rng.uniform(-90., 90., n), rng.uniform(-180., 180., n)
+    # Near-antipodal pairs (where Vincenty does not converge), identical points, poles and the antimeridian
+    m = 1_000
+    near_lats, near_lons = rng.uniform(-1., 1., m), rng.uniform(-180., 180., m)
+    lats1 = np.concatenate([lats1, near_lats, lats1[:m], [90., -90., 89.999, 0., 10.]])
+    lons1 = np.concatenate([lons1, near_lons, lons1[:m], [0., 0., 179.999, 179.9999, 180.]])
+    lats2 = np.concatenate([lats2, -near_lats + rng.uniform(-.5, .5, m), lats1[:m], [-90., 90., 89.999, 0., 10.]])
+    lons2 = np.concatenate([lons2, near_lons + 179.5 + rng.uniform(0., .5, m), lons1[:m],
+                            [0., 0., -179.999, -179.9999, -180.]])
+
+    errors = np.abs(geodesic_distance_km(lats1, lons1, lats2, lons2) - _reference(lats1, lons1, lats2, lons2))
+
+    assert errors.max() <= BATCH_DISTANCE_TOLERANCE_KM
+
+
+def test_non_converging_pairs_fall_back_to_geopy(monkeypatch):
+    fallbacks = []
+
+    def counted(a, b):
+        fallbacks.append((a, b))
+        return calculate_distance_km(a, b)
+
+    monkeypatch.setattr(util.math, "calculate_distance_km", counted)
+    lats = np.array([0.5, 10., 0.])
+    lons = np.array([179.7, 20., 0.])
+
+    rv = batch_distance_km((0., 0.), lats, lons)
+
+    assert len(fallbacks) >= 1
+    assert np.abs(rv - _reference(np.zeros(3), np.zeros(3), lats, lons)).max() <= BATCH_DISTANCE_TOLERANCE_KM
+    assert rv[2] == 0.
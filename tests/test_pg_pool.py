@@ -0,0 +1,160 @@
+import threading
+
+import psycopg2
+import pytest
+from psycopg2 import extensions
+
+import src.db.pg_pool
+from src.db.pg_pool import PgConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+
+    def __init__(self, conn: 'FakeConnection'):
+        self._conn = conn
+
+    def __enter__(self) -> 'FakeCursor':
+        return self
+
+    def __exit__(self, *_):
+        ...
+
+    def execute(self, query: str):
+        self._conn.queries.append(query)
+        if self._conn.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed: int = 0
+        self.broken: bool = False
+        self.queries: list[str] = []
+        self.rollbacks: int = 0
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def get_transaction_status(self) -> int:
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now: float = 1000.
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakePool(PgConnectionPool):
+
+    def __init__(self, **kwargs):
+        self.created: list[FakeConnection] = []
+        super().__init__({}, **kwargs)
+
+    def _new_connection(self) -> FakeConnection:
+        self.created.append(FakeConnection())
+        return self.created[-1]
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(src.db.pg_pool, "monotonic", clock)
+    return clock
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted():
+    pool = FakePool(max_connections=2, checkout_timeout_s=0.05)
+    held = [pool.checkout(), pool.checkout()]
+
+    with pytest.raises(PoolTimeout):
+        pool.checkout()
+    assert pool.in_use == 2
+
+    pool.checkin(held.pop())
+    assert pool.checkout() in pool.created
+    assert len(pool.created) == 2
+
+
+def test_checkout_waits_for_a_checkin():
+    pool = FakePool(max_connections=1, checkout_timeout_s=5.)
+    conn = pool.checkout()
+    threading.Timer(0.05, pool.checkin, args=(conn,)).start()
+
+    assert pool.checkout() is conn
+
+
+def test_connection_is_returned_after_an_exception():
+    pool = FakePool(min_connections=1, max_connections=1)
+
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            raise ValueError("not a DB error")
+
+    assert pool.in_use == 0
+    assert not conn.closed
+    with pool.connection() as again:
+        assert again is conn
+
+
+@pytest.mark.parametrize("error", [psycopg2.OperationalError, psycopg2.InterfaceError])
+def test_broken_connection_is_dropped_and_replaced(error):
+    pool = FakePool(min_connections=1, max_connections=1)
+
+    with pytest.raises(error):
+        with pool.connection() as conn:
+            raise error("connection lost")
+
+    assert conn.closed
+    assert pool.size == 0
+    with pool.connection() as replacement:
+        assert replacement is not conn
+    assert len(pool.created) == 2
+
+
+def test_health_check_runs_only_after_the_idle_threshold(clock):
+    pool = FakePool(min_connections=1, max_connections=1, health_check_idle_s=10.)
+    conn = pool.created[0]
+
+    clock.now += 5.
+    with pool.connection() as checked_out:
+        assert checked_out is conn
+    assert conn.queries == []
+
+    clock.now += 11.
+    with pool.connection() as checked_out:
+        assert checked_out is conn
+    assert conn.queries == ["SELECT 1"]
+
+
+def test_failed_health_check_replaces_the_connection(clock):
+    pool = FakePool(min_connections=1, max_connections=1, health_check_idle_s=10.)
+    conn = pool.created[0]
+    conn.broken = True
+
+    clock.now += 11.
+    with pool.connection() as checked_out:
+        assert checked_out is not conn
+    assert conn.queries == ["SELECT 1"]
+    assert conn.closed
+    assert pool.in_use == 0 and pool.size == 1
+
+
+def test_closed_connection_is_replaced_without_a_query():
+    pool = FakePool(min_connections=1, max_connections=1)
+    conn = pool.created[0]
+    conn.close()
+
+    with pool.connection() as checked_out:
+        assert checked_out is not conn
+    assert conn.queries == []
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+from requests import Session
+
+from src.flight_search.session import AmadeusSession
+from src.flight_search.token_manager import PermanentTokenError
+
+
+def _token_url(amadeus_stub) -> str:
+    return amadeus_stub.url + "v1/security/oauth2/token"
+
+
+def test_access_token_is_requested(amadeus_stub):
+    with Session() as sess:
+        token = AmadeusSession.request_access_token(sess, _token_url(amadeus_stub), "key", "secret")
+
+    assert token.value == "token1"
+    assert token.valid_for(1700.)
+
+
+def test_access_token_request_times_out(amadeus_stub):
+    amadeus_stub.token_delay_s = 2.
+
+    start_ = time.monotonic()
+    with Session() as sess:
+        token = AmadeusSession.request_access_token(sess, _token_url(amadeus_stub), "key", "secret", timeout_s=0.2)
+
+    assert token is None
+    assert time.monotonic() - start_ < 1.5
+
+
+class RecordingLogger:
+
+    def __init__(self):
+        self.messages: list[tuple[str, str]] = []
+
+    def __getattr__(self, level: str):
+        return lambda message, *_, **__: self.messages.append((level, message))
+
+
+def test_access_token_request_logs_to_the_given_logger(amadeus_stub):
+    amadeus_stub.token_delay_s = 2.
+    logger = RecordingLogger()
+
+    with Session() as sess:
+        token = AmadeusSession.request_access_token(sess, _token_url(amadeus_stub), "key", "secret", timeout_s=0.2,
+                                                    logger=logger)
+
+    assert token is None
+    assert [level for level, message in logger.messages if message.startswith("Failed to get Amadeus token")] == [
+        "error"
+    ]
+
+
+def test_access_token_request_without_credentials_fails_for_good():
+    with Session() as sess, pytest.raises(PermanentTokenError):
+        AmadeusSession.request_access_token(sess, "http://127.0.0.1/", "", "secret")
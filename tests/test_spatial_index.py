@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.flight_search.airport import Airport
+from src.geo.spatial_index import SphericalKDTree
+from src.geo.world_map import WorldMap
+from util.math import BATCH_DISTANCE_TOLERANCE_KM, calculate_distance_km
+
+
+def _points(n: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    # Uniform on the sphere, plus clusters at both poles and across the antimeridian
+    rng = np.random.default_rng(seed)
+    lats = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+    lons = rng.uniform(-180., 180., n)
+    cluster = n // 10
+    lats[:cluster], lons[:cluster] = rng.uniform(88., 90., cluster), rng.uniform(-180., 180., cluster)
+    lats[cluster:2 * cluster] = rng.uniform(-90., -88., cluster)
+    lats[2 * cluster:3 * cluster] = rng.uniform(-20., 20., cluster)
+    lons[2 * cluster:3 * cluster] = np.where(rng.random(cluster) < .5, rng.uniform(179., 180., cluster),
+                                             rng.uniform(-180., -179., cluster))
+    return lats, lons
+
+
+def _queries() -> list[tuple[float, float]]:
+    return [(90., 0.), (-90., 0.), (89.5, 179.9), (-89.9, -45.), (0., 180.), (0., -180.), (15., 179.99),
+            (-15., -179.99), (51.47, -0.46), (-33.9, 151.2), (40.6, -73.8), (0., 0.)]
+
+
+def _brute_force(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    return np.array([calculate_distance_km((lat, lon), (a, b)) for a, b in zip(lats, lons)])
+
+
+@pytest.fixture(scope="module")
+def points() -> tuple[np.ndarray, np.ndarray]:
+    return _points(600)
+
+
+def test_query_radius_matches_a_brute_force_scan(points):
+    lats, lons = points
+    tree = SphericalKDTree(lats, lons)
+    for lat, lon in _queries():
+        expected = _brute_force(lat, lon, lats, lons)
+        for radius_km in (50., 400., 2500.):
+            ids, distances = tree.query_radius(lat, lon, radius_km)
+            assert set(ids.tolist()) == set(np.flatnonzero(expected <= radius_km).tolist())
+            assert np.allclose(distances, expected[ids], rtol=0., atol=BATCH_DISTANCE_TOLERANCE_KM)
+            assert np.all(np.diff(distances) >= 0)
+
+
+def test_query_knn_matches_a_brute_force_scan(points):
+    lats, lons = points
+    tree = SphericalKDTree(lats, lons)
+    for lat, lon in _queries():
+        expected = np.sort(_brute_force(lat, lon, lats, lons))
+        for k in (1, 7, 40):
+            ids, distances = tree.query_knn(lat, lon, k)
+            assert len(ids) == k
+            assert np.allclose(distances, expected[:k], rtol=0., atol=BATCH_DISTANCE_TOLERANCE_KM)
+        ids, distances = tree.query_knn(lat, lon, 40, max_km=300.)
+        assert np.allclose(distances, expected[:40][expected[:40] <= 300.], rtol=0., atol=BATCH_DISTANCE_TOLERANCE_KM)
+
+
+def test_pending_points_are_found_before_a_rebuild(points):
+    lats, lons = points
+    tree = SphericalKDTree(lats[:500], lons[:500], rebuild_threshold=1_000)
+    for lat, lon in zip(lats[500:], lons[500:]):
+        tree.insert(lat, lon)
+    assert tree.pending == 100
+
+    for lat, lon in _queries():
+        expected = _brute_force(lat, lon, lats, lons)
+        ids, _ = tree.query_radius(lat, lon, 1000.)
+        assert set(ids.tolist()) == set(np.flatnonzero(expected <= 1000.).tolist())
+        ids, distances = tree.query_knn(lat, lon, 10)
+        assert np.allclose(distances, np.sort(expected)[:10], rtol=0., atol=BATCH_DISTANCE_TOLERANCE_KM)
+    assert tree.pending == 100
+
+
+
+def test_find_nearby_matches_a_brute_force_scan(points):
+    lats, lons = points
+    world_map = WorldMap()
+    airports = [Airport(full_name=f"Airport {i}", latitude=float(lat), longitude=float(lon))
+                for i, (lat, lon) in enumerate(zip(lats, lons))]
+    for ap in airports:
+        world_map.insert(ap)
+    for lat, lon in _queries():
+        query = Airport(full_name="Query", latitude=lat, longitude=lon)
+        expected = _brute_force(lat, lon, lats, lons)
+
+        found = world_map.find_nearby(query, max_radius_km=800.)
+
+        assert {ap.full_name for ap, _ in found} == {airports[i].full_name for i in np.flatnonzero(expected < 800.)}
+        assert all(abs(km - calculate_distance_km(query.coordinates, ap.coordinates)) <= BATCH_DISTANCE_TOLERANCE_KM
+                   for ap, km in found)
+
+
+def test_query_knn_batch_matches_a_brute_force_scan(points):
+    lats, lons = points
+    tree = SphericalKDTree(lats, lons)
+    q_lats, q_lons = _points(60, seed=1)
+
+    ids, distances = tree.query_knn_batch(q_lats, q_lons, 5)
+
+    assert ids.shape == distances.shape == (60, 5)
+    for row, (lat, lon) in enumerate(zip(q_lats, q_lons)):
+        expected = np.sort(_brute_force(lat, lon, lats, lons))[:5]
+        assert np.allclose(distances[row], expected, rtol=0., atol=BATCH_DISTANCE_TOLERANCE_KM)
+
+
+def test_query_knn_batch_pads_missing_neighbours():
+    tree = SphericalKDTree(np.array([0., 0., 10.]), np.array([0., 1., 0.]))
+
+    ids, distances = tree.query_knn_batch(np.array([0., 60.]), np.array([0., 0.]), 5)
+    assert ids.shape == distances.shape == (2, 5)
+    assert np.all(ids[:, 3:] == -1) and np.all(np.isinf(distances[:, 3:]))
+    assert np.all(ids[:, :3] >= 0) and np.all(np.isfinite(distances[:, :3]))
+
+    ids, distances = tree.query_knn_batch(np.array([0., 60.]), np.array([0., 0.]), 3, max_km=200.)
+    assert ids[0].tolist()[:2] == [0, 1] and ids[0, 2] == -1 and np.isinf(distances[0, 2])
+    assert np.all(ids[1] == -1) and np.all(np.isinf(distances[1]))
+
+    ids, distances = SphericalKDTree().query_knn_batch(np.array([0.]), np.array([0.]), 2)
+    assert ids.tolist() == [[-1, -1]] and np.all(np.isinf(distances))
+
+
+def test_nearest_airports_takes_arrays_or_a_frame(points):
+    lats, lons = points
+    world_map = WorldMap()
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        world_map.insert(Airport(full_name=f"Airport {i}", latitude=float(lat), longitude=float(lon)))
+    q_lats, q_lons = _points(50, seed=2)
+
+    ids, distances = world_map.nearest_airports(q_lats, q_lons, k=3)
+    frame_ids, frame_distances = world_map.nearest_airports(pd.DataFrame({"latitude": q_lats, "longitude": q_lons}),
+                                                            k=3)
+
+    assert ids.shape == distances.shape == (50, 3)
+    assert np.array_equal(ids, frame_ids) and np.array_equal(distances, frame_distances)
+    one_ids, one_distances = world_map.nearest_airports(q_lats, q_lons)
+    assert one_ids.shape == (50, 1) and np.array_equal(one_ids[:, 0], ids[:, 0])
+    cut_ids, cut_distances = world_map.nearest_airports(q_lats, q_lons, k=len(world_map.airports) + 5, max_km=500.)
+    assert np.all((cut_ids == -1) == np.isinf(cut_distances))
+    assert np.all(cut_distances[cut_ids >= 0] <= 500.)
+    with pytest.raises(ValueError):
+        world_map.nearest_airports(q_lats, k=3)
@@ -0,0 +1,67 @@
+import src.flight_search.token_manager
+from src.flight_search.token_manager import AccessToken, PermanentTokenError, TokenManager
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now: float = 1_000_000.
+
+    def time(self) -> float:
+        return self.now
+
+
+class RecordingEvent:
+    # Stands in for the refresher's stop event: records the waits instead of sleeping, and stops after `max_waits`
+
+    def __init__(self, max_waits: int, clock: FakeClock = None):
+        self.waits: list[float] = []
+        self.max_waits: int = max_waits
+        self._clock: FakeClock = clock
+
+    def is_set(self) -> bool:
+        return len(self.waits) >= self.max_waits
+
+    def wait(self, timeout: float):
+        self.waits.append(timeout)
+        if self._clock is not None:
+            self._clock.now += timeout
+
+
+def test_failed_refreshes_back_off_exponentially():
+    tokens = TokenManager(fetch=lambda: None)
+    tokens._stop = RecordingEvent(max_waits=10)
+
+    tokens._refresh_loop()
+
+    assert tokens.fetches == 10
+    assert tokens._stop.waits == [10., 20., 40., 80., 160., 320., 600., 600., 600., 600.]
+
+
+def test_backoff_restarts_after_a_successful_refresh(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(src.flight_search.token_manager, "time", clock)
+    results = iter([None, None, AccessToken(value="token", expires_at=clock.now + 230.)])
+    tokens = TokenManager(fetch=lambda: next(results, None), refresh_margin_s=120.)
+    tokens._stop = RecordingEvent(max_waits=5, clock=clock)
+
+    tokens._refresh_loop()
+
+    # Two failures, a token which is due for a refresh 80s later, then the backoff starts over
+    assert tokens._stop.waits == [10., 20., 80., 10., 20.]
+
+
+def test_permanent_failure_stops_the_refresher():
+    def fetch():
+        raise PermanentTokenError("No credentials")
+
+    tokens = TokenManager(fetch=fetch)
+    tokens.start()
+    tokens._refresher.join(5)
+
+    assert not tokens._refresher.is_alive()
+    assert tokens.fetches == 1
+    assert tokens.token() is None
+    assert tokens.fetches == 1
+    assert isinstance(tokens.permanent_error, PermanentTokenError)
+    tokens.stop()
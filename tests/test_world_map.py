@@ -0,0 +1,119 @@
+import numpy as np
+
+from src.flight_search.airport import Airport
+from src.flight_search.airport_table import AirportTable
+from src.geo.distance_matrix import DistanceMatrix
+from src.geo.world_map import WorldMap
+from util.math import calculate_distance_km
+
+
+def _table() -> AirportTable:
+    rng = np.random.default_rng(0)
+    airports = [
+        Airport(full_name=f"Airport {i}", iso_country="GB", iso_region="GB-ENG", latitude=float(lat),
+                longitude=float(lon), size="medium_airport", iata_code=f"A{i:02}")
+        for i, (lat, lon) in enumerate(zip(rng.uniform(50., 53., 40), rng.uniform(-2., 1., 40)))
+    ]
+    # A heliport sharing a runway's coordinates, without an IATA code
+    airports.append(Airport(full_name="Heliport", latitude=airports[0].latitude, longitude=airports[0].longitude,
+                            size="heliport"))
+    return AirportTable.from_airports(airports)
+
+
+def test_world_map_and_distance_matrix_share_table_ids():
+    table = _table()
+    world_map = WorldMap(table=table)
+    matrix = DistanceMatrix.from_table(table)
+
+    for ap_id in range(len(table)):
+        ids, distances = world_map.nearby_ids(ap_id, max_radius_km=80.)
+        matrix_ids, _ = matrix.within(ap_id, 80.)
+        assert set(ids.tolist()) - {ap_id} == set(matrix_ids.tolist()) - {ap_id}
+        assert np.all(np.diff(distances) >= 0)
+        assert world_map.id_of(table.uid_of(ap_id)) == ap_id
+
+
+def test_equal_coordinates_keep_their_own_ids():
+    table = _table()
+    world_map = WorldMap(table=table)
+    heliport = len(table) - 1
+
+    ids, distances = world_map.k_nearest_ids(heliport, k=2)
+
+    assert sorted(ids.tolist()) == [0, heliport]
+    assert distances.tolist() == [0., 0.]
+    assert world_map.airports[heliport].full_name == "Heliport"
+
+
+def _airports(n: int, seed: int = 1) -> list[Airport]:
+    rng = np.random.default_rng(seed)
+    return [Airport(full_name=f"Airport {i}", latitude=float(lat), longitude=float(lon), size="medium_airport",
+                    iata_code=f"B{i:03}")
+            for i, (lat, lon) in enumerate(zip(rng.uniform(-89., 89., n), rng.uniform(-179., 179., n)))]
+
+
+def test_construction_does_not_build_the_dense_grid():
+    world_map = WorldMap()
+    assert world_map.occupied_fields == 0
+
+    airports = _airports(300)
+    for ap in airports:
+        world_map.insert(ap)
+
+    cells = {WorldMap.convert_ll_to_indexes(ap.latitude, ap.longitude) for ap in airports}
+    assert world_map.occupied_fields == len(cells)
+    # Reading empty cells does not materialize them
+    assert len(list(world_map.subgrid(0, 0, 10))) == 400
+    assert world_map.occupied_fields == len(cells)
+
+
+def test_grid_accessors_behave_as_with_a_dense_grid():
+    world_map = WorldMap()
+    airports = _airports(300)
+    for ap in airports:
+        world_map.insert(ap)
+
+    for ap in airports:
+        lat_i, lon_i = WorldMap.convert_ll_to_indexes(ap.latitude, ap.longitude)
+        field = world_map.get_field(lat_i, lon_i)
+        assert field.get(ap.full_name) is ap
+        assert (field.lat, field.lon) == WorldMap.convert_indexes_to_ll(lat_i, lon_i)
+
+    empty = world_map.get_field(5, 7)
+    assert len(empty) == 0 and (empty.lat, empty.lon) == WorldMap.convert_indexes_to_ll(5, 7)
+
+    lat_i, lon_i = WorldMap.convert_ll_to_indexes(airports[0].latitude, airports[0].longitude)
+    fields = list(world_map.subgrid(lat_i - 2, lon_i - 2, 2))
+    expected = [WorldMap.convert_indexes_to_ll(lat_i - 2 + i, lon_i - 2 + j) for i in range(4) for j in range(4)]
+    assert [(field.lat, field.lon) for field in fields] == expected
+    assert airports[0] in [found for field in fields for found in field.airports.values()]
+
+
+def test_find_nearby_matches_a_brute_force_scan():
+    world_map = WorldMap()
+    airports = _airports(500, seed=2)
+    for ap in airports:
+        world_map.insert(ap)
+
+    for ap in airports[:50]:
+        expected = sorted((calculate_distance_km(ap.coordinates, other.coordinates), other.full_name)
+                          for other in airports)
+        expected = [(name, km) for km, name in expected if km < 1500.]
+        found = world_map.find_nearby(ap, max_radius_km=1500.)
+        assert [found_ap.full_name for found_ap, _ in found] == [name for name, _ in expected]
+        assert np.allclose([km for _, km in found], [km for _, km in expected], rtol=0., atol=1e-6)
+
+
+def test_stored_neighbors_list_the_airport_itself_once():
+    airports = _airports(3, seed=3)
+    # Stored lists may include the airport itself, as the spatial index does
+    stored = {airports[0].uid: [(airports[0].uid, 0.), (airports[1].uid, 101.), (airports[2].uid, 102.)]}
+    world_map = WorldMap(neighbors=lambda uid, max_radius_km: stored.get(uid))
+    for ap in airports:
+        world_map.insert(ap)
+
+    found = world_map.find_nearby(airports[0], max_radius_km=500.)
+
+    assert [(found_ap.full_name, km) for found_ap, km in found] == [
+        (airports[0].full_name, 0.), (airports[1].full_name, 101.), (airports[2].full_name, 102.)
+    ]
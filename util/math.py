@@ -1,12 +1,209 @@
 from datetime import timedelta
 
+import numpy as np
 from geopy import distance
 
+from util.types import const
+
+
+WGS84_A: const(float) = 6378.137  # semi-major axis (km)
+WGS84_F: const(float) = 1 / 298.257223563
+WGS84_B: const(float) = (1 - WGS84_F) * WGS84_A
+
+BATCH_DISTANCE_TOLERANCE_KM: const(float) = 1e-6
+
+MEAN_EARTH_RADIUS_KM: const(float) = 6371.0088
+# Worst-case |geodesic - great circle| / great circle for a sphere of MEAN_EARTH_RADIUS_KM against WGS-84.
+# Attained by short meridional arcs at the equator, where the ellipsoid's radius of curvature is smallest (~0.5583%).
+SPHERICAL_MAX_RELATIVE_ERROR: const(float) = 0.0056
+
 
 def calculate_distance_km(a: tuple[float, float], b: tuple[float, float]) -> float:
     return distance.geodesic(a, b, ellipsoid='WGS-84').km
 
 
+def geodesic_distance_km(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray,
+                         max_iterations: int = 200) -> np.ndarray:
+    """
+    Vectorized, element-wise (broadcasting) WGS-84 distances between two sets of points, using Vincenty's inverse
+    formula. For every pair where the iteration converges, the result matches `calculate_distance_km` (geopy's
+    geodesic) to within BATCH_DISTANCE_TOLERANCE_KM (1mm). Nearly antipodal pairs, where Vincenty does not converge,
+    are handed over to `calculate_distance_km` individually, so the whole result is within tolerance.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lat2, lon2)))
+
+    u1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    big_l = np.radians(lon2 - lon1)
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lam = big_l.copy()
+    active = np.ones(lat1.shape, dtype=bool)
+    sin_sigma = cos_sigma = sigma = cos_sq_alpha = cos_2sigma_m = np.zeros(lat1.shape)
+    for _ in range(max_iterations):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(sin_sigma == 0, 0., cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos_sq_alpha == 0, 0., cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+        c = WGS84_F / 16 * cos_sq_alpha * (4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+        lam_prev = lam
+        lam = big_l + (1 - c) * WGS84_F * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+        )
+        active = np.abs(lam - lam_prev) > 1e-12
+        if not active.any():
+            break
+
+    u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+        - big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+    ))
+    rv = WGS84_B * big_a * (sigma - delta_sigma)
+
+    for idx in zip(*np.nonzero(active | ~np.isfinite(rv))):
+        rv[idx] = calculate_distance_km((lat1[idx], lon1[idx]), (lat2[idx], lon2[idx]))
+    return rv
+
+
+def batch_distance_km(origin: tuple[float, float], lats: np.ndarray, lons: np.ndarray,
+                      max_iterations: int = 200) -> np.ndarray:
+    """
+    Vectorized WGS-84 distances from a single point to arrays of points. See `geodesic_distance_km` for accuracy.
+    """
+    return geodesic_distance_km(origin[0], origin[1], lats, lons, max_iterations=max_iterations)
+
+
+def haversine_km(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray,
+                 lon2: np.ndarray) -> np.ndarray:
+    """
+    Vectorized, element-wise great-circle distances on a sphere of MEAN_EARTH_RADIUS_KM.
+    A cheap bound for the WGS-84 geodesic g: |g - h| <= SPHERICAL_MAX_RELATIVE_ERROR * h for any pair, so
+    h * (1 - SPHERICAL_MAX_RELATIVE_ERROR) <= g <= h * (1 + SPHERICAL_MAX_RELATIVE_ERROR).
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * MEAN_EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0., 1.)))
+
+
+class PairDistanceCache:
+    """
+    Memoizes exact distances between coordinate pairs. Pairs are stored symmetrically (keyed by their ordered
+    coordinates), so a -> b and b -> a are solved once. Once `max_entries` is exceeded the cache starts over.
+    """
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries: int = max_entries
+        self._distances: dict[tuple[tuple[float, float], tuple[float, float]], float] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @staticmethod
+    def _key(a: tuple[float, float], b: tuple[float, float]) -> tuple[tuple[float, float], tuple[float, float]]:
+        a, b = (float(a[0]), float(a[1])), (float(b[0]), float(b[1]))
+        return (a, b) if a <= b else (b, a)
+
+    def __len__(self) -> int:
+        return len(self._distances)
+
+    def distance_km(self, a: tuple[float, float], b: tuple[float, float]) -> float:
+        key = self._key(a, b)
+        if (rv := self._distances.get(key)) is not None:
+            self.hits += 1
+            return rv
+        self.misses += 1
+        rv = calculate_distance_km(a, b)
+        self._store([(key, rv)])
+        return rv
+
+    def _store(self, items: list):
+        if self.max_entries is not None and len(self._distances) + len(items) > self.max_entries:
+            self._distances.clear()
+        self._distances.update(items)
+
+    def batch_distance_km(self, origin: tuple[float, float], lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        # Cached pairs are looked up, the rest are solved together with `geodesic_distance_km` and stored
+        keys = [self._key(origin, (lat, lon)) for lat, lon in zip(lats.tolist(), lons.tolist())]
+        rv = np.fromiter((self._distances.get(key, np.nan) for key in keys), dtype=np.float64, count=len(keys))
+        missing = np.flatnonzero(np.isnan(rv))
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            rv[missing] = geodesic_distance_km(origin[0], origin[1], lats[missing], lons[missing])
+            self._store(list(zip((keys[i] for i in missing.tolist()), rv[missing].tolist())))
+        return rv
+
+    def clear(self):
+        self._distances.clear()
+
+
+def within_radius_km(origin: tuple[float, float], lats: np.ndarray, lons: np.ndarray, radius_km: float,
+                     exact: bool = True, cache: PairDistanceCache = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Positions (into `lats`/`lons`) and distances of the points within `radius_km` of `origin`, filtered in two tiers:
+        - the haversine bound rejects every point that is certainly outside the radius, and accepts every point that
+          is certainly inside it
+        - only the borderline points, which SPHERICAL_MAX_RELATIVE_ERROR does not settle, get an exact WGS-84 solve
+    With `exact`, accepted points also get their exact distance; otherwise they keep the haversine estimate.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    approx = haversine_km(origin[0], origin[1], lats, lons)
+    candidates = np.flatnonzero(approx * (1 - SPHERICAL_MAX_RELATIVE_ERROR) <= radius_km)
+    distances = approx[candidates]
+    solve = np.ones(len(candidates), dtype=bool) if exact else \
+        distances * (1 + SPHERICAL_MAX_RELATIVE_ERROR) > radius_km
+    if solve.any():
+        idx = candidates[solve]
+        if cache is not None:
+            distances[solve] = cache.batch_distance_km(origin, lats[idx], lons[idx])
+        else:
+            distances[solve] = geodesic_distance_km(origin[0], origin[1], lats[idx], lons[idx])
+    keep = distances <= radius_km
+    return candidates[keep], distances[keep]
+
+
+def upper_triangle_distances_km(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """
+    Condensed (row-major, diagonal excluded) upper-triangular distance matrix for the given points,
+    i.e. entry k holds the distance for the k-th pair (i, j) with i < j. Computed one row at a time.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    n = len(lats)
+    rv = np.empty(n * (n - 1) // 2, dtype=np.float64)
+    offset = 0
+    for i in range(n - 1):
+        row = batch_distance_km((lats[i], lons[i]), lats[i + 1:], lons[i + 1:])
+        rv[offset:offset + len(row)] = row
+        offset += len(row)
+    return rv
+
+
+def to_unit_vectors(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    lat_r = np.radians(np.asarray(lats, dtype=np.float64))
+    lon_r = np.radians(np.asarray(lons, dtype=np.float64))
+    cos_lat = np.cos(lat_r)
+    return np.stack((cos_lat * np.cos(lon_r), cos_lat * np.sin(lon_r), np.sin(lat_r)), axis=-1)
+
+
+def chord_for_km(km: float | np.ndarray) -> float | np.ndarray:
+    # Straight-line distance between two points of the unit sphere which are `km` apart along a great circle
+    angle = np.minimum(np.asarray(km, dtype=np.float64) / MEAN_EARTH_RADIUS_KM, np.pi)
+    return 2 * np.sin(angle / 2)
+
+
+def km_for_chord(chord: float | np.ndarray) -> float | np.ndarray:
+    return 2 * MEAN_EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord, dtype=np.float64) / 2, 1.))
+
+
 def format_timedelta_string(t: timedelta) -> str:
     if t.seconds == 0:
         return f"{t.microseconds / 1000}ms"
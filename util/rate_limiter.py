@@ -0,0 +1,172 @@
+import asyncio
+import dataclasses
+import random
+import time
+from threading import Lock
+from typing import Mapping
+
+from .logging.logger import Logger, get_default_logger
+from .types import nullable, const
+
+
+@dataclasses.dataclass
+class TokenBucket:
+    """
+    `capacity` tokens, refilled continuously over `period_s`. Tokens may be borrowed, leaving the bucket negative:
+    that debt is the wait of whoever took the last token.
+    """
+
+    capacity: float
+    period_s: float
+    tokens: float = None
+    updated_at: float = dataclasses.field(default_factory=time.monotonic)
+
+    def __post_init__(self):
+        if self.tokens is None:
+            self.tokens = self.capacity
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period_s
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self) -> float:
+        # Returns how long to wait before the token taken may be used
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.
+
+
+class RateLimiter:
+    """
+    Keeps requests to an API within its per-second and per-day budgets, shared by every session (and thread, and
+    event loop) holding the same limiter:
+        - each request takes a token from both token buckets, waiting until it may go ahead
+        - the buckets follow the `X-RateLimit-Limit-*` / `X-RateLimit-Remaining-*` headers of the responses passed to
+          `update_from_headers`, so a budget does not have to be known up-front
+        - after a 429 or 5xx, `retry_delay` gives a jittered exponential backoff (or the server's `Retry-After`), and
+          a 429 holds back every caller until then
+    A budget of None is not limited (until headers say otherwise). `stats` shows the tokens left and the time spent
+    waiting.
+    """
+
+    logger: Logger = get_default_logger()
+
+    SECOND: const(str) = "Second"
+    DAY: const(str) = "Day"
+    _PERIODS_S: const(dict[str, float]) = {SECOND: 1., DAY: 24 * 60 * 60.}
+    _LIMIT_HEADER: const(str) = "X-RateLimit-Limit-{}"
+    _REMAINING_HEADER: const(str) = "X-RateLimit-Remaining-{}"
+
+    RETRY_STATUSES: const(frozenset[int]) = frozenset({429, 500, 502, 503, 504})
+    LONG_WAIT_S: const(float) = 60.
+
+    def __init__(self, per_second: float = None, per_day: int = None, max_retries: int = 3,
+                 backoff_base_s: float = 0.5, backoff_max_s: float = 30., logger: Logger = None):
+        if logger:
+            self.logger: Logger = logger
+            self.__class__.logger = logger
+        self._lock: Lock = Lock()
+        self._buckets: dict[str, TokenBucket] = {}
+        for period, budget in ((self.SECOND, per_second), (self.DAY, per_day)):
+            if budget:
+                self._buckets[period] = TokenBucket(capacity=budget, period_s=self._PERIODS_S[period])
+        self.max_retries: int = max_retries
+        self.backoff_base_s: float = backoff_base_s
+        self.backoff_max_s: float = backoff_max_s
+        self._blocked_until: float = 0.
+        self.requests: int = 0
+        self.waits: int = 0
+        self.waited_s: float = 0.
+        self.retries: int = 0
+        self.throttled: int = 0
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait_s = max(self._blocked_until - now, 0.)
+            for bucket in self._buckets.values():
+                bucket.refill(now)
+                wait_s = max(wait_s, bucket.take())
+            self.requests += 1
+            if wait_s > 0:
+                self.waits += 1
+                self.waited_s += wait_s
+        if wait_s > self.LONG_WAIT_S:
+            self.logger.warning(f"Rate limit reached, the next request waits {wait_s:.0f}s")
+        return wait_s
+
+    def acquire(self) -> float:
+        """
+        Blocks until a request may be sent. Returns the time waited.
+        """
+        if (wait_s := self._reserve()) > 0:
+            time.sleep(wait_s)
+        return wait_s
+
+    async def acquire_async(self) -> float:
+        if (wait_s := self._reserve()) > 0:
+            await asyncio.sleep(wait_s)
+        return wait_s
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        # Header lookups are case-insensitive with both requests and aiohttp
+        with self._lock:
+            now = time.monotonic()
+            for period, period_s in self._PERIODS_S.items():
+                limit = self._header_value(headers, self._LIMIT_HEADER.format(period))
+                remaining = self._header_value(headers, self._REMAINING_HEADER.format(period))
+                bucket = self._buckets.get(period)
+                if limit is not None and limit > 0:
+                    if bucket is None:
+                        bucket = self._buckets[period] = TokenBucket(capacity=limit, period_s=period_s)
+                    else:
+                        bucket.refill(now)
+                        bucket.capacity = limit
+                if bucket is not None and remaining is not None:
+                    bucket.refill(now)
+                    # Upstream's count wins when it is lower (other clients may share the quota)
+                    bucket.tokens = min(bucket.tokens, remaining)
+
+    @staticmethod
+    def _header_value(headers: Mapping[str, str], key: str) -> nullable(float):
+        try:
+            return float(headers.get(key))
+        except (TypeError, ValueError):
+            return
+
+    def retry_delay(self, status: int, attempt: int, headers: Mapping[str, str] = None) -> nullable(float):
+        """
+        How long to wait before retrying a request which got `status` on its `attempt`th retry (0 for the first
+        request), or None if it should not be retried.
+        """
+        if status not in self.RETRY_STATUSES or attempt >= self.max_retries:
+            return
+        retry_after = self._header_value(headers or {}, "Retry-After")
+        if retry_after is None:
+            # Full jitter, so that throttled callers do not all come back at once
+            retry_after = random.uniform(0., min(self.backoff_max_s, self.backoff_base_s * 2 ** attempt))
+        with self._lock:
+            self.retries += 1
+            if status == 429:
+                self.throttled += 1
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        return retry_after
+
+    def tokens(self) -> dict[str, float]:
+        with self._lock:
+            now = time.monotonic()
+            for bucket in self._buckets.values():
+                bucket.refill(now)
+            return {period: bucket.tokens for period, bucket in self._buckets.items()}
+
+    def stats(self) -> dict[str, float]:
+        return {f"tokens_{period.lower()}": tokens for period, tokens in self.tokens().items()} | {
+            "requests": self.requests,
+            "waits": self.waits,
+            "waited_s": self.waited_s,
+            "retries": self.retries,
+            "throttled": self.throttled
+        }